@@ -1,66 +1,89 @@
 import os
+from functools import lru_cache
 from fastapi import FastAPI
 from langchain_community.utilities import SQLDatabase
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, SystemMessage, ToolMessage
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
 import matplotlib
-import psycopg
 matplotlib.use('Agg') # non-interactive backend
 import logging
 
 # import user modules
+from artifacts import set_artifact_owner
 from executor import create_react_agent
 from langchain_community.utilities import SQLDatabase
-from langchain_community.tools import QuerySQLDatabaseTool
 from langchain_experimental.tools import PythonAstREPLTool
-from tools import ConvertGeneTool, CoxPHStatsLog2TPMExprTool, CoxRegressionBaseDataTool, DisplayPlotTool, DocumentSearchTool, GeneCopyNumberTool, GeneMetadataTool, GenerateGraphFilepathTool, MADLog2TPMExprTool, PythonSQLTool, RetrieveGeneListTool, SurvivalDataTool
-from llm_utils import universal_chat_model
+from tools import ClusteredHeatmapTool, ConvertGeneTool, CoxPHStatsLog2TPMExprTool, CoxPHSubpopulationTool, CoxRegressionBaseDataTool, DifferentialExpressionTool, DisplayPlotTool, DocumentSearchTool, GeneCopyNumberTool, GeneMetadataTool, GenerateGraphFilepathTool, MADLog2TPMExprTool, MADSubpopulationTool, PythonSQLTool, RenderPlotTool, RetrieveGeneListTool, SurvivalAnalysisTool, SurvivalDataTool, SurvivalScanTool, TrialSQLTool
+from intents import answer_directly
+from llm_utils import cacheable_prompt, get_chat_model
+from router import ModelRouter
 from utils import parse_step
-from variables import COMMPASS_DB_URI, COMMPASS_AUTH_DSN, MODEL_ID
+from variables import COMMPASS_DB_URI, MAX_TOOL_CONCURRENCY, MODEL_ID, ROUTER_MODEL_ID
 
 # Create a system message for the agent
-# dynamic variables will be filled in at the start of each session
+# dynamic variables will be filled in once per process, so the prompt is byte-identical
+# across sessions and stays in the provider's prompt cache
 # removed db description
-def create_system_message() -> str:
+@lru_cache(maxsize=1)
+def _system_prompt() -> str:
     db = SQLDatabase.from_uri(COMMPASS_DB_URI)
     with open(f'{os.path.dirname(__file__)}/prompt.txt', 'r') as f:
         latent_system_message = f.read()
-    system_message = latent_system_message.format(
+    return latent_system_message.format(
         dialect=db.dialect,
         commpass_db_uri=COMMPASS_DB_URI
     )
-    return [HumanMessage(content='Hello, MyeGPT!'),
-            SystemMessage(content=system_message)]
+
+def create_system_message() -> list:
+    # system prompt first, so that it is part of the cached prefix
+    return [SystemMessage(content=_system_prompt()),
+            HumanMessage(content='Hello, MyeGPT!')]
 
 async def send_init_prompt(app:FastAPI) -> None:
     # initializes LLM, stores response in app.state.init_response
     # then flags app.state.init_prompt_done event as done
     global graph
     global config_ask
-    config_init = {"configurable":{"thread_id": app.state.username, "recursion_limit": 5}} # init configuration
-    config_ask = {"configurable":{"thread_id": app.state.username, "recursion_limit": 50}} # ask configuration
+    config_init = {"configurable":{"thread_id": app.state.thread_id, "recursion_limit": 5}} # init configuration
+    config_ask = ask_config(app.state.thread_id) # ask configuration
+
+    # shared chat model, created once per process
+    llm = get_chat_model(MODEL_ID)
 
-    #  initialize the chat model
-    llm = universal_chat_model(MODEL_ID)
+    tools = [ConvertGeneTool(),
+             GeneMetadataTool(),
+             PythonAstREPLTool(),
+             TrialSQLTool(),
+             PythonSQLTool(),
+             DocumentSearchTool(),
+             GenerateGraphFilepathTool(),
+             DisplayPlotTool(),
+             RenderPlotTool(),
+             GeneCopyNumberTool(),
+             CoxRegressionBaseDataTool(),
+             CoxPHStatsLog2TPMExprTool(),
+             CoxPHSubpopulationTool(),
+             MADLog2TPMExprTool(),
+             MADSubpopulationTool(),
+             RetrieveGeneListTool(),
+             SurvivalDataTool(),
+             SurvivalAnalysisTool(),
+             SurvivalScanTool(),
+             ClusteredHeatmapTool(),
+             DifferentialExpressionTool()
+             ]
 
-    commpass_db = SQLDatabase.from_uri(COMMPASS_DB_URI)
+    # route intermediate tool-calling steps to a fast model if one is configured
+    # the router places cache breakpoints for the model of each route itself
+    if ROUTER_MODEL_ID:
+        model, prompt = ModelRouter(MODEL_ID, ROUTER_MODEL_ID, tools), cacheable_prompt()
+    else:
+        model, prompt = llm, cacheable_prompt(MODEL_ID)
 
     graph = create_react_agent(
-        model=llm,
-        tools = [ConvertGeneTool(),
-                 GeneMetadataTool(),
-                 PythonAstREPLTool(),
-                 QuerySQLDatabaseTool(db=commpass_db),
-                 PythonSQLTool(),
-                 DocumentSearchTool(),
-                 GenerateGraphFilepathTool(),
-                 DisplayPlotTool(),
-                 GeneCopyNumberTool(),
-                 CoxRegressionBaseDataTool(),
-                 CoxPHStatsLog2TPMExprTool(),
-                 MADLog2TPMExprTool(),
-                 RetrieveGeneListTool(),
-                 SurvivalDataTool()
-                 ],
+        model=model,
+        tools=tools,
+        prompt=prompt,
         checkpointer=app.state.checkpointer,
     )
 
@@ -87,13 +110,66 @@ async def send_init_prompt(app:FastAPI) -> None:
     
     return
 
-def query_agent(app: FastAPI, user_input: str):
-    global graph
+# conversation thread each user's turns go to, users run concurrently so turns never use the global config_ask
+_current_threads = {}  # username -> thread_id
+
+def ask_config(thread_id: str) -> dict:
+    return {"configurable":{"thread_id": thread_id, "recursion_limit": 50}, "max_concurrency": MAX_TOOL_CONCURRENCY}
+
+def current_thread(username: str) -> str | None:
+    return _current_threads.get(username)
+
+# point subsequent turns of the user at another conversation thread
+def switch_thread(app: FastAPI, thread_id: str, username: str) -> None:
     global config_ask
+    _current_threads[username] = thread_id
+    # the init prompt and /api/fix_history work on the thread of the last user to log in
+    app.state.thread_id = thread_id
+    config_ask = ask_config(thread_id)
+
+# human questions and final AI answers of a thread, for display
+async def get_thread_messages(app: FastAPI, thread_id: str) -> list[dict]:
+    global graph
+    state = await graph.aget_state(ask_config(thread_id))
+    messages = []
+    for msg in state.values.get("messages", []):
+        if isinstance(msg, HumanMessage) and msg.text != 'Hello, MyeGPT!':
+            messages.append({"role": "user", "content": msg.text})
+        elif isinstance(msg, AIMessage) and msg.text.strip() and not msg.tool_calls:
+            messages.append({"role": "ai", "content": msg.text})
+    return messages
+
+async def answer_fast_path(app: FastAPI, user_input: str, thread_id: str) -> str | None:
+    # simple lookups are answered from tools without calling the LLM, None falls back to query_agent
+    # the exchange is still written to the thread, so follow-up questions can refer to it
+    global graph
+    answer = answer_directly(user_input)
+    if answer is None:
+        return None
+    config = ask_config(thread_id)
+    messages = [HumanMessage(content=user_input), AIMessage(content=answer)]
+    state = await graph.aget_state(config)
+    if not state.values.get("messages"):
+        messages = create_system_message()[:1] + messages
+    await graph.aupdate_state(config, {"messages": messages}, as_node="agent")
+    return f"🤖 Agent: {answer}"
+
+async def query_agent(app: FastAPI, user_input: str, thread_id: str, username: str):
+    # runs on the event loop, so parallel tool calls of a step run concurrently
+    # up to MAX_TOOL_CONCURRENCY at a time
+    global graph
+    config = ask_config(thread_id)
     user_message = HumanMessage(content=user_input)
+    messages = [user_message]
+    # files written by tools during this run go to the user's artifact directories
+    # the caller, not app.state.username, which is whoever logged in last
+    set_artifact_owner(username)
     
     try:
-        for step in graph.stream({"messages": [user_message]}, config_ask, stream_mode="updates"):
+        # new threads start with the system prompt
+        if not (await graph.aget_state(config)).values.get("messages"):
+            messages = create_system_message()[:1] + messages
+        async for step in graph.astream({"messages": messages}, config, stream_mode="updates"):
             # for python tty
             print(step)
             # for frontend
@@ -104,54 +180,64 @@ def query_agent(app: FastAPI, user_input: str):
         # handle openai.BadRequestError: Error code: 400 - {'error': {'message': 'Input tokens exceed the configured limit of 272000 tokens. Your messages resulted in 287850 tokens. Please reduce the length of the messages.', 'type': 'invalid_request_error', 'param': 'messages', 'code': 'context_length_exceeded'}}
         yield f"⁉️ Unexpected message: {str(e)}"
 
-async def handle_invalid_chat_history(app: FastAPI, e: Exception):
+# result recorded for tool calls that were cut off e.g. by a crash or a closed connection
+INTERRUPTED_TOOL_RESULT = "Error: this tool call was interrupted before it returned a result. Call the tool again if the result is still needed."
+
+def find_dangling_tool_calls(messages: list) -> list[tuple[int, dict]]:
+    # (position of the AIMessage, tool call) for every tool call without a ToolMessage answering it
+    answered = {msg.tool_call_id for msg in messages if isinstance(msg, ToolMessage)}
+    return [(i, call) for i, msg in enumerate(messages) if isinstance(msg, AIMessage)
+            for call in msg.tool_calls if call["id"] not in answered]
+
+def patch_dangling_tool_calls(messages: list) -> list | None:
+    # insert a synthetic ToolMessage right after the AIMessage of each dangling tool call
+    # returns None if the history is consistent
+    dangling = find_dangling_tool_calls(messages)
+    if not dangling:
+        return None
+    calls_at = {}
+    for i, call in dangling:
+        calls_at.setdefault(i, []).append(call)
+    patched = []
+    for i, msg in enumerate(messages):
+        patched.append(msg)
+        for call in calls_at.get(i, []):
+            logging.warning(f"Closing tool call {call['name']} ({call['id']}) that has no result")
+            patched.append(ToolMessage(content=INTERRUPTED_TOOL_RESULT, tool_call_id=call["id"], name=call["name"]))
+    return patched
+
+async def repair_thread(app: FastAPI, thread_id: str | None = None) -> int:
+    # cheap enough to run before every turn: one lookup of the latest checkpoint, no LLM call
+    # thread_id defaults to the thread of the last user to log in, see switch_thread
+    # returns 0 = empty history, 1 = no changes, 2 = dangling tool calls patched
     global graph
     global config_ask
-    if "Found AIMessages with tool_calls that do not have a corresponding ToolMessage" in str(e) or "bypass" == str(e):
-
-        # get the list of most recent messages from the graph state with graph.getState(config)
-        state = await graph.aget_state(config_ask)
-        
-        if "messages" in state[0]:
-            response_code = 1 # 1 = no changes, 2 = deletion made
-            # modify the list of messages remove unanswered tool calls from AIMessages
-            for step in range(len(state[0]["messages"]) - 1, -1, -1):
-                msg = state[0]["messages"][step]
-                # support both dict-like and object-like messages
-                msg_type = msg.get("type") if isinstance(msg, dict) else getattr(msg, "type", None)
-                additional_kwargs = msg.get("additional_kwargs") if isinstance(msg, dict) else getattr(msg, "additional_kwargs", None)
-                if msg_type == "ai" and isinstance(additional_kwargs, dict) and "tool_calls" in additional_kwargs:
-                    logging.warning(f"Removing potential AIMessage without accompanying ToolMessage: {str(msg)}")
-                    response_code = 2
-                    break
-
-            # delete all checkpoints after offending message to attempt to reload
-            auth_db_conn = psycopg.connect(COMMPASS_AUTH_DSN)
-            with auth_db_conn.cursor() as cur:
-                cur.execute(
-                    """
-                    DELETE FROM checkpoints.checkpoints
-                    WHERE thread_id = %s
-                        AND (metadata->>'step') IS NOT NULL
-                        AND (metadata->>'step')::int >= %s
-                    """,
-                    (app.state.username, step),
-                )
-                auth_db_conn.commit()
-            
-            state[0]["messages"] = state[0]["messages"][:step]
-            await graph.aupdate_state(config_ask, state, as_node='tools')
-            await graph.ainvoke({"messages": create_system_message()}, config_ask)  # empty messages to trigger reload
-            return response_code
-        else:
-            # conversation history is empty
-            return 0
+    config = ask_config(thread_id) if thread_id else config_ask
+    checkpoint = await app.state.checkpointer.aget_tuple(config)
+    messages = checkpoint.checkpoint["channel_values"].get("messages", []) if checkpoint else []
+    if not messages:
+        return 0
+    patched = patch_dangling_tool_calls(messages)
+    if patched is None:
+        return 1
+    # replace the message list in a single new checkpoint, earlier checkpoints are left untouched
+    await graph.aupdate_state(config, {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES)] + patched}, as_node="tools")
+    return 2
 
+async def handle_invalid_chat_history(app: FastAPI, e: Exception):
+    if "Found AIMessages with tool_calls that do not have a corresponding ToolMessage" in str(e) or "bypass" == str(e):
+        return await repair_thread(app)
     else:
         raise e
 
 __all__ = [
+    "answer_fast_path",
+    "ask_config",
+    "current_thread",
+    "get_thread_messages",
     "handle_invalid_chat_history",
+    "repair_thread",
     "send_init_prompt",
+    "switch_thread",
     "query_agent"
 ]
\ No newline at end of file
@@ -0,0 +1,226 @@
+import os
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import psycopg
+from contextvars import ContextVar
+from typing import Callable
+
+from staticfiles import ENCODINGS, precompress, remove_precompressed
+from variables import ARTIFACT_QUOTA_MB, ARTIFACT_TTL_DAYS, COMMPASS_AUTH_DSN
+
+# files written for the user by tools and the python REPL, served under /result and /graph
+# each user has a sub-directory, e.g. result/<owner>/kaplan_meier_os_<digest>.csv,
+# files written by tools are named after their content so identical results are stored once
+# auth.artifacts indexes the files with their size, last access and an optional reuse key
+ARTIFACT_KINDS = ('result', 'graph')
+
+# username of the agent run writing artifacts, set per request so concurrent runs do not mix
+_owner = ContextVar('artifact_owner', default=None)
+
+def set_artifact_owner(username: str | None) -> None:
+    _owner.set(username)
+
+def artifact_owner() -> str | None:
+    return _owner.get()
+
+def owner_dir(username: str) -> str:
+    # directory name of a user, usernames are e-mail addresses and do not belong in URLs
+    return hashlib.sha256(username.encode()).hexdigest()[:16]
+
+def setup_artifacts_table() -> None:
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS auth.artifacts (
+                    path TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    size BIGINT NOT NULL,
+                    reuse_key TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    accessed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS artifacts_username_reuse_key_idx ON auth.artifacts (username, reuse_key)")
+            cur.execute("CREATE INDEX IF NOT EXISTS artifacts_accessed_at_idx ON auth.artifacts (accessed_at)")
+            conn.commit()
+
+
+def new_artifact_path(kind: str, prefix: str, ext: str) -> str:
+    # unique path in the current user's directory for a file that is about to be written
+    # the shared directory is used outside of agent runs, e.g. in scripts
+    username = _owner.get()
+    folder = os.path.join(kind, owner_dir(username)) if username else kind
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{prefix}_{uuid.uuid4().hex[:8]}{ext}")
+
+
+def file_digest(path: str) -> str:
+    # sha256 hex digest of a file's contents
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _content_path(path: str, digest: str) -> str:
+    # result/<owner>/kaplan_meier_os_ab12cd34.csv -> result/<owner>/kaplan_meier_os_<digest>.csv
+    folder, name = os.path.split(path)
+    stem, ext = os.path.splitext(name)
+    stem = stem.rsplit('_', 1)[0]
+    return os.path.join(folder, f"{stem}_{digest[:16]}{ext}")
+
+
+def _enforce_quota(cur: psycopg.Cursor, username: str) -> None:
+    # evict the least recently used artifacts of the user until the rest fits in the quota
+    # the most recent artifact is always kept, even if it alone is over the quota
+    cur.execute("SELECT path, size FROM auth.artifacts WHERE username = %s ORDER BY accessed_at DESC", (username,))
+    total, evicted = 0, []
+    for i, (path, size) in enumerate(cur.fetchall()):
+        total += size
+        if i and total > ARTIFACT_QUOTA_MB * 1024 * 1024:
+            evicted.append(path)
+    if evicted:
+        cur.execute("DELETE FROM auth.artifacts WHERE path = ANY(%s)", (evicted,))
+        for path in evicted:
+            if os.path.exists(path):
+                os.remove(path)
+            remove_precompressed(path)
+        logging.info(f"Evicted {len(evicted)} artifacts of {username} over the {ARTIFACT_QUOTA_MB} MB quota")
+
+
+def register_artifact(path: str, reuse_key: str | None = None, content_address: bool = True) -> str:
+    # input: path of a written file, key under which tools can find it again, whether to rename it after its content
+    # output: final path of the file, an existing identical file of the user if there is one
+    # files outside of the current user's directories are left alone
+    username = _owner.get()
+    parts = os.path.normpath(path).split(os.sep)
+    if not username or len(parts) != 3 or parts[0] not in ARTIFACT_KINDS or parts[1] != owner_dir(username) or not os.path.exists(path):
+        return path
+    digest = file_digest(path)
+    if content_address:
+        final = _content_path(path, digest)
+        if os.path.exists(final):
+            os.remove(path)
+        else:
+            os.replace(path, final)
+        path = final
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO auth.artifacts (path, username, digest, size, reuse_key) VALUES (%s, %s, %s, %s, %s) "
+                "ON CONFLICT (path) DO UPDATE SET digest = EXCLUDED.digest, size = EXCLUDED.size, accessed_at = now(), "
+                "reuse_key = COALESCE(EXCLUDED.reuse_key, auth.artifacts.reuse_key)",
+                (path, username, digest, os.path.getsize(path), reuse_key),
+            )
+            _enforce_quota(cur, username)
+            conn.commit()
+    # compressed copies for downloads, served by staticfiles.CachedStaticFiles
+    precompress(path)
+    return path
+
+
+def save_artifact(kind: str, prefix: str, ext: str, write: Callable[[str], None], reuse_key: str | None = None) -> str:
+    # input: 'result' or 'graph', file name prefix and extension, function writing the file to the given path
+    # output: path of the stored file
+    path = new_artifact_path(kind, prefix, ext)
+    write(path)
+    return register_artifact(path, reuse_key)
+
+
+def find_artifact(reuse_key: str) -> str | None:
+    # path of the current user's artifact stored under reuse_key, or None
+    username = _owner.get()
+    if not username:
+        return None
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT path FROM auth.artifacts WHERE username = %s AND reuse_key = %s ORDER BY accessed_at DESC LIMIT 1",
+                (username, reuse_key),
+            )
+            row = cur.fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[0]):
+                cur.execute("DELETE FROM auth.artifacts WHERE path = %s", (row[0],))
+                conn.commit()
+                return None
+            cur.execute("UPDATE auth.artifacts SET accessed_at = now() WHERE path = %s", (row[0],))
+            conn.commit()
+    return row[0]
+
+
+def collect_artifacts(ttl_days: float = ARTIFACT_TTL_DAYS) -> int:
+    # delete artifacts not used for ttl_days, returns the number of files deleted
+    # files without an index entry, e.g. written by the python REPL, expire by modification time
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM auth.artifacts WHERE accessed_at < now() - make_interval(secs => %s) RETURNING path", (ttl_days * 86400,))
+            expired = [row[0] for row in cur.fetchall()]
+            cur.execute("SELECT path FROM auth.artifacts")
+            indexed = {row[0] for row in cur.fetchall()}
+            conn.commit()
+
+    cutoff = time.time() - ttl_days * 86400
+    deleted = 0
+    for kind in ARTIFACT_KINDS:
+        for root, dirs, files in os.walk(kind):
+            for file in files:
+                path = os.path.join(root, file)
+                # compressed copies live as long as their file
+                original = next((path.removesuffix(suffix) for _, suffix in ENCODINGS if path.endswith(suffix)), path)
+                if original in indexed or os.path.getmtime(path) >= cutoff:
+                    continue
+                os.remove(path)
+                deleted += 1
+    # index entries whose file was removed outside of this module
+    missing = [path for path in indexed if not os.path.exists(path)]
+    if missing:
+        with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM auth.artifacts WHERE path = ANY(%s)", (missing,))
+                conn.commit()
+    logging.info(f"Artifact collection deleted {deleted} files, {len(expired)} of them indexed")
+    return deleted
+
+
+def delete_user_artifacts(username: str) -> None:
+    # remove every artifact of a user together with the index entries
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM auth.artifacts WHERE username = %s", (username,))
+            conn.commit()
+    for kind in ARTIFACT_KINDS:
+        shutil.rmtree(os.path.join(kind, owner_dir(username)), ignore_errors=True)
+
+
+def artifact_usage(username: str) -> dict:
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*), COALESCE(sum(size), 0) FROM auth.artifacts WHERE username = %s", (username,))
+            n_files, size = cur.fetchone()
+    return {"files": n_files, "bytes": int(size), "quota_bytes": ARTIFACT_QUOTA_MB * 1024 * 1024, "ttl_days": ARTIFACT_TTL_DAYS}
+
+
+__all__ = [
+    "ARTIFACT_KINDS",
+    "artifact_owner",
+    "artifact_usage",
+    "collect_artifacts",
+    "delete_user_artifacts",
+    "file_digest",
+    "find_artifact",
+    "new_artifact_path",
+    "owner_dir",
+    "register_artifact",
+    "save_artifact",
+    "set_artifact_owner",
+    "setup_artifacts_table",
+]
@@ -0,0 +1,123 @@
+import os
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from scipy.cluster.hierarchy import leaves_list, linkage, optimal_leaf_ordering
+from scipy.spatial.distance import pdist
+
+filedir = os.path.dirname(os.path.abspath(__file__))
+
+# hierarchical clustering of expression matrices, rows are clustered
+# linkages are cached in memory and on disk, keyed by the data and the clustering options,
+# so re-plotting the same genes and samples with other labels or colours does not re-cluster
+CACHE_DIR = os.path.join(filedir, 'cache', 'linkage')
+MEMORY_CACHE_SIZE = 32
+# linkage files beyond these limits are removed, least recently used first
+DISK_CACHE_FILES = 2000
+DISK_CACHE_MB = 200
+METHODS = ('average', 'complete', 'single', 'ward')
+METRICS = ('correlation', 'euclidean', 'cosine')
+# optimal leaf ordering takes ~3 s at 1000 leaves and grows steeply, larger trees keep the linkage order
+OPTIMAL_ORDERING_MAX_LEAVES = 1000
+_memory = OrderedDict()
+_lock = threading.Lock()
+
+def _cache_key(values: np.ndarray, method: str, metric: str, optimal: bool) -> str:
+    sha = hashlib.sha1(np.ascontiguousarray(values, dtype=np.float32).tobytes())
+    sha.update(f'{values.shape}:{method}:{metric}:{optimal}'.encode())
+    return sha.hexdigest()
+
+def _cached(key: str) -> np.ndarray | None:
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return _memory[key]
+    path = os.path.join(CACHE_DIR, f'{key}.npy')
+    try:
+        Z = np.load(path)
+    except FileNotFoundError:
+        return None
+    # the modification time orders the files for pruning
+    os.utime(path)
+    return Z
+
+def _prune() -> None:
+    files = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.npy') and not entry.name.endswith('.tmp.npy'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort(reverse=True)
+    total = 0
+    for n, (_, size, path) in enumerate(files):
+        total += size
+        if n >= DISK_CACHE_FILES or total > DISK_CACHE_MB * 2**20:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # removed by another worker
+                pass
+
+def _store(key: str, Z: np.ndarray) -> None:
+    with _lock:
+        _memory[key] = Z
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_CACHE_SIZE:
+            _memory.popitem(last=False)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = os.path.join(CACHE_DIR, f'{key}.{os.getpid()}.tmp.npy')
+    np.save(tmp, Z)
+    os.replace(tmp, os.path.join(CACHE_DIR, f'{key}.npy'))
+    _prune()
+
+def cluster_linkage(values: np.ndarray, method: str = 'average', metric: str = 'correlation',
+                    optimal: bool = True) -> np.ndarray:
+    # input: matrix (R, C) whose rows are clustered, linkage method, distance metric, whether to apply optimal leaf ordering
+    # output: scipy linkage matrix (R-1, 4)
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {', '.join(METHODS)}")
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+    if method == 'ward':
+        # ward is only defined for euclidean distances
+        metric = 'euclidean'
+    values = np.nan_to_num(np.asarray(values, dtype=np.float32))
+    optimal = optimal and len(values) <= OPTIMAL_ORDERING_MAX_LEAVES
+    key = _cache_key(values, method, metric, optimal)
+    Z = _cached(key)
+    if Z is not None:
+        return Z
+    # condensed distances, correlation distances of flat rows are undefined and treated as unrelated
+    dist = np.nan_to_num(pdist(values, metric), nan=1.0)
+    Z = linkage(dist, method)
+    if optimal:
+        Z = optimal_leaf_ordering(Z, dist)
+    _store(key, Z)
+    return Z
+
+def cluster_order(values: np.ndarray, method: str = 'average', metric: str = 'correlation',
+                  optimal: bool = True) -> np.ndarray:
+    # row positions in dendrogram leaf order
+    if len(values) < 3:
+        return np.arange(len(values))
+    return leaves_list(cluster_linkage(values, method, metric, optimal))
+
+def cluster_matrix(values: np.ndarray, method: str = 'average', metric: str = 'correlation',
+                   cluster_columns: bool = True) -> tuple[np.ndarray, np.ndarray]:
+    # input: matrix (R, C) e.g. z-scored genes x samples
+    # output: row order (R,) and column order (C,), the columns keep their order unless clustered
+    rows = cluster_order(values, method, metric)
+    cols = cluster_order(values.T, method, metric) if cluster_columns else np.arange(values.shape[1])
+    return rows, cols
+
+__all__ = [
+    "METHODS",
+    "METRICS",
+    "cluster_linkage",
+    "cluster_matrix",
+    "cluster_order",
+]
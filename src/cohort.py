@@ -0,0 +1,85 @@
+import os
+import re
+import pandas as pd
+
+from sql import read_query
+
+# first-visit, bone marrow CD138+ samples e.g. MMRF_1014_1_BM_CD138pos
+FIRST_VISIT_SAMPLE_PATTERN = re.compile(r'^(MMRF_[0-9]+)_1_BM_CD138pos$', re.IGNORECASE)
+PUBLIC_ID_PATTERN = re.compile(r'^MMRF_[0-9]+$', re.IGNORECASE)
+
+def first_visit_public_id(sample: str) -> str | None:
+    # input: sample name e.g. MMRF_1014_1_BM_CD138pos
+    # output: public id e.g. MMRF_1014, or None if not a first-visit BM CD138+ sample
+    match = FIRST_VISIT_SAMPLE_PATTERN.match(sample)
+    return match.group(1).upper() if match else None
+
+def _public_id_column(df: pd.DataFrame) -> str:
+    # prefer a public_id column (any case), fall back to the first column
+    for col in df.columns:
+        if str(col).lower() == 'public_id':
+            return col
+    return df.columns[0]
+
+def _read_table(spec: str) -> pd.DataFrame:
+    # load a csv file path or run a SELECT statement into a data frame
+    if spec.lower().endswith('.csv'):
+        if not os.path.exists(spec):
+            raise ValueError(f"file {spec} does not exist")
+        return pd.read_csv(spec)
+    if re.match(r'^(SELECT|WITH)\b', spec, flags=re.IGNORECASE):
+        # QueryRejected is a ValueError, its message explains how to fix the query
+        return read_query(spec)
+    raise ValueError("expected a path to a csv file or a SELECT query")
+
+def _to_public_id(value: str) -> str | None:
+    # accept sample names as well as public ids
+    value = value.strip()
+    if PUBLIC_ID_PATTERN.match(value):
+        return value.upper()
+    match = re.match(r'^(MMRF_[0-9]+)_', value, flags=re.IGNORECASE)
+    return match.group(1).upper() if match else None
+
+def resolve_patients(spec: str | None) -> list[str] | None:
+    # input: one of
+    #   - empty string, None, or 'all' -> entire cohort, returns None
+    #   - path to a csv file with a public_id column (e.g. from execute_full_sql_query_with_python)
+    #   - a SELECT statement whose first column (or public_id column) contains public ids
+    #   - a comma-separated list of public ids e.g. MMRF_1014,MMRF_1017
+    # output: sorted list of unique public ids
+    if spec is None or spec.strip() == '' or spec.strip().lower() == 'all':
+        return None
+    spec = spec.strip()
+    if spec.lower().endswith('.csv') or re.match(r'^(SELECT|WITH)\b', spec, flags=re.IGNORECASE):
+        df = _read_table(spec)
+        values = df[_public_id_column(df)] if not df.empty else pd.Series(dtype='str')
+    else:
+        values = pd.Series(spec.split(','))
+
+    public_ids = {_to_public_id(value) for value in values.dropna().astype(str)} - {None}
+    if not public_ids:
+        raise ValueError("no valid public ids (e.g. MMRF_1014) found in patient subset")
+    return sorted(public_ids)
+
+def resolve_groups(spec: str) -> pd.Series:
+    # input: path to a csv file or a SELECT statement with a public_id column and a group column
+    #   the group column is the first column other than public_id
+    # output: group labels indexed by public id
+    df = _read_table(spec.strip())
+    if df.empty:
+        raise ValueError("grouping returned no rows")
+    id_col = _public_id_column(df)
+    group_cols = [col for col in df.columns if col != id_col]
+    if not group_cols:
+        raise ValueError("grouping needs a group column besides public_id")
+    public_ids = df[id_col].astype(str).map(_to_public_id)
+    groups = pd.Series(df[group_cols[0]].to_numpy(), index=public_ids.to_numpy(), name=group_cols[0])
+    groups = groups[groups.index.notna()]
+    return groups[~groups.index.duplicated(keep='first')]
+
+__all__ = [
+    "FIRST_VISIT_SAMPLE_PATTERN",
+    "first_visit_public_id",
+    "resolve_groups",
+    "resolve_patients",
+]
@@ -0,0 +1,173 @@
+import os
+import numpy as np
+import pandas as pd
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import norm
+
+from refdata import load_refdata
+
+COVARIATES = ['D_PT_age', 'D_PT_gender_Male', 'D_PT_iss_II', 'D_PT_iss_III']
+ENDPOINT_COLUMNS = {'os': ('oscdy', 'censos'), 'pfs': ('pfscdy', 'censpfs')}
+# same layout as the pre-computed refdata/cox_ph_*_genes.csv files
+RESULT_COLUMNS = ['Gene', 'coef', 'exp(coef)', 'se(coef)', 'coef lower 95%', 'coef upper 95%',
+                  'exp(coef) lower 95%', 'exp(coef) upper 95%', 'cmp to', 'z', 'p', '-log2(p)']
+CHUNK_SIZE = 256
+
+def load_covariates(endpoint: str) -> pd.DataFrame:
+    # age, sex, ISS and right-censored survival indexed by PUBLIC_ID, complete cases only
+    if endpoint not in ENDPOINT_COLUMNS:
+        raise ValueError('endpoint must be either "os" or "pfs"')
+    df = load_refdata(f'cox_ph_covariates_{endpoint}.csv')
+    return df.set_index('PUBLIC_ID').dropna()
+
+def _fit_chunk(z: np.ndarray, covariates: np.ndarray, time: np.ndarray, event: np.ndarray,
+               max_iter: int = 50, tol: float = 1e-9) -> tuple[np.ndarray, np.ndarray]:
+    # input: z-scored expression (G, N), shared covariates (N, P-1), times (N,) and events (N,)
+    # output: coefficient and standard error of the gene term for each of the G genes
+    # vectorised Newton-Raphson on the partial likelihood, one model per gene
+    order = np.argsort(time, kind='stable')
+    time, event = time[order], event[order].astype(bool)
+    G, N = z.shape
+    X = np.empty((G, covariates.shape[1] + 1, N))
+    X[:, 0] = z[:, order]
+    X[:, 1:] = (covariates[order] - covariates.mean(axis=0)).T
+    P = X.shape[1]
+
+    # features whose weighted risk-set sums give S0, S1 and the upper triangle of S2
+    iu, ju = np.triu_indices(P)
+    F = np.concatenate([np.ones((G, 1, N)), X, X[:, iu] * X[:, ju]], axis=1)
+    s1, s2 = slice(1, 1 + P), slice(1 + P, None)
+
+    # Efron's method for tied event times, as used by lifelines:
+    # the l-th of d tied events sees the risk set minus l/d of the tied events
+    first = np.searchsorted(time, time, side='left')[event]
+    last = np.searchsorted(time, time, side='right')[event]
+    n_events = np.concatenate([[0], np.cumsum(event)])
+    frac = (n_events[1:][event] - n_events[first] - 1) / (n_events[last] - n_events[first])
+    Xe = X[:, :, event].sum(axis=2)
+
+    beta = np.zeros((G, P))
+    beta_prev = np.zeros((G, P))
+    loglik_prev = np.full(G, -np.inf)
+    info = np.zeros((G, P, P))
+    done = np.zeros(G, dtype=bool)
+    active = np.arange(G)
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        eta = np.einsum('gpn,gp->gn', X[active], beta[active])
+        # partial likelihood is invariant to shifting all linear predictors
+        eta -= eta.max(axis=1, keepdims=True)
+        wF = F[active] * np.exp(eta)[:, None, :]
+        # risk-set sums from a cumulative sum over samples sorted by ascending time
+        cum = np.zeros(wF.shape[:2] + (N + 1,))
+        np.cumsum(wF, axis=2, out=cum[:, :, 1:])
+        S = cum[:, :, -1:] - cum[:, :, first]
+        np.cumsum(wF * event, axis=2, out=cum[:, :, 1:])
+        S -= frac * (cum[:, :, last] - cum[:, :, first])
+
+        S0 = S[:, 0]
+        mean = S[:, s1] / S0[:, None]
+        S2 = (S[:, s2] / S0[:, None]).sum(axis=2)
+        hessian = np.empty((active.size, P, P))
+        hessian[:, iu, ju] = S2
+        hessian[:, ju, iu] = S2
+        hessian -= np.einsum('gpe,gqe->gpq', mean, mean)
+        score = Xe[active] - mean.sum(axis=2)
+        loglik = (eta[:, event] - np.log(S0)).sum(axis=1)
+        try:
+            delta = np.linalg.solve(hessian, score[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            delta = np.einsum('gpq,gq->gp', np.linalg.pinv(hessian), score)
+
+        # halve the step for genes whose likelihood decreased
+        worse = loglik < loglik_prev[active] - 1e-10
+        better = ~worse
+        converged = better & (np.abs(delta).max(axis=1) < tol)
+
+        idx = active[worse]
+        beta[idx] = (beta_prev[idx] + beta[idx]) / 2
+
+        idx = active[converged]
+        info[idx] = hessian[converged]
+        done[idx] = True
+
+        step = better & ~converged
+        idx = active[step]
+        beta_prev[idx] = beta[idx]
+        loglik_prev[idx] = loglik[step]
+        beta[idx] = beta[idx] + delta[step]
+        active = active[~converged]
+
+    coef = np.full(G, np.nan)
+    se = np.full(G, np.nan)
+    if done.any():
+        with np.errstate(invalid='ignore'):
+            coef[done] = beta[done, 0]
+            se[done] = np.sqrt(np.linalg.pinv(info[done])[:, 0, 0])
+    return coef, se
+
+def _zscore(log2tpm: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # z-score each gene across samples; genes with missing or constant expression are dropped
+    x = log2tpm.astype(np.float64)
+    sd = x.std(axis=1, ddof=1)
+    keep = np.isfinite(x).all(axis=1) & (sd > 0)
+    x = x[keep]
+    return (x - x.mean(axis=1, keepdims=True)) / sd[keep, None], keep
+
+def coxph_genes(genes: np.ndarray, public_ids: np.ndarray, log2tpm: np.ndarray, endpoint: str,
+                workers: int | None = None) -> pd.DataFrame:
+    # input: gene ids (G,), public ids (N,), log2(tpm+1) matrix (G, N) and endpoint 'os' or 'pfs'
+    # output: one Cox PH regression per gene adjusted for age, sex and ISS, ordered by p value
+    covars = load_covariates(endpoint)
+    time_col, event_col = ENDPOINT_COLUMNS[endpoint]
+    in_cohort = pd.Index(public_ids).isin(covars.index)
+    covars = covars.loc[np.asarray(public_ids)[in_cohort]]
+    z, keep = _zscore(log2tpm[:, in_cohort])
+    genes = np.asarray(genes)[keep]
+
+    if covars[event_col].sum() == 0:
+        raise ValueError(f'no {endpoint} events in the selected patients')
+    args = (covars[COVARIATES].to_numpy(dtype=np.float64),
+            covars[time_col].to_numpy(dtype=np.float64),
+            covars[event_col].to_numpy(dtype=np.float64))
+    chunks = [z[i:i + CHUNK_SIZE] for i in range(0, len(z), CHUNK_SIZE)]
+
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(chunks) > 1:
+        # spawn rather than fork, as the server process runs threads
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=get_context('spawn')) as pool:
+            fits = list(pool.map(_fit_chunk, chunks, *[[a] * len(chunks) for a in args]))
+    else:
+        fits = [_fit_chunk(chunk, *args) for chunk in chunks]
+
+    coef = np.concatenate([fit[0] for fit in fits]) if fits else np.array([])
+    se = np.concatenate([fit[1] for fit in fits]) if fits else np.array([])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zval = coef / se
+        p = 2 * norm.sf(np.abs(zval))
+        df = pd.DataFrame({
+            'Gene': genes,
+            'coef': coef,
+            'exp(coef)': np.exp(coef),
+            'se(coef)': se,
+            'coef lower 95%': coef - norm.ppf(0.975) * se,
+            'coef upper 95%': coef + norm.ppf(0.975) * se,
+            'exp(coef) lower 95%': np.exp(coef - norm.ppf(0.975) * se),
+            'exp(coef) upper 95%': np.exp(coef + norm.ppf(0.975) * se),
+            'cmp to': 0.0,
+            'z': zval,
+            'p': p,
+            '-log2(p)': -np.log2(p),
+        }, columns=RESULT_COLUMNS)
+    df = df.dropna(subset=['coef', 'se(coef)']).sort_values('p').reset_index(drop=True)
+    df.attrs['n_patients'] = int(in_cohort.sum())
+    return df
+
+__all__ = [
+    "COVARIATES",
+    "RESULT_COLUMNS",
+    "coxph_genes",
+    "load_covariates",
+]
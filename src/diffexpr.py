@@ -0,0 +1,85 @@
+from collections.abc import Iterable
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm, rankdata
+from scipy.stats import t as t_dist
+
+from stats import CHUNK_SIZE, benjamini_hochberg
+
+# two-group tests applied to every gene at once, a block of genes at a time
+TESTS = ('welch', 'mannwhitney')
+
+def _welch_chunk(a: np.ndarray, b: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # input: blocks (g, n_a) and (g, n_b)
+    # output: Welch t statistic (g,) and two-sided p value (g,), NaN for genes without variance
+    n_a, n_b = a.shape[1], b.shape[1]
+    se2_a = a.var(axis=1, ddof=1, dtype=np.float64) / n_a
+    se2_b = b.var(axis=1, ddof=1, dtype=np.float64) / n_b
+    se2 = se2_a + se2_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = (a.mean(axis=1, dtype=np.float64) - b.mean(axis=1, dtype=np.float64)) / np.sqrt(se2)
+        # Welch-Satterthwaite degrees of freedom
+        df = se2 ** 2 / (se2_a ** 2 / (n_a - 1) + se2_b ** 2 / (n_b - 1))
+    return t, 2 * t_dist.sf(np.abs(t), df)
+
+def _mannwhitney_chunk(a: np.ndarray, b: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # input: blocks (g, n_a) and (g, n_b)
+    # output: U statistic of a (g,) and two-sided p value (g,) from the tie-corrected normal approximation
+    # with continuity correction, as scipy.stats.mannwhitneyu(method='asymptotic')
+    n_a, n_b = a.shape[1], b.shape[1]
+    n = n_a + n_b
+    ranks = rankdata(np.concatenate([a, b], axis=1), axis=1)
+    u = ranks[:, :n_a].sum(axis=1) - n_a * (n_a + 1) / 2
+    # sum of t^3 - t over tied groups, from the spread of the average ranks
+    ties = (n ** 3 - n) - 12 * ((ranks - (n + 1) / 2) ** 2).sum(axis=1)
+    sigma = np.sqrt(n_a * n_b / 12 * ((n + 1) - ties / (n * (n - 1))))
+    # genes with a single value in all samples cannot be tested
+    sigma[sigma == 0] = np.nan
+    z = (np.abs(u - n_a * n_b / 2) - 0.5) / sigma
+    return u, np.minimum(2 * norm.sf(z), 1)
+
+def differential_expression(blocks: Iterable[tuple[np.ndarray, np.ndarray]], case: np.ndarray, control: np.ndarray,
+                            test: str = 'welch', chunk_size: int = CHUNK_SIZE) -> pd.DataFrame:
+    # input: gene ids (g,) and log2(tpm+1) matrix (g, N) per block of genes, e.g. from iter_first_visit_log2tpm,
+    #   boolean masks (N,) of the case and control samples, test name
+    # output: gene, mean_case, mean_control, log2fc (case minus control), statistic, p, q ordered by p value
+    # genes with missing values or no variation get NaN p and q values and are ordered last
+    if test not in TESTS:
+        raise ValueError(f"test must be one of {', '.join(TESTS)}")
+    case, control = np.asarray(case, dtype=bool), np.asarray(control, dtype=bool)
+    if case.sum() < 2 or control.sum() < 2:
+        raise ValueError("each group needs at least 2 samples")
+    run_test = _welch_chunk if test == 'welch' else _mannwhitney_chunk
+    genes, mean_case, mean_control, statistic, p = [], [], [], [], []
+    for gene_ids, log2tpm in blocks:
+        genes.append(gene_ids)
+        for i in range(0, log2tpm.shape[0], chunk_size):
+            block = np.asarray(log2tpm[i:i + chunk_size], dtype=np.float32)
+            a, b = block[:, case], block[:, control]
+            mean_case.append(a.mean(axis=1))
+            mean_control.append(b.mean(axis=1))
+            block_statistic, block_p = run_test(a, b)
+            statistic.append(block_statistic)
+            p.append(block_p)
+    genes = np.concatenate(genes) if genes else np.array([], dtype=object)
+    mean_case = np.concatenate(mean_case) if mean_case else np.array([], dtype=np.float32)
+    mean_control = np.concatenate(mean_control) if mean_control else np.array([], dtype=np.float32)
+    statistic = np.concatenate(statistic) if statistic else np.array([])
+    p = np.concatenate(p) if p else np.array([])
+    df = pd.DataFrame({
+        'gene': genes,
+        'mean_case': mean_case,
+        'mean_control': mean_control,
+        # difference of mean log2(tpm+1), i.e. log2 fold change of the geometric means
+        'log2fc': mean_case - mean_control,
+        'statistic': statistic,
+        'p': p,
+    })
+    df['q'] = benjamini_hochberg(p)
+    return df.sort_values('p').reset_index(drop=True)
+
+__all__ = [
+    "TESTS",
+    "differential_expression",
+]
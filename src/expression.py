@@ -0,0 +1,354 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+import psycopg
+from abc import ABC, abstractmethod
+from collections.abc import Iterator
+from functools import lru_cache
+from psycopg import sql
+
+from cohort import first_visit_public_id
+from replicas import connect_read, run_read
+from stats import CHUNK_SIZE
+from variables import COMMPASS_DSN
+
+filedir = os.path.dirname(os.path.abspath(__file__))
+
+# the `expr` table holds TPM values with one row per gene and one column per sample
+EXPR_TABLE = 'expr'
+# local float32 copy of `expr`, one sub-directory per dataset version
+# override the version with EXPR_CACHE_VERSION, otherwise it is derived from the table layout and contents
+CACHE_DIR = os.path.join(filedir, 'cache', 'expr')
+EXPR_CACHE_VERSION = os.environ.get("EXPR_CACHE_VERSION")
+FETCH_SIZE = 2000
+# gene-indexed copy of `expr` in Postgres, one real[] of TPM values per gene,
+# with the sample of each array position in EXPR_SAMPLE_TABLE
+EXPR_ARRAY_TABLE = 'expr_by_gene'
+EXPR_SAMPLE_TABLE = 'expr_samples'
+# slices of at most this many genes are read from EXPR_ARRAY_TABLE when the local cache is not open
+ARRAY_READ_MAX_GENES = 500
+_cache_lock = threading.Lock()
+
+def _expr_columns(conn: psycopg.Connection) -> list[str]:
+    # column names of the expr table in their stored order
+    with conn.cursor() as curs:
+        curs.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position",
+            (EXPR_TABLE,),
+        )
+        return [row[0] for row in curs.fetchall()]
+
+def _dataset_version(conn: psycopg.Connection, columns: list[str]) -> str:
+    # fingerprint of the sample columns, the number of genes and the values in the expr table
+    # the row hashes are summed so the checksum needs one scan and no ordering; table statistics such as
+    # pg_stat_user_tables are not used, as they are reset on restart and not kept on replicas
+    with conn.cursor() as curs:
+        curs.execute(sql.SQL("SELECT count(*), coalesce(sum(hashtext(t::text)::bigint), 0) FROM {} AS t").format(
+            sql.Identifier(EXPR_TABLE)))
+        n_genes, checksum = curs.fetchone()
+    digest = hashlib.md5('\n'.join(columns + [str(n_genes), str(checksum)]).encode()).hexdigest()
+    return digest[:12]
+
+def build_expression_cache(version: str | None = None, force: bool = False) -> str:
+    # input: dataset version (defaults to EXPR_CACHE_VERSION or the table fingerprint), force rebuild
+    # output: path of the cache directory containing
+    #   matrix.f32   genes x samples float32 TPM values, row-major
+    #   genes.txt    one gene id per matrix row
+    #   samples.txt  one sample name per matrix column
+    #   meta.json    shape, dtype and source table
+    version = version or EXPR_CACHE_VERSION
+    if version and not force and os.path.exists(os.path.join(CACHE_DIR, version, 'meta.json')):
+        return os.path.join(CACHE_DIR, version)
+    # the export is a long read, keep it off the primary if there are replicas
+    with connect_read() as conn:
+        columns = _expr_columns(conn)
+        version = version or _dataset_version(conn, columns)
+        path = os.path.join(CACHE_DIR, version)
+        if os.path.exists(os.path.join(path, 'meta.json')) and not force:
+            return path
+
+        gene_col, samples = columns[0], columns[1:]
+        with conn.cursor() as curs:
+            curs.execute(sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(EXPR_TABLE)))
+            n_genes = curs.fetchone()[0]
+
+        # private build directory, a deploy-time build and the app may run at the same time
+        tmp = f'{path}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        matrix = np.memmap(os.path.join(tmp, 'matrix.f32'), dtype=np.float32, mode='w+', shape=(n_genes, len(samples)))
+        genes = []
+        # stream rows through a server-side cursor so the table is never held in memory
+        with conn.cursor(name='expr_cache') as curs:
+            curs.itersize = FETCH_SIZE
+            curs.execute(sql.SQL("SELECT * FROM {} ORDER BY {}").format(sql.Identifier(EXPR_TABLE), sql.Identifier(gene_col)))
+            while rows := curs.fetchmany(FETCH_SIZE):
+                block = pd.DataFrame(rows)
+                matrix[len(genes):len(genes) + len(block)] = block.iloc[:, 1:].to_numpy(dtype=np.float32, na_value=np.nan)
+                genes.extend(block.iloc[:, 0].astype(str))
+        matrix.flush()
+        del matrix
+
+        with open(os.path.join(tmp, 'genes.txt'), 'w') as f:
+            f.write('\n'.join(genes))
+        with open(os.path.join(tmp, 'samples.txt'), 'w') as f:
+            f.write('\n'.join(samples))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'table': EXPR_TABLE, 'version': version, 'values': 'tpm', 'dtype': 'float32',
+                       'shape': [len(genes), len(samples)]}, f)
+        if force or not os.path.exists(os.path.join(path, 'meta.json')):
+            shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another process finished the same version first
+            shutil.rmtree(tmp, ignore_errors=True)
+    return path
+
+def build_expression_arrays() -> int:
+    # input: none
+    # output: number of genes copied from the expr table into EXPR_ARRAY_TABLE
+    # the copy runs inside Postgres and replaces both tables in one transaction, so readers never see a partial table
+    with psycopg.connect(COMMPASS_DSN) as conn:
+        columns = _expr_columns(conn)
+        gene_col, samples = columns[0], columns[1:]
+        array_tmp, sample_tmp = f'{EXPR_ARRAY_TABLE}_tmp', f'{EXPR_SAMPLE_TABLE}_tmp'
+        with conn.cursor() as curs:
+            curs.execute(sql.SQL("DROP TABLE IF EXISTS {}, {}").format(sql.Identifier(array_tmp), sql.Identifier(sample_tmp)))
+            curs.execute(sql.SQL("CREATE TABLE {} AS SELECT {}::text AS gene_id, ARRAY[{}]::real[] AS tpm FROM {}").format(
+                sql.Identifier(array_tmp),
+                sql.Identifier(gene_col),
+                sql.SQL(', ').join(sql.Identifier(sample) for sample in samples),
+                sql.Identifier(EXPR_TABLE),
+            ))
+            n_genes = curs.rowcount
+            curs.execute(sql.SQL("CREATE INDEX ON {} (gene_id)").format(sql.Identifier(array_tmp)))
+            curs.execute(sql.SQL("CREATE TABLE {} (position int PRIMARY KEY, sample text NOT NULL)").format(sql.Identifier(sample_tmp)))
+            curs.executemany(sql.SQL("INSERT INTO {} VALUES (%s, %s)").format(sql.Identifier(sample_tmp)),
+                             list(enumerate(samples, start=1)))
+            for table, tmp in ((EXPR_ARRAY_TABLE, array_tmp), (EXPR_SAMPLE_TABLE, sample_tmp)):
+                curs.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+                curs.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(tmp), sql.Identifier(table)))
+            curs.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(EXPR_ARRAY_TABLE)))
+    return n_genes
+
+def _log2p1(values: np.ndarray) -> np.ndarray:
+    # log2(tpm+1) in place, views of the read-only memmap are copied first
+    if not values.flags.writeable:
+        values = values.copy()
+    np.add(values, 1, out=values)
+    np.log2(values, out=values)
+    return values
+
+class _ExpressionSource(ABC):
+    # methods shared by the local matrix cache and the array table
+    samples: np.ndarray
+
+    def first_visit_samples(self) -> list[str]:
+        # first-visit BM CD138+ samples, one per patient
+        return [sample for sample in self.samples if first_visit_public_id(sample)]
+
+    @abstractmethod
+    def slice(self, genes: list[str] | None = None, samples: list[str] | None = None,
+              log2: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # input: gene ids and sample names (None for all), whether to return log2(tpm+1)
+        # output: gene ids (G,), sample names (N,), float32 matrix (G, N)
+        ...
+
+    def iter_slices(self, genes: list[str] | None = None, samples: list[str] | None = None, log2: bool = False,
+                    chunk_size: int = CHUNK_SIZE) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        # input: as slice, and the number of genes per block
+        # output: gene ids (g,) and float32 matrix (g, N) per block of genes, in the sample order of slice
+        # sources that only serve small slices return them as a single block
+        gene_ids, _, values = self.slice(genes, samples, log2)
+        yield gene_ids, values
+
+    def to_frame(self, genes: list[str] | None = None, samples: list[str] | None = None,
+                 log2: bool = False) -> pd.DataFrame:
+        # genes x samples data frame of the requested slice
+        gene_ids, sample_names, values = self.slice(genes, samples, log2)
+        return pd.DataFrame(values, index=pd.Index(gene_ids, name='gene'), columns=sample_names)
+
+class ExpressionMatrix(_ExpressionSource):
+    # read-only view of a cached expression matrix
+    # genes and samples can be sliced by id without touching Postgres, e.g.
+    #   m = open_expression_matrix()
+    #   df = m.to_frame(genes=['ENSG00000109685'], samples=m.first_visit_samples(), log2=True)
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, 'genes.txt')) as f:
+            self.genes = np.array(f.read().split('\n'))
+        with open(os.path.join(path, 'samples.txt')) as f:
+            self.samples = np.array(f.read().split('\n'))
+        self.values = np.memmap(os.path.join(path, 'matrix.f32'), dtype=np.float32, mode='r', shape=tuple(self.meta['shape']))
+        self._gene_index = pd.Index(self.genes)
+        self._sample_index = pd.Index(self.samples)
+
+    @property
+    def version(self) -> str:
+        return self.meta['version']
+
+    def gene_positions(self, genes: list[str]) -> np.ndarray:
+        # row numbers of the given gene ids, unknown ids are skipped
+        idx = self._gene_index.get_indexer(genes)
+        return idx[idx >= 0]
+
+    def sample_positions(self, samples: list[str]) -> np.ndarray:
+        # column numbers of the given sample names, unknown names are skipped
+        idx = self._sample_index.get_indexer(samples)
+        return idx[idx >= 0]
+
+    def slice(self, genes: list[str] | None = None, samples: list[str] | None = None,
+              log2: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # input: gene ids and sample names (None for all), whether to return log2(tpm+1)
+        # output: gene ids (G,), sample names (N,), float32 matrix (G, N)
+        rows = self.gene_positions(genes) if genes is not None else slice(None)
+        cols = self.sample_positions(samples) if samples is not None else slice(None)
+        if isinstance(rows, np.ndarray) and isinstance(cols, np.ndarray):
+            values = np.asarray(self.values[np.ix_(rows, cols)])
+        else:
+            values = np.asarray(self.values[rows, cols])
+        if log2:
+            # a single copy of the slice, transformed in place
+            values = _log2p1(values)
+        return self.genes[rows], self.samples[cols], values
+
+    def iter_slices(self, genes: list[str] | None = None, samples: list[str] | None = None, log2: bool = False,
+                    chunk_size: int = CHUNK_SIZE) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        # only one block of genes is copied out of the memmap at a time
+        rows = self.gene_positions(genes) if genes is not None else np.arange(len(self.genes))
+        cols = self.sample_positions(samples) if samples is not None else slice(None)
+        for start in range(0, len(rows), chunk_size):
+            block = rows[start:start + chunk_size]
+            if genes is None:
+                # consecutive rows are a view of the memmap, the column selection copies the block
+                values = np.asarray(self.values[block[0]:block[-1] + 1][:, cols])
+            else:
+                values = np.asarray(self.values[block][:, cols])
+            yield self.genes[block], _log2p1(values) if log2 else values
+
+class ExpressionArrays(_ExpressionSource):
+    # read-only view of EXPR_ARRAY_TABLE with the same slicing interface as ExpressionMatrix
+    # only the requested genes are fetched, and only the requested array positions leave the server
+    def __init__(self):
+        def run(conn: psycopg.Connection) -> list[str]:
+            with conn.cursor() as curs:
+                curs.execute(sql.SQL("SELECT sample FROM {} ORDER BY position").format(sql.Identifier(EXPR_SAMPLE_TABLE)))
+                return [row[0] for row in curs.fetchall()]
+        self.samples = np.array(run_read(run))
+        self._sample_index = pd.Index(self.samples)
+
+    def sample_positions(self, samples: list[str]) -> np.ndarray:
+        # column numbers of the given sample names, unknown names are skipped
+        idx = self._sample_index.get_indexer(samples)
+        return idx[idx >= 0]
+
+    def slice(self, genes: list[str] | None = None, samples: list[str] | None = None,
+              log2: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # input: gene ids and sample names (None for all), whether to return log2(tpm+1)
+        # output: gene ids (G,), sample names (N,), float32 matrix (G, N), genes in the requested order
+        cols = self.sample_positions(samples) if samples is not None else np.arange(len(self.samples))
+        values = sql.SQL("tpm") if samples is None else sql.SQL(
+            "(SELECT array_agg(tpm[i] ORDER BY n) FROM unnest(%(positions)s::int[]) WITH ORDINALITY AS s(i, n))")
+        query = sql.SQL("SELECT gene_id, {} FROM {}").format(values, sql.Identifier(EXPR_ARRAY_TABLE))
+        if genes is not None:
+            query += sql.SQL(" WHERE gene_id = ANY(%(genes)s)")
+        params = {'positions': (cols + 1).tolist(), 'genes': list(genes or [])}
+
+        def run(conn: psycopg.Connection) -> dict[str, list]:
+            rows = {}
+            with conn.cursor(name='expr_slice') as curs:
+                curs.itersize = FETCH_SIZE
+                curs.execute(query, params)
+                for gene, tpm in curs:
+                    rows[gene] = tpm
+            return rows
+
+        rows = run_read(run)
+        gene_ids = [gene for gene in dict.fromkeys(genes) if gene in rows] if genes is not None else sorted(rows)
+        matrix = np.full((len(gene_ids), len(cols)), np.nan, dtype=np.float32)
+        for i, gene in enumerate(gene_ids):
+            if rows[gene]:
+                matrix[i] = np.array(rows[gene], dtype=np.float32)
+        if log2:
+            matrix = _log2p1(matrix)
+        return np.array(gene_ids, dtype=str), self.samples[cols], matrix
+
+@lru_cache(maxsize=4)
+def open_expression_matrix(version: str | None = None) -> ExpressionMatrix:
+    # open the cached expression matrix, building it from the expr table if needed
+    with _cache_lock:
+        path = build_expression_cache(version)
+    return ExpressionMatrix(path)
+
+@lru_cache(maxsize=1)
+def open_expression_arrays() -> ExpressionArrays:
+    return ExpressionArrays()
+
+def open_expression_store(genes: list[str] | None = None) -> _ExpressionSource:
+    # input: gene ids that will be sliced, or None for all
+    # output: the local matrix cache if it is open, pinned and built, or the slice covers many genes,
+    #   otherwise the array table, so that looking up a few genes does not export the whole expr table
+    pinned = EXPR_CACHE_VERSION and os.path.exists(os.path.join(CACHE_DIR, EXPR_CACHE_VERSION, 'meta.json'))
+    if open_expression_matrix.cache_info().currsize or pinned or genes is None or len(genes) > ARRAY_READ_MAX_GENES:
+        return open_expression_matrix()
+    try:
+        return open_expression_arrays()
+    except psycopg.errors.UndefinedTable:
+        # array table not built yet
+        return open_expression_matrix()
+
+def _first_visit_samples(matrix: _ExpressionSource, public_ids: list[str] | None) -> list[str]:
+    samples = matrix.first_visit_samples()
+    if public_ids is not None:
+        wanted = set(public_ids)
+        samples = [sample for sample in samples if first_visit_public_id(sample) in wanted]
+    return samples
+
+def load_first_visit_log2tpm(public_ids: list[str] | None = None,
+                             genes: list[str] | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # input: list of public ids and list of gene ids, or None for all
+    # output: gene ids (G,), public ids (N,), float32 log2(tpm+1) matrix (G, N) of first-visit BM CD138+ samples
+    matrix = open_expression_store(genes)
+    genes, samples, log2tpm = matrix.slice(genes=genes, samples=_first_visit_samples(matrix, public_ids), log2=True)
+    return genes, np.array([first_visit_public_id(sample) for sample in samples], dtype=object), log2tpm
+
+def iter_first_visit_log2tpm(public_ids: list[str] | None = None, genes: list[str] | None = None,
+                             chunk_size: int = CHUNK_SIZE) -> tuple[np.ndarray, Iterator[tuple[np.ndarray, np.ndarray]]]:
+    # as load_first_visit_log2tpm, for consumers that process a block of genes at a time within bounded memory
+    # output: public ids (N,), and an iterator of gene ids (g,) and float32 log2(tpm+1) matrix (g, N) per block,
+    #   blocks are read when the iterator reaches them
+    matrix = open_expression_store(genes)
+    samples = _first_visit_samples(matrix, public_ids)
+    public_ids = np.array([first_visit_public_id(sample) for sample in samples], dtype=object)
+    return public_ids, matrix.iter_slices(genes=genes, samples=samples, log2=True, chunk_size=chunk_size)
+
+if __name__ == "__main__":
+    # build or refresh the cache ahead of time e.g. at deployment
+    # usage: python expression.py [--force] [--arrays]
+    import sys
+    if '--arrays' in sys.argv[1:]:
+        print(f"{build_expression_arrays()} genes copied to {EXPR_ARRAY_TABLE}")
+    else:
+        print(build_expression_cache(force='--force' in sys.argv[1:]))
+
+__all__ = [
+    "EXPR_ARRAY_TABLE",
+    "EXPR_SAMPLE_TABLE",
+    "EXPR_TABLE",
+    "ExpressionArrays",
+    "ExpressionMatrix",
+    "build_expression_arrays",
+    "build_expression_cache",
+    "iter_first_visit_log2tpm",
+    "load_first_visit_log2tpm",
+    "open_expression_arrays",
+    "open_expression_matrix",
+    "open_expression_store",
+]
@@ -0,0 +1,64 @@
+import re
+
+from tools import ConvertGeneTool, GeneMetadataTool, RetrieveGeneListTool
+
+# short lookup questions answered straight from a tool, without the agent loop
+# patterns match the whole question, so anything longer or more specific goes to the agent
+
+_ID_WORDS = r"(?:ensembl|gencode|ensg)(?:\s+gene)?(?:\s+(?:stable\s+)?(?:id|accession))?"
+_GENE = r"(?P<gene>[A-Za-z0-9][A-Za-z0-9\-\.]*)"
+
+GENE_ID_PATTERNS = [
+    # what is the Ensembl ID of NSD2
+    re.compile(rf"^(?:what(?:'s|\s+is)\s+)?(?:the\s+)?{_ID_WORDS}\s+(?:of|for)\s+(?:the\s+)?(?:gene\s+)?{_GENE}(?:\s+gene)?$", re.IGNORECASE),
+    # convert NSD2 to Ensembl ID
+    re.compile(rf"^convert\s+(?:the\s+)?(?:gene\s+)?{_GENE}(?:\s+gene)?\s+(?:to|into)\s+(?:an?\s+|the\s+)?{_ID_WORDS}$", re.IGNORECASE),
+]
+
+GENE_METADATA_PATTERNS = [
+    # metadata of ENSG00000109685
+    re.compile(r"^(?:(?:show|give|get|retrieve)(?:\s+me)?\s+|what(?:'s|\s+is|\s+are)\s+)?(?:the\s+)?(?:gene\s+)?(?:metadata|annotation|info(?:rmation)?|details)\s+(?:of|for|about|on)\s+(?:gene\s+)?(?P<gene>ENSG[0-9]+)(?:\.[0-9]+)?$", re.IGNORECASE),
+]
+
+GENE_LIST_PATTERNS = [
+    # give me the housekeeping gene list
+    re.compile(r"^(?:(?:show|give|get|retrieve)(?:\s+me)?\s+|what\s+(?:is|are)\s+)?(?:the\s+)?(?:list\s+of\s+)?(?P<kind>housekeeping|immunoglobulin|protein[\s\-]?coding)\s+genes?(?:\s+list)?$", re.IGNORECASE),
+]
+
+_convert_gene_tool = ConvertGeneTool()
+_gene_metadata_tool = GeneMetadataTool()
+_gene_list_tool = RetrieveGeneListTool()
+
+def _match(patterns: list[re.Pattern], question: str) -> re.Match | None:
+    for pattern in patterns:
+        match = pattern.match(question)
+        if match:
+            return match
+    return None
+
+def answer_directly(user_input: str) -> str | None:
+    # answer of a simple lookup question, or None to fall back to the agent
+    # tool errors also fall back, the agent can handle misspelt or ambiguous names
+    question = re.sub(r"\s+", " ", user_input).strip().rstrip("?.!").strip()
+    if len(question) > 120:
+        return None
+
+    match = _match(GENE_ID_PATTERNS, question)
+    if match:
+        gene_id = _convert_gene_tool._run(match.group("gene"))
+        return None if gene_id.startswith("Error") else f"The Ensembl gene ID of {match.group('gene')} is {gene_id}."
+
+    match = _match(GENE_METADATA_PATTERNS, question)
+    if match:
+        metadata = _gene_metadata_tool._run(match.group("gene").upper())
+        return None if metadata.startswith("Error") else metadata.replace("\n", "<br>")
+
+    match = _match(GENE_LIST_PATTERNS, question)
+    if match:
+        kind = re.sub(r"[\s\-]", "", match.group("kind").lower())
+        path = _gene_list_tool._run(kind)
+        return None if path.startswith("Error") else path
+
+    return None
+
+__all__ = ["answer_directly"]
@@ -1,4 +1,84 @@
+import time
+import logging
+import threading
 from langchain.chat_models.base import BaseChatModel
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.rate_limiters import InMemoryRateLimiter
+
+from variables import LLM_RATE_LIMITS
+
+# one limiter per provider, shared by every chat model of that provider in this process
+_rate_limiters = {}
+# one chat model per MODEL_ID, so that its HTTP client and keep-alive connections are reused across logins
+_chat_models = {}
+_chat_models_lock = threading.Lock()
+
+def model_provider(MODEL_ID: str) -> str:
+    # provider name used for rate limiting, as in LLM_RATE_LIMITS
+    if MODEL_ID.startswith("gpt-"):
+        return "openai"
+    elif MODEL_ID.startswith("claude"):
+        return "anthropic"
+    elif MODEL_ID.startswith("gemini"):
+        return "google"
+    return "bedrock"
+
+def provider_rate_limiter(provider: str) -> InMemoryRateLimiter | None:
+    if provider not in LLM_RATE_LIMITS:
+        return None
+    if provider not in _rate_limiters:
+        rate = LLM_RATE_LIMITS[provider]
+        # allow short bursts of up to one second worth of requests
+        _rate_limiters[provider] = InMemoryRateLimiter(requests_per_second=rate, check_every_n_seconds=0.1, max_bucket_size=max(1, rate))
+    return _rate_limiters[provider]
+
+class LatencyTracker(BaseCallbackHandler):
+    # wall time of each chat model call, aggregated per provider
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = {}  # run_id -> (provider, start time)
+        self.stats = {}  # provider -> {"calls", "errors", "total_s", "max_s", "last_s"}
+
+    def start(self, provider: str, run_id) -> None:
+        with self.lock:
+            self.started[run_id] = (provider, time.perf_counter())
+
+    def end(self, run_id, error: bool = False) -> None:
+        with self.lock:
+            if run_id not in self.started:
+                return
+            provider, start = self.started.pop(run_id)
+            elapsed = time.perf_counter() - start
+            stats = self.stats.setdefault(provider, {"calls": 0, "errors": 0, "total_s": 0., "max_s": 0., "last_s": 0.})
+            stats["calls"] += 1
+            stats["errors"] += int(error)
+            stats["total_s"] += elapsed
+            stats["max_s"] = max(stats["max_s"], elapsed)
+            stats["last_s"] = elapsed
+
+    def report(self) -> dict:
+        with self.lock:
+            return {provider: dict(stats, mean_s=stats["total_s"] / stats["calls"]) for provider, stats in self.stats.items()}
+
+latency_tracker = LatencyTracker()
+
+class _ProviderLatencyCallback(BaseCallbackHandler):
+    # forwards the calls of one chat model to latency_tracker under its provider name
+    def __init__(self, provider: str):
+        self.provider = provider
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        latency_tracker.start(self.provider, run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        latency_tracker.start(self.provider, run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        latency_tracker.end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        latency_tracker.end(run_id, error=True)
 
 def universal_chat_model(MODEL_ID: str) -> BaseChatModel:
     MAX_TOKENS = 20000
@@ -16,6 +96,9 @@ def universal_chat_model(MODEL_ID: str) -> BaseChatModel:
     else:
         f"Defaulting to Bedrock as {MODEL_ID} does not match known providers"
         from langchain_aws import ChatBedrockConverse as ChatModel
+
+    rate_limiter = provider_rate_limiter(model_provider(MODEL_ID))
+    callbacks = [_ProviderLatencyCallback(model_provider(MODEL_ID))]
     
     try:
         # Google, Claude, OpenAI use "model" parameter
@@ -23,6 +106,8 @@ def universal_chat_model(MODEL_ID: str) -> BaseChatModel:
             model=MODEL_ID,
             temperature=0.,
             max_tokens=MAX_TOKENS,
+            rate_limiter=rate_limiter,
+            callbacks=callbacks,
         )
     except Exception as e:
         # AWS Bedrock uses "MODEL_ID" parameter
@@ -31,10 +116,86 @@ def universal_chat_model(MODEL_ID: str) -> BaseChatModel:
                 MODEL_ID=MODEL_ID,
                 temperature=0.,
                 max_tokens=MAX_TOKENS,
+                rate_limiter=rate_limiter,
+                callbacks=callbacks,
             )
         except Exception as e:
             raise ValueError(f"Failed to initialize chat model with MODEL_ID {MODEL_ID}: {e}")
     
     return llm
 
-__all__ = ["universal_chat_model"]
\ No newline at end of file
+def supports_cache_breakpoints(MODEL_ID: str) -> bool:
+    # Anthropic and Claude on Bedrock only cache up to explicit breakpoints
+    # OpenAI and Gemini cache repeated prefixes automatically
+    provider = model_provider(MODEL_ID)
+    return provider == "anthropic" or (provider == "bedrock" and "claude" in MODEL_ID.lower())
+
+def _with_cache_breakpoint(message: BaseMessage, MODEL_ID: str) -> BaseMessage:
+    content = message.content
+    blocks = [{"type": "text", "text": content}] if isinstance(content, str) else list(content)
+    if model_provider(MODEL_ID) == "anthropic":
+        blocks[-1] = dict(blocks[-1], cache_control={"type": "ephemeral"})
+    else:
+        from langchain_aws import ChatBedrockConverse
+        blocks.append(ChatBedrockConverse.create_cache_point())
+    return message.model_copy(update={"content": blocks})
+
+def cacheable_messages(messages: list[BaseMessage], MODEL_ID: str | None = None) -> list[BaseMessage]:
+    # order the request so that its prefix is identical from step to step:
+    # tools (bound to the model), then the system prompt, then the conversation in order
+    # threads hold one system message per login, only the latest is sent
+    system = [msg for msg in messages if isinstance(msg, SystemMessage)]
+    messages = system[-1:] + [msg for msg in messages if not isinstance(msg, SystemMessage)]
+    if MODEL_ID is None or not supports_cache_breakpoints(MODEL_ID):
+        return messages
+    # breakpoints after the system prompt (covers the tool schemas too) and after the latest message with content
+    # Anthropic rejects cache_control on empty text, e.g. AIMessages that only call tools
+    positions = {i for i, msg in enumerate(messages) if msg.content}
+    breakpoints = {0 if system else None, max(positions, default=None)} - {None}
+    return [_with_cache_breakpoint(msg, MODEL_ID) if i in breakpoints else msg for i, msg in enumerate(messages)]
+
+def cacheable_prompt(MODEL_ID: str | None = None):
+    # prompt for create_react_agent, see cacheable_messages
+    return lambda state: cacheable_messages(state["messages"], MODEL_ID)
+
+def get_chat_model(MODEL_ID: str) -> BaseChatModel:
+    # process-wide registry of chat models, created on first use
+    with _chat_models_lock:
+        if MODEL_ID not in _chat_models:
+            _chat_models[MODEL_ID] = universal_chat_model(MODEL_ID)
+        return _chat_models[MODEL_ID]
+
+async def prewarm_chat_model(MODEL_ID: str) -> None:
+    # open the TLS connection of the shared client at startup, so the first login does not pay for it
+    # uses the free model lookup endpoint of the provider's async client, which shares the connection pool of
+    # chat requests; no completion is billed and the latency stats and rate limiter are left alone
+    # errors are only logged, the model is still usable and will connect on first use
+    start = time.perf_counter()
+    try:
+        model = get_chat_model(MODEL_ID)
+        provider = model_provider(MODEL_ID)
+        if provider == "openai":
+            await model.root_async_client.models.retrieve(MODEL_ID)
+        elif provider == "anthropic":
+            await model._async_client.models.retrieve(MODEL_ID)
+        else:
+            # the google and bedrock clients have no lookup on the connection used for chat requests
+            return
+        logging.info(f"Prewarmed {MODEL_ID} in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        logging.warning(f"Prewarming {MODEL_ID} failed: {e}")
+
+def latency_stats() -> dict:
+    return latency_tracker.report()
+
+__all__ = [
+    "cacheable_messages",
+    "cacheable_prompt",
+    "get_chat_model",
+    "latency_stats",
+    "model_provider",
+    "prewarm_chat_model",
+    "provider_rate_limiter",
+    "supports_cache_breakpoints",
+    "universal_chat_model",
+]
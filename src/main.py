@@ -1,35 +1,83 @@
 import os
 import psycopg
 import asyncio
+import logging
 from typing import Annotated
 from contextlib import asynccontextmanager
 from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
 from fastapi import Depends, FastAPI, Request, HTTPException, status
-from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, HTMLResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, HTMLResponse, RedirectResponse
 
 # src modules
-from agent import handle_invalid_chat_history, send_init_prompt, query_agent
+from agent import answer_fast_path, current_thread, get_thread_messages, handle_invalid_chat_history, repair_thread, send_init_prompt, switch_thread, query_agent
+from artifacts import artifact_usage, collect_artifacts, setup_artifacts_table
+from llm_utils import latency_stats, prewarm_chat_model
 from mail import send_verification_email
+from memory import compact_all, compact_thread, storage_report
 from models import Token, TokenData, Query, UserCreate, UserInDB
+from plots import arender_full, prewarm_plot_pool
+from replicas import replica_status
+from router import route_report
+from scheduler import RunScheduler
 from security import get_password_hash, authenticate_user, create_bearer_token, validate_token_str, validate_headers
 from serialize import generate_verification_token, confirm_verification_token
-from variables import COMMPASS_AUTH_DSN, COMMPASS_DSN, COMMPASS_MEMORY_DB_URI, MODEL_ID
+from staticfiles import CachedStaticFiles
+from threads import create_thread, delete_threads, get_thread, list_threads, setup_threads_table, touch_thread, user_thread_ids
+from variables import ARTIFACT_GC_INTERVAL, CHECKPOINT_COMPACTION_INTERVAL, COMMPASS_AUTH_DSN, COMMPASS_DSN, COMMPASS_MEMORY_DB_URI, MODEL_ID
+
+# periodically trim old checkpoints so that checkpoint reads stay fast as accounts age
+async def compact_checkpoints_periodically() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(compact_all)
+        except Exception as e:
+            logging.warning(f"Checkpoint compaction failed: {e}")
+        await asyncio.sleep(CHECKPOINT_COMPACTION_INTERVAL)
+
+# periodically delete result and graph files that have not been used for ARTIFACT_TTL_DAYS
+async def collect_artifacts_periodically() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(collect_artifacts)
+        except Exception as e:
+            logging.warning(f"Artifact collection failed: {e}")
+        await asyncio.sleep(ARTIFACT_GC_INTERVAL)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     async with AsyncPostgresSaver.from_conn_string(COMMPASS_MEMORY_DB_URI) as checkpointer:
         await checkpointer.setup()
+        setup_threads_table()
+        setup_artifacts_table()
         app.state.checkpointer = checkpointer
+        compaction_task = asyncio.create_task(compact_checkpoints_periodically())
+        artifact_task = asyncio.create_task(collect_artifacts_periodically())
+        asyncio.create_task(prewarm_chat_model(MODEL_ID))
+        asyncio.create_task(asyncio.to_thread(prewarm_plot_pool))
         yield
+        compaction_task.cancel()
+        artifact_task.cancel()
 
 app = FastAPI(lifespan=lifespan)
 
+# caps concurrent agent runs globally and per user
+scheduler = RunScheduler()
+
+# conversation thread the user's turns go to, their most recently used one after a restart
+def user_thread(username: str) -> str:
+    if (thread_id := current_thread(username)) is None:
+        thread_id = list_threads(username)[0]["thread_id"]
+        switch_thread(app, thread_id, username)
+    return thread_id
+
 # update FastAPI app state with user info and model IDs
 def update_app_state(user: UserInDB) -> None:
     global app
     # user must be verified to exist by now
+    # resume the most recently used conversation thread of a newly logged in user
+    if getattr(app.state, "username", None) != user.username or not hasattr(app.state, "thread_id"):
+        switch_thread(app, user_thread(user.username), user.username)
     app.state.username = user.username
     app.state.email = user.email
     app.state.model_id = MODEL_ID
@@ -46,12 +94,13 @@ result_folder = os.path.join(app_dir, 'result')
 os.makedirs(result_folder, exist_ok=True)
 refdata_dir = os.path.join(app_dir, '..', 'refdata')
 
-app.mount("/result", StaticFiles(directory=result_folder), name="result") # serve csv files
-app.mount("/graph", StaticFiles(directory=graph_folder), name="graph") # serve plotted graphs
-app.mount("/static", StaticFiles(directory=static_dir), name="static") # serve css/image files
-app.mount("/scripts", StaticFiles(directory=scripts_dir), name="scripts") # serve js files
-app.mount("/templates", StaticFiles(directory=templates_dir), name="templates") # serve html files
-app.mount("/refdata", StaticFiles(directory=refdata_dir), name="refdata") # serve reference data files
+# assets are revalidated with their ETag, content-addressed artifacts are cached for good
+app.mount("/result", CachedStaticFiles(directory=result_folder), name="result") # serve csv files
+app.mount("/graph", CachedStaticFiles(directory=graph_folder), name="graph") # serve plotted graphs
+app.mount("/static", CachedStaticFiles(directory=static_dir), name="static") # serve css/image files
+app.mount("/scripts", CachedStaticFiles(directory=scripts_dir), name="scripts") # serve js files
+app.mount("/templates", CachedStaticFiles(directory=templates_dir), name="templates") # serve html files
+app.mount("/refdata", CachedStaticFiles(directory=refdata_dir, cache_control="public, max-age=86400"), name="refdata") # serve reference data files
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
@@ -226,19 +275,124 @@ async def erase_memory(token_str: Annotated[str, Depends(oauth2_scheme)], reques
     
     user = validate_token_str(token_str)
 
+    # remove all conversation threads of the user
+    delete_threads(user.username)
+    switch_thread(app, list_threads(user.username)[0]["thread_id"], user.username)
+    return JSONResponse({"message": "🗑️ Memory of previous conversations erased. Refresh page for changes to take effect."})
+
+
+# triggered by loading the app page or creating, switching or deleting a thread
+@app.get("/api/threads")
+async def get_threads(token_str: Annotated[str, Depends(oauth2_scheme)], request: Request) -> JSONResponse:
+    validate_headers(request)
+
+    user = validate_token_str(token_str)
+
+    return JSONResponse({"threads": list_threads(user.username), "current": user_thread(user.username)})
+
+
+# triggered by clicking new conversation button
+@app.post("/api/threads")
+async def new_thread(token_str: Annotated[str, Depends(oauth2_scheme)], request: Request) -> JSONResponse:
+    validate_headers(request)
+
+    user = validate_token_str(token_str)
+    update_app_state(user)
+
+    thread = create_thread(user.username)
+    switch_thread(app, thread["thread_id"], user.username)
+    return JSONResponse({"thread": thread, "messages": [], "status": "ok"})
+
+
+# triggered by clicking a thread in the sidebar
+@app.post("/api/threads/{thread_id}/switch")
+async def select_thread(thread_id: str, token_str: Annotated[str, Depends(oauth2_scheme)], request: Request) -> JSONResponse:
+    validate_headers(request)
+
+    user = validate_token_str(token_str)
+    update_app_state(user)
+
+    # raises 404 if the thread does not belong to the user
+    thread = get_thread(user.username, thread_id)
+    switch_thread(app, thread_id, user.username)
+    touch_thread(thread_id)
+
+    try:
+        messages = await get_thread_messages(app, thread_id)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to load thread. Error: " + str(e))
+    return JSONResponse({"thread": thread, "messages": messages, "status": "ok"})
+
+
+# triggered by clicking the delete button of a thread in the sidebar
+@app.delete("/api/threads/{thread_id}")
+async def remove_thread(thread_id: str, token_str: Annotated[str, Depends(oauth2_scheme)], request: Request) -> JSONResponse:
+    validate_headers(request)
+
+    user = validate_token_str(token_str)
+    update_app_state(user)
+
+    get_thread(user.username, thread_id)
+    delete_threads(user.username, [thread_id])
+    if current_thread(user.username) == thread_id:
+        switch_thread(app, list_threads(user.username)[0]["thread_id"], user.username)
+    return JSONResponse({"current": user_thread(user.username), "status": "ok"})
+
+
+# triggered by clicking compact memory button
+# this keeps only the latest checkpoints of the conversation history
+@app.post("/api/compact_memory")
+async def compact_memory(token_str: Annotated[str, Depends(oauth2_scheme)], request: Request) -> JSONResponse:
+    validate_headers(request)
+
+    user = validate_token_str(token_str)
+
     with psycopg.connect(COMMPASS_MEMORY_DB_URI) as conn:
         with conn.cursor() as cur:
             try:
-                cur.execute("DELETE FROM checkpoints.checkpoints WHERE thread_id = %s", (user.username,))
-                cur.execute("DELETE FROM checkpoints.checkpoint_writes WHERE thread_id = %s", (user.username,))
-                cur.execute("DELETE FROM checkpoints.checkpoint_blobs WHERE thread_id = %s", (user.username,))
+                deleted = {}
+                for thread_id in user_thread_ids(user.username):
+                    for key, value in compact_thread(cur, thread_id).items():
+                        deleted[key] = deleted.get(key, 0) + value
                 conn.commit()
             except Exception as e_memorydb:
                 conn.rollback()
-                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to erase memory. Error: " + str(e_memorydb))
-    return JSONResponse({"message": "🗑️ Memory of previous conversations erased. Refresh page for changes to take effect."})
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to compact memory. Error: " + str(e_memorydb))
+    return JSONResponse({"deleted": deleted, "storage": storage_report(user_thread_ids(user.username)), "status": "ok"})
+
+
+# full resolution image of a plot previewed in the chat, rendered on first request
+# opened as a plain link, so the token comes from the cookie set by /app
+@app.get("/api/plot_full")
+async def plot_full(preview: str, request: Request, format: str = "png") -> RedirectResponse:
+    validate_headers(request)
+
+    token_str = request.cookies.get("access_token")
+    if not token_str:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+    user = validate_token_str(token_str)
+
+    try:
+        path = await arender_full(user.username, preview, format)
+    except (FileNotFoundError, ValueError) as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    return RedirectResponse(f"/{path}")
 
 
+# storage used by the conversation history of the user
+@app.get("/api/memory_usage")
+async def memory_usage(token_str: Annotated[str, Depends(oauth2_scheme)], request: Request) -> JSONResponse:
+    validate_headers(request)
+
+    user = validate_token_str(token_str)
+
+    try:
+        report = storage_report(user_thread_ids(user.username))
+        artifacts = artifact_usage(user.username)
+    except Exception as e_memorydb:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to read memory usage. Error: " + str(e_memorydb))
+    return JSONResponse({"storage": report, "artifacts": artifacts, "status": "ok"})
+
 
 # triggered by login form submission
 @app.post("/app")
@@ -303,7 +457,7 @@ async def ask(query: Query, token_str: Annotated[str, Depends(oauth2_scheme)], r
     validate_headers(request)
     
     # ensure token is valid and user exists in DB
-    validate_token_str(token_str)
+    user = validate_token_str(token_str)
 
     # ensure init prompt is sent
     if not hasattr(app.state, "init_prompt_done"):
@@ -312,8 +466,43 @@ async def ask(query: Query, token_str: Annotated[str, Depends(oauth2_scheme)], r
     # await initialization
     await app.state.init_prompt_done.wait()
 
-    def generate_response():
-        yield from query_agent(app, query.user_input)
+    # the user's own thread, other users may be running turns at the same time
+    thread_id = user_thread(user.username)
+
+    async def prepare_thread():
+        # only once admitted, a queued request must not rewrite the thread under a run of the same user
+        # close tool calls left without results by an interrupted turn
+        # otherwise the model provider rejects the history
+        if await repair_thread(app, thread_id) == 2:
+            logging.warning(f"Repaired interrupted tool calls in thread {thread_id}")
+        # name new threads after their first question
+        touch_thread(thread_id, title=query.user_input.strip()[:60])
+
+    async def generate_response():
+        # simple lookups skip the queue and the agent, unless a run of the user is queued or running
+        # the user's slot is held while the answer is written, so it cannot interleave with an agent turn
+        if scheduler.try_admit(user.username):
+            try:
+                await prepare_thread()
+                answer = await answer_fast_path(app, query.user_input, thread_id)
+            finally:
+                scheduler.release(user.username)
+            if answer is not None:
+                yield answer
+                return
+        admitted = False
+        try:
+            async for position in scheduler.wait_turn(user.username):
+                # shown in place by chat.js while the request is queued
+                yield f"⏳ Waiting for a free agent. Position in queue: {position}"
+            admitted = True
+            # again, another run of the user may have been admitted in between
+            await prepare_thread()
+            async for chunk in query_agent(app, query.user_input, thread_id, user.username):
+                yield chunk
+        finally:
+            if admitted:
+                scheduler.release(user.username)
         
     return StreamingResponse(generate_response(), media_type="text/plain")
 
@@ -354,7 +543,7 @@ async def ready(token_str: Annotated[str, Depends(oauth2_scheme)], request: Requ
             if not result:
                 raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Memory database connection failed")
 
-    return JSONResponse({"status": "ok"})
+    return JSONResponse({"replicas": replica_status(), "scheduler": scheduler.status(), "status": "ok"})
 
 @app.post("/api/fix_history")
 async def fix_history(token_str: Annotated[str, Depends(oauth2_scheme)], request: Request) -> JSONResponse:
@@ -365,6 +554,16 @@ async def fix_history(token_str: Annotated[str, Depends(oauth2_scheme)], request
     return JSONResponse({"response": response_code, "status": "ok"})
     
 
+@app.get("/api/llm_stats")
+async def llm_stats(token_str: Annotated[str, Depends(oauth2_scheme)], request: Request) -> JSONResponse:
+    validate_headers(request)
+
+    # validate token to allow latency stats access
+    _ = validate_token_str(token_str)
+
+    return JSONResponse({"latency": latency_stats(), "routes": route_report(), "status": "ok"})
+
+
 @app.get("/api/usage_metadata")
 async def usage_metadata(token_str: Annotated[str, Depends(oauth2_scheme)], request: Request) -> JSONResponse:
     validate_headers(request)
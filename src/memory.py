@@ -0,0 +1,109 @@
+import psycopg
+import logging
+
+from variables import COMMPASS_MEMORY_DB_URI, CHECKPOINT_KEEP_LAST
+
+# tables written by langgraph's AsyncPostgresSaver in the checkpoints schema
+#   checkpoints        one row per graph step, checkpoint->'channel_versions' points at blobs
+#   checkpoint_writes  pending writes of a checkpoint
+#   checkpoint_blobs   channel values (e.g. the full message list) keyed by channel and version
+
+def compact_thread(cur: psycopg.Cursor, thread_id: str, keep_last: int = CHECKPOINT_KEEP_LAST) -> dict:
+    # keep the latest keep_last checkpoints of a thread and drop writes and blobs no longer referenced
+    # the latest checkpoint references the blob holding the complete message list, so the thread can always resume
+    keep_last = max(1, keep_last)
+    cur.execute(
+        """
+        DELETE FROM checkpoints.checkpoints c
+        USING (
+            SELECT checkpoint_ns, checkpoint_id,
+                   row_number() OVER (PARTITION BY checkpoint_ns ORDER BY checkpoint_id DESC) AS rn
+            FROM checkpoints.checkpoints
+            WHERE thread_id = %s
+        ) ranked
+        WHERE c.thread_id = %s
+            AND c.checkpoint_ns = ranked.checkpoint_ns
+            AND c.checkpoint_id = ranked.checkpoint_id
+            AND ranked.rn > %s
+        """,
+        (thread_id, thread_id, keep_last),
+    )
+    deleted_checkpoints = cur.rowcount
+    cur.execute(
+        """
+        DELETE FROM checkpoints.checkpoint_writes w
+        WHERE w.thread_id = %s
+            AND NOT EXISTS (
+                SELECT 1 FROM checkpoints.checkpoints c
+                WHERE c.thread_id = w.thread_id
+                    AND c.checkpoint_ns = w.checkpoint_ns
+                    AND c.checkpoint_id = w.checkpoint_id
+            )
+        """,
+        (thread_id,),
+    )
+    deleted_writes = cur.rowcount
+    cur.execute(
+        """
+        DELETE FROM checkpoints.checkpoint_blobs b
+        WHERE b.thread_id = %s
+            AND NOT EXISTS (
+                SELECT 1 FROM checkpoints.checkpoints c
+                WHERE c.thread_id = b.thread_id
+                    AND c.checkpoint_ns = b.checkpoint_ns
+                    AND c.checkpoint->'channel_versions'->>b.channel = b.version
+            )
+        """,
+        (thread_id,),
+    )
+    deleted_blobs = cur.rowcount
+    return {"checkpoints": deleted_checkpoints, "writes": deleted_writes, "blobs": deleted_blobs}
+
+def compact_all(keep_last: int = CHECKPOINT_KEEP_LAST, vacuum: bool = True) -> dict:
+    # compact every thread, one transaction per thread, then reclaim space
+    totals = {"threads": 0, "checkpoints": 0, "writes": 0, "blobs": 0}
+    with psycopg.connect(COMMPASS_MEMORY_DB_URI) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT DISTINCT thread_id FROM checkpoints.checkpoints")
+            thread_ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+        for thread_id in thread_ids:
+            try:
+                with conn.transaction():
+                    with conn.cursor() as cur:
+                        deleted = compact_thread(cur, thread_id, keep_last)
+            except Exception as e:
+                logging.warning(f"Checkpoint compaction failed for thread {thread_id}: {e}")
+                continue
+            totals["threads"] += 1
+            for key, value in deleted.items():
+                totals[key] += value
+    if vacuum:
+        # VACUUM cannot run inside a transaction block
+        with psycopg.connect(COMMPASS_MEMORY_DB_URI, autocommit=True) as conn:
+            with conn.cursor() as cur:
+                for table in ["checkpoints", "checkpoint_writes", "checkpoint_blobs"]:
+                    cur.execute(f"VACUUM (ANALYZE) checkpoints.{table}")
+    logging.info(f"Checkpoint compaction done: {totals}")
+    return totals
+
+def storage_report(thread_ids: list[str]) -> dict:
+    # number of rows and bytes stored per checkpoint table for the given threads
+    report = {}
+    with psycopg.connect(COMMPASS_MEMORY_DB_URI) as conn:
+        with conn.cursor() as cur:
+            for table in ["checkpoints", "checkpoint_writes", "checkpoint_blobs"]:
+                cur.execute(
+                    f"SELECT count(*), coalesce(sum(pg_column_size(t.*)), 0) FROM checkpoints.{table} t WHERE thread_id = ANY(%s)",
+                    (thread_ids,),
+                )
+                rows, size = cur.fetchone()
+                report[table] = {"rows": rows, "bytes": int(size)}
+    report["total_bytes"] = sum(table["bytes"] for table in report.values())
+    return report
+
+__all__ = [
+    "compact_all",
+    "compact_thread",
+    "storage_report",
+]
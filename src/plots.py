@@ -0,0 +1,303 @@
+import os
+import json
+import asyncio
+import threading
+import numpy as np
+import pandas as pd
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from artifacts import artifact_owner, file_digest, find_artifact, new_artifact_path, owner_dir, register_artifact, set_artifact_owner
+from variables import PLOT_WORKERS
+
+# declarative plots rendered by a pool of worker processes that keep matplotlib imported and styled
+# a spec is a dict with
+#   kind     'km', 'box', 'heatmap' or 'volcano'
+#   data     path of a csv file
+#   formats  list of output formats, 'png' first, optionally 'webp' and 'svg'
+#   title, xlabel, ylabel
+# and per kind
+#   km       group, time, survival columns (defaults 'group', 'time', 'survival'),
+#            lower95 and upper95 bands if present, labels: group -> legend label
+#   box      x: group column, y: value column
+#   heatmap  index: row label column (default the first column), zscore: z-score rows, cmap,
+#            diverging: values are already centred e.g. z-scores, use a symmetric colour scale
+#   volcano  x: effect size column, y: p value column, label: column naming the top hits,
+#            p_threshold (default 0.05), x_threshold (default 1)
+# plots are first rendered as a preview for the chat, with the spec saved next to it,
+# the full resolution images are rendered from the saved spec when the user opens them
+PLOT_KINDS = ('km', 'box', 'heatmap', 'volcano')
+PLOT_FORMATS = ('png', 'webp', 'svg')
+PLOT_TIMEOUT = 120
+DPI = 150
+STYLE = {
+    'figure.figsize': (6, 4),
+    'figure.dpi': DPI,
+    'savefig.dpi': DPI,
+    'savefig.bbox': 'tight',
+    'axes.spines.top': False,
+    'axes.spines.right': False,
+    'legend.loc': 'best',
+    'legend.frameon': False,
+    'svg.fonttype': 'none',
+}
+# previews are drawn at a lower resolution from block-averaged heatmaps and binned scatter plots
+PREVIEW_DPI = 100
+PREVIEW_MAX_CELLS = 200
+PREVIEW_MAX_POINTS = 5000
+# images written by the python REPL are shown in the chat downscaled if larger than this
+PREVIEW_MIN_BYTES = 256 * 1024
+PREVIEW_MAX_WIDTH = 900
+# lossy WebP, lossless WebP is larger than the PNG for plots
+SAVE_OPTIONS = {'webp': {'pil_kwargs': {'quality': 80}}}
+REQUIRED = {'km': [], 'box': ['x', 'y'], 'heatmap': [], 'volcano': ['x', 'y']}
+
+def _init_worker() -> None:
+    # runs once per worker: import and style matplotlib, and draw a figure so the fonts are loaded
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.rcParams.update(STYLE)
+    fig, ax = plt.subplots()
+    ax.set_title('warm up')
+    ax.plot([0, 1], [0, 1], label='warm up')
+    ax.legend()
+    fig.canvas.draw()
+    plt.close(fig)
+
+def _ping() -> bool:
+    return True
+
+def _block_mean(values: np.ndarray, n: int, axis: int) -> np.ndarray:
+    # mean over consecutive blocks so that at most n remain along axis, ignoring NaN
+    if values.shape[axis] <= n:
+        return values
+    starts = np.linspace(0, values.shape[axis], n + 1).astype(int)[:-1]
+    sums = np.add.reduceat(np.nan_to_num(values), starts, axis=axis)
+    counts = np.add.reduceat(np.isfinite(values).astype(np.float32), starts, axis=axis)
+    with np.errstate(invalid='ignore'):
+        return (sums / counts).astype(np.float32)
+
+def _draw_km(ax, df: pd.DataFrame, spec: dict) -> None:
+    group, time, survival = spec.get('group', 'group'), spec.get('time', 'time'), spec.get('survival', 'survival')
+    labels = spec.get('labels', {})
+    for name, curve in df.groupby(group, sort=False):
+        ax.step(curve[time], curve[survival], where='post', label=labels.get(str(name), str(name)))
+        if {'lower95', 'upper95'} <= set(curve.columns):
+            ax.fill_between(curve[time], curve['lower95'], curve['upper95'], step='post', alpha=0.15)
+    ax.set_ylim(0, 1.05)
+    ax.set_xlabel('Days')
+    ax.legend()
+
+def _draw_box(ax, df: pd.DataFrame, spec: dict) -> None:
+    groups = [(str(name), values[spec['y']].dropna().to_numpy()) for name, values in df.groupby(spec['x'], sort=True)]
+    ax.boxplot([values for _, values in groups], showfliers=False)
+    # points on top of the boxes, jittered so that equal values stay visible
+    rng = np.random.default_rng(0)
+    for i, (_, values) in enumerate(groups, start=1):
+        if spec.get('detail') == 'preview' and len(values) > PREVIEW_MAX_POINTS:
+            continue
+        ax.scatter(i + rng.uniform(-0.15, 0.15, len(values)), values, s=4, alpha=0.4, color='black', linewidths=0)
+    ax.set_xticks(range(1, len(groups) + 1), [f'{name}\n(n={len(values)})' for name, values in groups], rotation=45, ha='right')
+    ax.set_xlabel(spec['x'])
+    ax.set_ylabel(spec['y'])
+
+def _draw_heatmap(ax, df: pd.DataFrame, spec: dict) -> None:
+    df = df.set_index(spec.get('index', df.columns[0])).select_dtypes('number')
+    values = df.to_numpy(dtype=np.float32)
+    if spec.get('zscore'):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = (values - np.nanmean(values, axis=1, keepdims=True)) / np.nanstd(values, axis=1, keepdims=True)
+    if spec.get('detail') == 'preview':
+        values = _block_mean(_block_mean(values, PREVIEW_MAX_CELLS, 0), PREVIEW_MAX_CELLS, 1)
+    centred = spec.get('zscore') or spec.get('diverging')
+    limit = np.nanpercentile(np.abs(values), 99) if centred and np.isfinite(values).any() else None
+    image = ax.imshow(values, aspect='auto', interpolation='nearest', cmap=spec.get('cmap', 'RdBu_r' if limit else 'viridis'),
+                      vmin=-limit if limit else None, vmax=limit)
+    ax.figure.colorbar(image, ax=ax, label='z-score' if centred else None)
+    # label rows and columns only while they stay legible
+    if len(df) <= 60 and values.shape[0] == len(df):
+        ax.set_yticks(range(len(df)), df.index.astype(str), fontsize=6)
+    else:
+        ax.set_yticks([])
+    if df.shape[1] <= 60 and values.shape[1] == df.shape[1]:
+        ax.set_xticks(range(df.shape[1]), df.columns.astype(str), fontsize=6, rotation=90)
+    else:
+        ax.set_xticks([])
+
+def _draw_volcano(ax, df: pd.DataFrame, spec: dict) -> None:
+    effect = df[spec['x']].to_numpy(dtype=float)
+    with np.errstate(divide='ignore'):
+        log_p = -np.log10(df[spec['y']].to_numpy(dtype=float))
+    p_threshold, x_threshold = float(spec.get('p_threshold', 0.05)), float(spec.get('x_threshold', 1))
+    hit = (df[spec['y']] < p_threshold).to_numpy() & (np.abs(effect) >= x_threshold)
+    if spec.get('detail') == 'preview' and (~hit).sum() > PREVIEW_MAX_POINTS:
+        # the bulk of unremarkable points as density, the hits stay individual points
+        finite = ~hit & np.isfinite(effect) & np.isfinite(log_p)
+        ax.hexbin(effect[finite], log_p[finite], gridsize=80, bins='log', cmap='Greys', mincnt=1, linewidths=0)
+    else:
+        ax.scatter(effect[~hit], log_p[~hit], s=3, color='grey', alpha=0.5, linewidths=0, rasterized=True)
+    ax.scatter(effect[hit & (effect > 0)], log_p[hit & (effect > 0)], s=5, color='tab:red', linewidths=0, rasterized=True)
+    ax.scatter(effect[hit & (effect < 0)], log_p[hit & (effect < 0)], s=5, color='tab:blue', linewidths=0, rasterized=True)
+    ax.axhline(-np.log10(p_threshold), color='black', linewidth=0.5, linestyle='--')
+    for x in (-x_threshold, x_threshold):
+        ax.axvline(x, color='black', linewidth=0.5, linestyle='--')
+    if spec.get('label'):
+        top = df[hit].nsmallest(10, spec['y'])
+        for _, row in top.iterrows():
+            ax.annotate(str(row[spec['label']]), (row[spec['x']], -np.log10(row[spec['y']])), fontsize=6)
+    ax.set_xlabel(spec['x'])
+    ax.set_ylabel(f"-log10({spec['y']})")
+
+DRAW = {'km': _draw_km, 'box': _draw_box, 'heatmap': _draw_heatmap, 'volcano': _draw_volcano}
+
+def _render(spec: dict, paths: dict[str, str], dpi: int = DPI) -> None:
+    # runs in a worker process
+    import matplotlib.pyplot as plt
+    df = pd.read_csv(spec['data'])
+    height = min(12, max(4, 0.12 * len(df))) if spec['kind'] == 'heatmap' else 4
+    fig, ax = plt.subplots(figsize=(6, height))
+    try:
+        DRAW[spec['kind']](ax, df, spec)
+        for key in ('title', 'xlabel', 'ylabel'):
+            if spec.get(key):
+                getattr(ax, f'set_{key}')(spec[key])
+        for fmt, path in paths.items():
+            fig.savefig(path, format=fmt, dpi=dpi, **SAVE_OPTIONS.get(fmt, {}))
+    finally:
+        plt.close(fig)
+
+def validate_spec(spec: dict) -> dict:
+    # input: plot spec
+    # output: the spec with defaults filled in, raises ValueError with a message for the agent
+    spec = dict(spec)
+    if spec.get('kind') not in PLOT_KINDS:
+        raise ValueError(f"kind must be one of {', '.join(PLOT_KINDS)}")
+    if not spec.get('data') or not str(spec['data']).endswith('.csv'):
+        raise ValueError("data must be the path of a csv file")
+    columns = pd.read_csv(spec['data'], nrows=0).columns
+    if spec['kind'] == 'km':
+        required = [spec.setdefault(key, key) for key in ('group', 'time', 'survival')]
+    else:
+        required = [spec.get(key) for key in REQUIRED[spec['kind']]]
+        if spec['kind'] == 'volcano' and spec.get('label'):
+            required.append(spec['label'])
+    missing = [name for name in required if name not in columns]
+    if missing:
+        raise ValueError(f"columns {missing} not found in {spec['data']}, available columns: {list(columns)}")
+    formats = [fmt for fmt in spec.get('formats') or ['png'] if fmt in PLOT_FORMATS]
+    spec['formats'] = ['png'] + [fmt for fmt in formats if fmt != 'png']
+    return spec
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool(broken: ProcessPoolExecutor | None = None) -> ProcessPoolExecutor:
+    # broken: a pool that failed, replaced only if no other thread has replaced it already
+    global _pool
+    with _pool_lock:
+        if broken is not None and _pool is broken:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+        if _pool is None:
+            # spawn rather than fork, as the server process runs threads
+            _pool = ProcessPoolExecutor(max_workers=PLOT_WORKERS, mp_context=get_context('spawn'), initializer=_init_worker)
+        return _pool
+
+def prewarm_plot_pool() -> None:
+    # start every worker ahead of the first plot
+    pool = _get_pool()
+    for future in [pool.submit(_ping) for _ in range(PLOT_WORKERS)]:
+        future.result()
+
+def _run_in_pool(spec: dict, paths: dict[str, str], dpi: int) -> None:
+    pool = _get_pool()
+    try:
+        pool.submit(_render, spec, paths, dpi).result(timeout=PLOT_TIMEOUT)
+    except BrokenProcessPool:
+        # a worker died, e.g. out of memory, start a fresh pool and try once more
+        _get_pool(broken=pool).submit(_render, spec, paths, dpi).result(timeout=PLOT_TIMEOUT)
+
+def _spec_path(preview_path: str) -> str:
+    return os.path.splitext(preview_path)[0] + '.json'
+
+def render_plot(spec: dict, detail: str = 'preview', reuse_key: str | None = None) -> dict[str, str]:
+    # input: plot spec, see above, 'preview' or 'full', key the full images are registered under
+    # output: format -> path of the stored image, only 'png' for previews
+    spec = dict(validate_spec(spec), detail=detail)
+    if detail == 'preview':
+        paths = {'png': new_artifact_path('graph', f"{spec['kind']}_preview", '.png')}
+        _run_in_pool(spec, paths, PREVIEW_DPI)
+    else:
+        paths = {fmt: new_artifact_path('graph', spec['kind'], f'.{fmt}') for fmt in spec['formats']}
+        _run_in_pool(spec, paths, DPI)
+    stored = {fmt: register_artifact(path, f'{reuse_key}:{fmt}' if reuse_key else None) for fmt, path in paths.items()}
+    if detail == 'preview':
+        # the data file may be overwritten or expire before the full image is requested
+        spec['data_digest'] = file_digest(spec['data'])
+        with open(_spec_path(stored['png']), 'w') as f:
+            json.dump(spec, f)
+        register_artifact(_spec_path(stored['png']), content_address=False)
+    return stored
+
+async def arender_plot(spec: dict, detail: str = 'preview') -> dict[str, str]:
+    # async version of render_plot, the rendering itself happens in the pool
+    return await asyncio.to_thread(render_plot, spec, detail)
+
+def render_full(preview_path: str, fmt: str = 'png') -> str:
+    # input: path of a preview from render_plot, output format
+    # output: path of the full resolution image, rendered on first request
+    # raises FileNotFoundError for previews that are unknown or not the current user's, or whose data is gone,
+    # and ValueError if the data file changed since the preview was drawn
+    parts = os.path.normpath(preview_path).split(os.sep)
+    username = artifact_owner()
+    spec_path = _spec_path(preview_path)
+    if not username or len(parts) != 3 or parts[:2] != ['graph', owner_dir(username)] or not os.path.exists(spec_path):
+        raise FileNotFoundError(f'no plot for {preview_path}')
+    if fmt not in PLOT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(PLOT_FORMATS)}")
+    reuse_key = f'plot:{preview_path}'
+    if path := find_artifact(f'{reuse_key}:{fmt}'):
+        return path
+    with open(spec_path) as f:
+        spec = json.load(f)
+    if not os.path.exists(spec['data']):
+        raise FileNotFoundError(f"the data of this plot, {spec['data']}, no longer exists; render the plot again")
+    if spec.get('data_digest') != file_digest(spec['data']):
+        raise ValueError(f"{spec['data']} changed since this plot was drawn; render the plot again")
+    spec['formats'] = list(dict.fromkeys(spec['formats'] + [fmt]))
+    return render_plot(spec, 'full', reuse_key)[fmt]
+
+async def arender_full(username: str, preview_path: str, fmt: str = 'png') -> str:
+    # async version of render_full for requests outside of agent runs
+    def run() -> str:
+        set_artifact_owner(username)
+        return render_full(preview_path, fmt)
+    return await asyncio.to_thread(run)
+
+def make_preview(path: str) -> str:
+    # input: path of a PNG written by the python REPL
+    # output: path of a downscaled WebP copy if the image is large, otherwise the path itself
+    if os.path.getsize(path) < PREVIEW_MIN_BYTES:
+        return path
+    preview = os.path.splitext(path)[0] + '.preview.webp'
+    if not os.path.exists(preview) or os.path.getmtime(preview) < os.path.getmtime(path):
+        from PIL import Image
+        with Image.open(path) as image:
+            image.thumbnail((PREVIEW_MAX_WIDTH, PREVIEW_MAX_WIDTH * 4))
+            image.save(preview, 'WEBP', quality=80)
+        register_artifact(preview, content_address=False)
+    return preview
+
+__all__ = [
+    "PLOT_FORMATS",
+    "PLOT_KINDS",
+    "arender_full",
+    "arender_plot",
+    "make_preview",
+    "prewarm_plot_pool",
+    "render_full",
+    "render_plot",
+    "validate_spec",
+]
@@ -0,0 +1,97 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+
+filedir = os.path.dirname(os.path.abspath(__file__))
+
+# reference csv/tsv files shipped with the app, also served to users as is
+REFDATA_DIR = os.path.join(filedir, '..', 'refdata')
+# typed, zstd-compressed parquet copy of each file, rebuilt when the source file is newer
+CACHE_DIR = os.path.join(filedir, 'cache', 'refdata')
+# read_csv options for files whose column types would otherwise be inferred wrongly
+READ_OPTIONS = {
+    'gene_annotation.tsv': {'dtype': {'chromosome': 'str'}},
+}
+_build_lock = threading.Lock()
+
+def _name(name: str) -> str:
+    # accept 'gene_annotation.tsv' as well as paths such as 'refdata/gene_annotation.tsv'
+    return name.removeprefix('refdata/').removeprefix('/refdata/')
+
+def _source_path(name: str) -> str:
+    return os.path.join(REFDATA_DIR, name)
+
+def _parquet_path(name: str) -> str:
+    return os.path.join(CACHE_DIR, f'{name}.parquet')
+
+def _read_source(name: str) -> pd.DataFrame:
+    sep = '\t' if name.endswith('.tsv') else ','
+    return pd.read_csv(_source_path(name), sep=sep, low_memory=False, **READ_OPTIONS.get(name, {}))
+
+def build_refdata_file(name: str, force: bool = False) -> str:
+    # input: file name relative to REFDATA_DIR, force rebuild
+    # output: path of its parquet copy
+    name = _name(name)
+    source, target = _source_path(name), _parquet_path(name)
+    if not force and os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+        return target
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # write to a private file first, other workers may be reading the old copy
+    tmp = f'{target}.{os.getpid()}.tmp'
+    _read_source(name).to_parquet(tmp, compression='zstd', index=False)
+    os.replace(tmp, target)
+    return target
+
+def build_refdata(force: bool = False) -> list[str]:
+    # convert every csv/tsv file in REFDATA_DIR, returns the parquet paths
+    paths = []
+    for root, _, files in os.walk(REFDATA_DIR):
+        for file in sorted(files):
+            if file.endswith(('.csv', '.tsv')):
+                paths.append(build_refdata_file(os.path.relpath(os.path.join(root, file), REFDATA_DIR), force))
+    return paths
+
+@lru_cache(maxsize=64)
+def _load(name: str, mtime: float) -> pd.DataFrame:
+    # keyed by the source mtime so that an updated file is picked up without a restart
+    return pd.read_parquet(_parquet_path(name))
+
+def _mtime(name: str) -> float:
+    with _build_lock:
+        build_refdata_file(name)
+    return os.path.getmtime(_source_path(name))
+
+def load_refdata(name: str) -> pd.DataFrame:
+    # input: file name relative to REFDATA_DIR e.g. 'gene_annotation.tsv' or 'os.csv'
+    # output: its contents, parsed once per process
+    # the data frame is shared by all callers, copy it before modifying it in place
+    name = _name(name)
+    return _load(name, _mtime(name))
+
+@lru_cache(maxsize=64)
+def _index(name: str, key: str, mtime: float) -> dict[str, np.ndarray]:
+    return load_refdata(name).groupby(key, sort=False).indices
+
+def refdata_index(name: str, key: str) -> dict[str, np.ndarray]:
+    # input: file name relative to REFDATA_DIR, column name
+    # output: value -> row positions of the rows with that value, for use with load_refdata(name).iloc
+    # rows with a missing value are not indexed
+    name = _name(name)
+    return _index(name, key, _mtime(name))
+
+if __name__ == "__main__":
+    # build the parquet copies ahead of time e.g. at deployment
+    # usage: python refdata.py [--force]
+    import sys
+    for path in build_refdata(force='--force' in sys.argv[1:]):
+        print(path)
+
+__all__ = [
+    "REFDATA_DIR",
+    "build_refdata",
+    "build_refdata_file",
+    "load_refdata",
+    "refdata_index",
+]
@@ -0,0 +1,89 @@
+import time
+import logging
+import itertools
+import psycopg
+from psycopg.conninfo import conninfo_to_dict
+from typing import Awaitable, Callable, TypeVar
+
+from variables import COMMPASS_DSN, COMMPASS_REPLICA_DSNS
+
+# read-only CoMMpass queries go to the replicas in turn, the primary is the last resort
+# auth and checkpointer traffic never comes through here and always uses the primary
+
+# seconds a replica that failed is skipped before it is tried again
+REPLICA_RETRY_AFTER = 30
+
+T = TypeVar("T")
+
+_down = {}  # replica dsn -> time it failed
+_turn = itertools.count()
+
+def read_dsns() -> list[str]:
+    # healthy replicas, rotated for load balancing, followed by the primary
+    now = time.monotonic()
+    healthy = [dsn for dsn in COMMPASS_REPLICA_DSNS if now - _down.get(dsn, -REPLICA_RETRY_AFTER) >= REPLICA_RETRY_AFTER]
+    if healthy:
+        start = next(_turn) % len(healthy)
+        healthy = healthy[start:] + healthy[:start]
+    return healthy + [COMMPASS_DSN]
+
+def _is_replica_failure(e: Exception) -> bool:
+    # connection errors, and queries cancelled by the standby because of replication conflicts
+    # statement timeouts are the query's fault, not the replica's
+    if isinstance(e, psycopg.errors.QueryCanceled):
+        return False
+    return isinstance(e, (psycopg.OperationalError, psycopg.errors.SerializationFailure))
+
+def _mark_down(dsn: str, e: Exception) -> None:
+    _down[dsn] = time.monotonic()
+    host = conninfo_to_dict(dsn).get("host")
+    logging.warning(f"Read replica {host} failed, failing over: {e}")
+
+def connect_read() -> psycopg.Connection:
+    # connection to the first replica that accepts it, or to the primary
+    # only covers failures to connect, use run_read to also retry failed queries
+    for dsn in read_dsns():
+        try:
+            return psycopg.connect(dsn)
+        except psycopg.OperationalError as e:
+            if dsn == COMMPASS_DSN:
+                raise
+            _mark_down(dsn, e)
+
+def run_read(fn: Callable[[psycopg.Connection], T]) -> T:
+    # run fn on a connection to a replica, retrying on the next replica or the primary if the replica fails
+    # fn may run more than once, so it must not have side effects other than overwriting its output
+    for dsn in read_dsns():
+        try:
+            with psycopg.connect(dsn) as conn:
+                return fn(conn)
+        except Exception as e:
+            if dsn == COMMPASS_DSN or not _is_replica_failure(e):
+                raise
+            _mark_down(dsn, e)
+
+async def arun_read(fn: Callable[[psycopg.AsyncConnection], Awaitable[T]]) -> T:
+    # async version of run_read
+    for dsn in read_dsns():
+        try:
+            async with await psycopg.AsyncConnection.connect(dsn) as conn:
+                return await fn(conn)
+        except Exception as e:
+            if dsn == COMMPASS_DSN or not _is_replica_failure(e):
+                raise
+            _mark_down(dsn, e)
+
+def replica_status() -> dict:
+    now = time.monotonic()
+    return {
+        conninfo_to_dict(dsn).get("host"): "down" if now - _down.get(dsn, -REPLICA_RETRY_AFTER) < REPLICA_RETRY_AFTER else "up"
+        for dsn in COMMPASS_REPLICA_DSNS
+    }
+
+__all__ = [
+    "arun_read",
+    "connect_read",
+    "read_dsns",
+    "replica_status",
+    "run_read",
+]
@@ -0,0 +1,110 @@
+import time
+import threading
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.runnables import RunnableLambda
+
+from llm_utils import cacheable_messages, get_chat_model
+
+# tools whose results rarely need interpretation, the step after them is usually just another tool call
+LIGHTWEIGHT_TOOLS = {
+    "convert_gene_name_to_accession",
+    "generate_graph_filepath",
+    "get_cox_regression_base_data",
+    "get_gene_metadata",
+    "get_survival_data",
+}
+
+class RouteStats:
+    # calls, wall time and tokens of each route, aggregated over the process
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _route(self, route: str) -> dict:
+        return self.stats.setdefault(route, {"calls": 0, "escalated": 0, "total_s": 0., "input_tokens": 0, "output_tokens": 0, "cache_read": 0})
+
+    def record(self, route: str, elapsed: float, response: AIMessage) -> None:
+        usage = response.usage_metadata or {}
+        with self.lock:
+            stats = self._route(route)
+            stats["calls"] += 1
+            stats["total_s"] += elapsed
+            stats["input_tokens"] += usage.get("input_tokens", 0)
+            stats["output_tokens"] += usage.get("output_tokens", 0)
+            stats["cache_read"] += usage.get("input_token_details", {}).get("cache_read", 0) or 0
+
+    def escalate(self, route: str) -> None:
+        # the route's answer was discarded and the step re-run on the strong model
+        with self.lock:
+            self._route(route)["escalated"] += 1
+
+    def report(self) -> dict:
+        with self.lock:
+            return {route: dict(stats, mean_s=stats["total_s"] / stats["calls"]) for route, stats in self.stats.items()}
+
+route_stats = RouteStats()
+
+def choose_route(messages: list) -> str:
+    # "fast" right after results of lightweight tools only, "strong" otherwise
+    # e.g. after the user's question, after errors and after analysis results that need interpreting
+    results = []
+    for msg in reversed(messages):
+        if not isinstance(msg, ToolMessage):
+            break
+        results.append(msg)
+    if results and all(msg.name in LIGHTWEIGHT_TOOLS and not msg.text.startswith("Error") for msg in results):
+        return "fast"
+    return "strong"
+
+class ModelRouter:
+    # dynamic model for create_react_agent: the fast model plans intermediate tool calls,
+    # the configured model writes answers. A fast step that would answer is re-run on the strong model.
+    def __init__(self, strong_model_id: str, fast_model_id: str, tools: list):
+        self.model_ids = {"strong": strong_model_id, "fast": fast_model_id}
+        self.models = {
+            "strong": get_chat_model(strong_model_id).bind_tools(tools),
+            "fast": get_chat_model(fast_model_id).bind_tools(tools),
+        }
+
+    def _invoke(self, route: str, model_input, config=None) -> AIMessage:
+        model_input = cacheable_messages(model_input, self.model_ids[route])
+        start = time.perf_counter()
+        response = self.models[route].invoke(model_input, config)
+        route_stats.record(route, time.perf_counter() - start, response)
+        return response
+
+    async def _ainvoke(self, route: str, model_input, config=None) -> AIMessage:
+        model_input = cacheable_messages(model_input, self.model_ids[route])
+        start = time.perf_counter()
+        response = await self.models[route].ainvoke(model_input, config)
+        route_stats.record(route, time.perf_counter() - start, response)
+        return response
+
+    def __call__(self, state, runtime) -> RunnableLambda:
+        route = choose_route(state["messages"])
+
+        def invoke(model_input, config=None):
+            response = self._invoke(route, model_input, config)
+            if route == "fast" and not response.tool_calls:
+                route_stats.escalate("fast")
+                response = self._invoke("strong", model_input, config)
+            return response
+
+        async def ainvoke(model_input, config=None):
+            response = await self._ainvoke(route, model_input, config)
+            if route == "fast" and not response.tool_calls:
+                route_stats.escalate("fast")
+                response = await self._ainvoke("strong", model_input, config)
+            return response
+
+        return RunnableLambda(invoke, afunc=ainvoke, name=f"route_{route}")
+
+def route_report() -> dict:
+    return route_stats.report()
+
+__all__ = [
+    "LIGHTWEIGHT_TOOLS",
+    "ModelRouter",
+    "choose_route",
+    "route_report",
+]
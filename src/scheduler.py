@@ -0,0 +1,81 @@
+import asyncio
+from collections.abc import AsyncIterator
+
+from variables import MAX_CONCURRENT_RUNS, MAX_CONCURRENT_RUNS_PER_USER
+
+# admits agent runs in arrival order, subject to a global and a per-user cap
+# a request whose user is at the per-user cap does not hold up requests of other users
+# all methods run on the event loop, so no locking is needed
+class RunScheduler:
+    def __init__(self, max_runs: int = MAX_CONCURRENT_RUNS, max_runs_per_user: int = MAX_CONCURRENT_RUNS_PER_USER):
+        self.max_runs = max(1, max_runs)
+        self.max_runs_per_user = max(1, max_runs_per_user)
+        self.running = {}  # username -> number of running agent runs
+        self.waiting = []  # (ticket, username) in arrival order
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        # wake up every waiter to recompute its position
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _position(self, ticket: object) -> int:
+        # 0 if the ticket can start now, otherwise its 1-based place in the queue
+        free = self.max_runs - sum(self.running.values())
+        claimed = dict(self.running)
+        for place, (other, username) in enumerate(self.waiting, start=1):
+            eligible = free > 0 and claimed.get(username, 0) < self.max_runs_per_user
+            if other is ticket:
+                return 0 if eligible else place
+            if eligible:
+                # an earlier request will take this slot first
+                free -= 1
+                claimed[username] = claimed.get(username, 0) + 1
+        raise ValueError("ticket is not waiting")
+
+    async def wait_turn(self, username: str) -> AsyncIterator[int]:
+        # yields the queue position whenever it changes, finishes once the run is admitted
+        # the caller must call release(username) after an admitted run
+        ticket = object()
+        self.waiting.append((ticket, username))
+        last = None
+        try:
+            while True:
+                changed = self._changed
+                position = self._position(ticket)
+                if position == 0:
+                    break
+                if position != last:
+                    last = position
+                    yield position
+                await changed.wait()
+        finally:
+            # also reached when the client disconnects while queued
+            self.waiting.remove((ticket, username))
+            self._notify()
+        self.running[username] = self.running.get(username, 0) + 1
+
+    def try_admit(self, username: str) -> bool:
+        # takes a slot at once if the user has no run running or queued, without queueing
+        # for short thread writes that call no model, so the global cap is not checked
+        # the caller must call release(username) if True is returned
+        if self.running.get(username) or any(other == username for _, other in self.waiting):
+            return False
+        self.running[username] = 1
+        return True
+
+    def release(self, username: str) -> None:
+        self.running[username] -= 1
+        if self.running[username] <= 0:
+            del self.running[username]
+        self._notify()
+
+    def status(self) -> dict:
+        return {
+            "running": sum(self.running.values()),
+            "waiting": len(self.waiting),
+            "max_runs": self.max_runs,
+            "max_runs_per_user": self.max_runs_per_user,
+        }
+
+__all__ = ["RunScheduler"]
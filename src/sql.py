@@ -0,0 +1,319 @@
+import re
+import time
+import uuid
+import asyncio
+import threading
+import psycopg
+import pandas as pd
+from collections import OrderedDict
+
+from replicas import arun_read, run_read
+from variables import SQL_EXPORT_MAX_COST, SQL_EXPORT_TIMEOUT_MS, SQL_TRIAL_MAX_COST, SQL_TRIAL_TIMEOUT_MS
+
+# rows fetched per round trip by server-side cursors
+FETCH_SIZE = 2000
+# trial runs keep fetching past their LIMIT until the result is complete or exceeds this many cells
+TRIAL_CACHE_CELLS = 200_000
+# the cache as a whole holds at most this many cells, the least recently used results are dropped first
+TRIAL_CACHE_TOTAL_CELLS = 2_000_000
+TRIAL_CACHE_TTL = 600
+# admission limits per query class: trial runs from sql_db_query, exports of full results
+QUERY_TIMEOUTS_MS = {"trial": SQL_TRIAL_TIMEOUT_MS, "export": SQL_EXPORT_TIMEOUT_MS}
+QUERY_MAX_COST = {"trial": SQL_TRIAL_MAX_COST, "export": SQL_EXPORT_MAX_COST}
+# a join without a join condition is rejected if both sides are estimated above this many rows
+CROSS_JOIN_ROWS = 1000
+# rows assumed for a trial run without LIMIT, as trial runs never fetch the complete result of a large query
+TRIAL_EXPLAIN_LIMIT = 1000
+
+_TOKEN_PATTERN = re.compile(
+    r"'(?:[^']|'')*'"            # string literal
+    r'|"(?:[^"]|"")*"'           # quoted identifier
+    r"|--[^\n]*"                 # line comment
+    r"|/\*.*?\*/"                # block comment
+    r"|[()]"
+    r"|[A-Za-z_][A-Za-z0-9_$]*"  # keyword or identifier
+    r"|[0-9]+",
+    re.DOTALL,
+)
+
+def _top_level_tokens(query: str) -> list[tuple[str, int, int]]:
+    # upper-cased words and numbers outside parentheses, strings and comments, with their positions
+    tokens = []
+    depth = 0
+    for match in _TOKEN_PATTERN.finditer(query):
+        token = match.group()
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth == 0 and (token[0].isalnum() or token[0] == '_'):
+            tokens.append((token.upper(), match.start(), match.end()))
+    return tokens
+
+def split_limit(query: str) -> tuple[str, int | None]:
+    # input: SELECT statement, optionally ending with LIMIT n, LIMIT n OFFSET m or OFFSET m LIMIT n
+    # output: the statement without its outermost LIMIT, and n (None if there was none or LIMIT ALL)
+    # LIMITs inside subqueries, strings and comments are left alone
+    query = query.strip().rstrip(';').rstrip()
+    tokens = _top_level_tokens(query)
+    words = [token for token, _, _ in tokens]
+    if len(words) >= 4 and words[-4] == 'LIMIT' and words[-2] == 'OFFSET' and words[-1].isdigit():
+        # LIMIT n OFFSET m, keep the offset
+        limit = int(words[-3]) if words[-3].isdigit() else None
+        return (query[:tokens[-4][1]] + query[tokens[-2][1]:]).strip(), limit
+    if len(words) >= 2 and words[-2] == 'LIMIT':
+        limit = int(words[-1]) if words[-1].isdigit() else None
+        return query[:tokens[-2][1]].rstrip(), limit
+    return query, None
+
+def normalize_query(query: str) -> str:
+    # cache key: runs of whitespace collapsed to a single space, except inside strings, quoted identifiers and
+    # comments, which are kept as written; a line comment keeps the newline that ends it
+    query = query.strip().rstrip(';').strip()
+    parts, end = [], 0
+    for match in _TOKEN_PATTERN.finditer(query):
+        token = match.group()
+        if token[0] in '\'"' or token[:2] in ('--', '/*'):
+            parts.append(re.sub(r'\s+', ' ', query[end:match.start()]))
+            parts.append(token + '\n' if token[:2] == '--' else token)
+            end = match.end()
+    parts.append(re.sub(r'\s+', ' ', query[end:]))
+    return ''.join(parts).strip()
+
+class QueryRejected(ValueError):
+    # the message is returned to the agent as feedback
+    pass
+
+def _plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+def check_plan(plan: dict, query_class: str) -> None:
+    # input: top node of EXPLAIN (FORMAT JSON) output
+    # raises QueryRejected for plans that would tie up the shared database
+    for node in _plan_nodes(plan):
+        children = node.get("Plans", [])
+        if node["Node Type"] == "Nested Loop" and "Join Filter" not in node and len(children) == 2 \
+                and all(child["Plan Rows"] > CROSS_JOIN_ROWS for child in children) \
+                and not any("Index Cond" in child or "Recheck Cond" in child for child in children):
+            raise QueryRejected(
+                f"the query joins {children[0]['Plan Rows']:,} rows with {children[1]['Plan Rows']:,} rows without a join condition "
+                f"(estimated {node['Plan Rows']:,} rows). Add the missing ON/WHERE condition, e.g. on public_id."
+            )
+    if plan["Total Cost"] > QUERY_MAX_COST[query_class]:
+        scans = sorted({node["Relation Name"] for node in _plan_nodes(plan) if node["Node Type"] == "Seq Scan" and "Filter" not in node and "Relation Name" in node})
+        hint = f" Unfiltered full scans of: {', '.join(scans)}." if scans else ""
+        raise QueryRejected(
+            f"the estimated cost of the query ({plan['Total Cost']:,.0f}, about {plan['Plan Rows']:,} rows) exceeds the {query_class} limit of {QUERY_MAX_COST[query_class]:,.0f}.{hint} "
+            "Select fewer columns, add WHERE filters (e.g. first-visit samples) or aggregate in SQL. "
+            "For gene expression use the local expression cache instead of the expr table."
+        )
+
+def _admission_sql(query: str, query_class: str) -> tuple[str, str]:
+    # statement_timeout for the current transaction, and the statement to EXPLAIN
+    # trial runs are explained with their LIMIT, or a nominal one, as they only fetch a bounded number of rows
+    explain = query
+    if query_class == "trial":
+        base, limit = split_limit(query)
+        explain = f"{base}\nLIMIT {limit if limit is not None else TRIAL_EXPLAIN_LIMIT}"
+    return str(QUERY_TIMEOUTS_MS[query_class]), f"EXPLAIN (FORMAT JSON) {explain}"
+
+def admit(curs: psycopg.Cursor, query: str, query_class: str) -> dict:
+    # run on the transaction that will execute the query, before executing it
+    # query is the statement as it will run, except for trial runs, which pass the statement with its LIMIT
+    # returns the admitted plan
+    timeout, explain = _admission_sql(query, query_class)
+    curs.execute("SELECT set_config('statement_timeout', %s, true)", (timeout,))
+    curs.execute(explain)
+    plan = curs.fetchone()[0][0]["Plan"]
+    check_plan(plan, query_class)
+    return plan
+
+def _streams_cheaply(curs: psycopg.Cursor, base: str, limited_plan: dict) -> bool:
+    # whether the statement without its LIMIT returns its first rows as cheaply as the statement with it
+    # sorts, aggregates and DISTINCT consume their whole input before the first row, which the planner
+    # reports as a startup cost above the total cost of the limited plan (e.g. a top-N sort or an index scan)
+    curs.execute(f"EXPLAIN (FORMAT JSON) {base}")
+    return curs.fetchone()[0][0]["Plan"]["Startup Cost"] <= limited_plan["Total Cost"]
+
+async def aadmit(curs: psycopg.AsyncCursor, query: str, query_class: str) -> None:
+    timeout, explain = _admission_sql(query, query_class)
+    await curs.execute("SELECT set_config('statement_timeout', %s, true)", (timeout,))
+    await curs.execute(explain)
+    check_plan((await curs.fetchone())[0][0]["Plan"], query_class)
+
+def _timed_out(query_class: str) -> QueryRejected:
+    return QueryRejected(
+        f"the query was cancelled after the {QUERY_TIMEOUTS_MS[query_class] / 1000:.0f}s {query_class} statement timeout. "
+        "Narrow it with WHERE filters, fewer columns or aggregation in SQL."
+    )
+
+def _cells(columns: list[str], rows: list[tuple]) -> int:
+    return len(rows) * max(1, len(columns))
+
+class _ResultCache:
+    # small LRU of complete query results, keyed by the statement without its LIMIT, bounded by the total
+    # number of cached cells; shared by tool calls running in executor threads
+    def __init__(self, max_cells: int = TRIAL_CACHE_TOTAL_CELLS, ttl: float = TRIAL_CACHE_TTL):
+        self.max_cells = max_cells
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.cells = 0
+        self.lock = threading.Lock()
+
+    def _drop(self, key: str) -> None:
+        _, columns, rows = self.entries.pop(key)
+        self.cells -= _cells(columns, rows)
+
+    def get(self, query: str) -> tuple[list[str], list[tuple]] | None:
+        key = normalize_query(query)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+        return entry[1], entry[2]
+
+    def put(self, query: str, columns: list[str], rows: list[tuple]) -> None:
+        key = normalize_query(query)
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (time.monotonic(), columns, rows)
+            self.cells += _cells(columns, rows)
+            # the newest entry is kept even if it alone exceeds the budget
+            while self.cells > self.max_cells and len(self.entries) > 1:
+                self._drop(next(iter(self.entries)))
+
+result_cache = _ResultCache()
+
+def trial_run(query: str) -> tuple[list[str], list[tuple], bool]:
+    # run a trial query and return its columns, the rows up to its LIMIT, and whether rows were cut off
+    # where the plan shows it is no more expensive, the statement runs without its LIMIT through a server-side
+    # cursor; if the complete result is small it is cached, so that the full run of the same statement does not
+    # hit the database again. Otherwise it runs with its LIMIT, and is cached only if it returned fewer rows.
+    base, limit = split_limit(query)
+    cached = result_cache.get(base)
+    if cached is not None:
+        columns, rows = cached
+        return columns, rows[:limit] if limit is not None else rows, False
+
+    def run(conn: psycopg.Connection):
+        with conn.cursor() as curs:
+            plan = admit(curs, query, "trial")
+            stream = limit is None or _streams_cheaply(curs, base, plan)
+        try:
+            with conn.cursor(name=f"trial_{uuid.uuid4().hex[:8]}") as curs:
+                curs.execute(base if stream else query)
+                columns = [desc[0] for desc in curs.description]
+                max_rows = TRIAL_CACHE_CELLS // max(1, len(columns))
+                rows = []
+                while len(rows) <= max_rows:
+                    batch = curs.fetchmany(min(FETCH_SIZE, max_rows + 1 - len(rows)))
+                    if not batch:
+                        # a LIMITed run is the complete result only if the LIMIT was not reached
+                        return columns, rows, max_rows, stream or len(rows) < limit
+                    rows.extend(batch)
+                return columns, rows, max_rows, False
+        except psycopg.errors.QueryCanceled:
+            raise _timed_out("trial")
+
+    columns, rows, max_rows, complete = run_read(run)
+    if complete:
+        result_cache.put(base, columns, rows)
+        return columns, rows[:limit] if limit is not None else rows, False
+    # too large to cache, or cut off by the LIMIT; rows beyond max_rows were not fetched
+    return columns, rows[:limit] if limit is not None else rows[:max_rows], limit is None
+
+def _write_chunk(csv_path: str, columns: list[str], rows: list[tuple], header: bool) -> None:
+    pd.DataFrame(rows, columns=columns).to_csv(csv_path, mode='w' if header else 'a', header=header, index=False)
+
+def export_query(query: str, csv_path: str) -> int:
+    # run the full query (outermost LIMIT removed) and stream it to csv_path in chunks
+    # returns the number of rows, no file is written if there are none
+    base, _ = split_limit(query)
+    cached = result_cache.get(base)
+    if cached is not None:
+        columns, rows = cached
+        if rows:
+            _write_chunk(csv_path, columns, rows, header=True)
+        return len(rows)
+    def run(conn: psycopg.Connection) -> int:
+        n_rows = 0
+        with conn.cursor() as curs:
+            admit(curs, base, "export")
+        try:
+            with conn.cursor(name=f"export_{uuid.uuid4().hex[:8]}") as curs:
+                curs.execute(base)
+                columns = [desc[0] for desc in curs.description]
+                while batch := curs.fetchmany(FETCH_SIZE):
+                    # the first chunk overwrites the file, so a retry on another server starts afresh
+                    _write_chunk(csv_path, columns, batch, header=n_rows == 0)
+                    n_rows += len(batch)
+        except psycopg.errors.QueryCanceled:
+            raise _timed_out("export")
+        return n_rows
+
+    return run_read(run)
+
+def read_query(query: str) -> pd.DataFrame:
+    # result of an agent-written query as written, including its LIMIT, with the same admission as exports
+    query = query.strip().rstrip(';')
+    if split_limit(query)[1] is None:
+        cached = result_cache.get(query)
+        if cached is not None:
+            return pd.DataFrame(cached[1], columns=cached[0])
+    def run(conn: psycopg.Connection) -> pd.DataFrame:
+        with conn.cursor() as curs:
+            admit(curs, query, "export")
+            try:
+                curs.execute(query)
+                return pd.DataFrame(curs.fetchall(), columns=[desc[0] for desc in curs.description])
+            except psycopg.errors.QueryCanceled:
+                raise _timed_out("export")
+
+    return run_read(run)
+
+async def aexport_query(query: str, csv_path: str) -> int:
+    # async version of export_query, csv writes run in a worker thread
+    base, _ = split_limit(query)
+    cached = result_cache.get(base)
+    if cached is not None:
+        columns, rows = cached
+        if rows:
+            await asyncio.to_thread(_write_chunk, csv_path, columns, rows, True)
+        return len(rows)
+    async def run(conn: psycopg.AsyncConnection) -> int:
+        n_rows = 0
+        async with conn.cursor() as curs:
+            await aadmit(curs, base, "export")
+        try:
+            async with conn.cursor(name=f"export_{uuid.uuid4().hex[:8]}") as curs:
+                await curs.execute(base)
+                columns = [desc[0] for desc in curs.description]
+                while batch := await curs.fetchmany(FETCH_SIZE):
+                    await asyncio.to_thread(_write_chunk, csv_path, columns, batch, n_rows == 0)
+                    n_rows += len(batch)
+        except psycopg.errors.QueryCanceled:
+            raise _timed_out("export")
+        return n_rows
+
+    return await arun_read(run)
+
+__all__ = [
+    "QueryRejected",
+    "aadmit",
+    "admit",
+    "aexport_query",
+    "check_plan",
+    "export_query",
+    "normalize_query",
+    "read_query",
+    "result_cache",
+    "split_limit",
+    "trial_run",
+]
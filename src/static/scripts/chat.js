@@ -99,6 +99,7 @@ async function sendMessage() {
         let originalTitle = document.title;
         let loadingTitle = 'Working on it...';
         let alertTitle = '🔔 New Message'
+        let queueMessage = null;
         while (true) {
             document.title = loadingTitle;
             const { done, value } = await reader.read();
@@ -108,6 +109,16 @@ async function sendMessage() {
             }
             var chunk = decoder.decode(value, { stream: false });
             console.log('Received chunk:', chunk);
+            if (chunk.startsWith('⏳')) {
+                // queue position updates replace each other
+                if (queueMessage) queueMessage.remove();
+                queueMessage = createAIMessage(chunk);
+                continue;
+            }
+            if (queueMessage) {
+                queueMessage.remove();
+                queueMessage = null;
+            }
             createAIMessage(chunk);
         }
     } catch (error) {
@@ -86,7 +86,7 @@ async function deleteAccount() {
 }
 
 async function fixHistory(){
-    if(confirm('This will delete tool calls that do not have corresponding results. The conversation history will be truncated up to the deleted tool call. Proceed?')) {
+    if(confirm('This will close tool calls that do not have corresponding results by recording them as interrupted. Proceed?')) {
         switchMode();
         const header = {
             'Content-Type': 'application/json',
@@ -105,7 +105,7 @@ async function fixHistory(){
             } else if (data.response == 1) {
                 createSystemMessage('✅ Conversation history seems fine. No changes were made.');
             } else if (data.response == 2) {
-                createSystemMessage('🚧 Error-causing parts of the conversation history deleted. Try simplifying the question or asking it in another way.');
+                createSystemMessage('🚧 Interrupted tool calls were closed. Try simplifying the question or asking it in another way.');
             } else {
                 createSystemMessage('🚧 Unknown response code');
             }
@@ -129,6 +129,8 @@ function parse_usage_metadata(usage_metadata) {
         const reasonT = usage_metadata.output_token_details.reasoning || 0;
         const outputT = usage_metadata.output_tokens - reasonT || 0;
         const totalT = usage_metadata.total_tokens || 0;
+        // share of input tokens served from the provider's prompt cache
+        const cacheHit = usage_metadata.input_tokens ? 100 * cachedT / usage_metadata.input_tokens : 0;
         // based on GPT-5-mini pricing
         const inputCost = inputT * 2.5e-7 + cachedT * 2.5e-8;
         const outputCost = outputT * 2e-6;
@@ -145,7 +147,8 @@ function parse_usage_metadata(usage_metadata) {
                 <strong>💬💬 Running token usage</strong><br>
                 Input: ${inputT}&#9Cached: ${cachedT}<br>
                 Output: ${outputT}&#9Reasoning: ${reasonT}<br>
-                Total: ${totalT}
+                Total: ${totalT}<br>
+                Prompt cache hit: ${cacheHit.toFixed(1)}%
             </div>
         </div>`
     }
@@ -0,0 +1,139 @@
+import { getCookie } from './utils.js';
+import { createAIMessage, createSystemMessage } from './messages.js';
+import { isResponding } from './controls.js';
+
+const chatHistory = document.querySelector('div#chat-history');
+const threadList = document.querySelector('ul#thread-list');
+
+const headers = {
+    'Content-Type': 'application/json',
+    'Authorization': `Bearer ${getCookie('access_token')}`,
+}
+
+let currentThreadId = null;
+
+// Insert a previous user message into chat history
+function createUserMessage(message) {
+    const userMessageContainer = document.createElement('div');
+    userMessageContainer.classList.add('chat-message-container');
+    const userMessageElement = document.createElement('div');
+    userMessageElement.classList.add('chat-message', 'user');
+    userMessageElement.textContent = message;
+    userMessageContainer.appendChild(userMessageElement);
+    chatHistory.appendChild(userMessageContainer);
+}
+
+function renderMessages(messages) {
+    chatHistory.innerHTML = '';
+    if (messages.length == 0) {
+        createSystemMessage('💬 New conversation. Ask anything related to the CoMMpass dataset.');
+        return;
+    }
+    for (const message of messages) {
+        if (message.role == 'user') {
+            createUserMessage(message.content);
+        } else {
+            createAIMessage(message.content.replace(/\n/g, '<br>'));
+        }
+    }
+    chatHistory.scrollTop = chatHistory.scrollHeight;
+}
+
+function renderThreads(threads) {
+    threadList.innerHTML = '';
+    for (const thread of threads) {
+        const item = document.createElement('li');
+        item.classList.add('thread-item');
+        if (thread.thread_id == currentThreadId) item.classList.add('active');
+        const title = document.createElement('span');
+        title.classList.add('thread-title');
+        title.textContent = thread.title;
+        title.title = thread.title;
+        title.addEventListener('click', () => switchThread(thread.thread_id));
+        const deleteButton = document.createElement('button');
+        deleteButton.classList.add('thread-delete');
+        deleteButton.textContent = '🗑️';
+        deleteButton.title = 'Delete conversation';
+        deleteButton.addEventListener('click', () => deleteThread(thread.thread_id));
+        item.appendChild(title);
+        item.appendChild(deleteButton);
+        threadList.appendChild(item);
+    }
+}
+
+async function loadThreads() {
+    try {
+        const response = await fetch('/api/threads', {
+            method: 'GET',
+            headers: headers,
+        });
+        if (!response.ok) throw new Error('Failed to load conversations');
+        const data = await response.json();
+        currentThreadId = data.current;
+        renderThreads(data.threads);
+    } catch (error) {
+        console.error('Error:', error);
+    }
+}
+
+async function newThread() {
+    if (isResponding) return;
+    try {
+        const response = await fetch('/api/threads', {
+            method: 'POST',
+            headers: headers,
+        });
+        if (!response.ok) throw new Error('Failed to create conversation');
+        const data = await response.json();
+        currentThreadId = data.thread.thread_id;
+        renderMessages(data.messages);
+        await loadThreads();
+    } catch (error) {
+        console.error('Error:', error);
+        createSystemMessage(error);
+    }
+}
+
+async function switchThread(threadId) {
+    if (isResponding || threadId == currentThreadId) return;
+    try {
+        const response = await fetch(`/api/threads/${encodeURIComponent(threadId)}/switch`, {
+            method: 'POST',
+            headers: headers,
+        });
+        if (!response.ok) throw new Error('Failed to switch conversation');
+        const data = await response.json();
+        currentThreadId = data.thread.thread_id;
+        renderMessages(data.messages);
+        await loadThreads();
+    } catch (error) {
+        console.error('Error:', error);
+        createSystemMessage(error);
+    }
+}
+
+async function deleteThread(threadId) {
+    if (isResponding) return;
+    if (!confirm('Delete this conversation and its memory?')) return;
+    try {
+        const response = await fetch(`/api/threads/${encodeURIComponent(threadId)}`, {
+            method: 'DELETE',
+            headers: headers,
+        });
+        if (!response.ok) throw new Error('Failed to delete conversation');
+        const data = await response.json();
+        if (threadId == currentThreadId) {
+            // the server moved on to the most recent remaining conversation
+            currentThreadId = null;
+            await switchThread(data.current);
+        }
+        await loadThreads();
+    } catch (error) {
+        console.error('Error:', error);
+        createSystemMessage(error);
+    }
+}
+
+loadThreads();
+
+export { loadThreads, newThread, switchThread, deleteThread };
@@ -0,0 +1,131 @@
+import os
+import re
+import gzip
+import shutil
+import mimetypes
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# text files worth compressing ahead of time, images are already compressed
+COMPRESSIBLE_EXTENSIONS = ('.csv', '.tsv', '.txt', '.json', '.html', '.css', '.js', '.svg', '.md')
+PRECOMPRESS_MIN_BYTES = 1024
+# preferred first, brotli only if the package is installed
+ENCODINGS = ([('br', '.br')] if brotli else []) + [('gzip', '.gz')]
+# artifacts named after their content, see artifacts._content_path, never change once written
+CONTENT_ADDRESSED = re.compile(r'_([0-9a-f]{16})\.[^./]+$')
+IMMUTABLE = "public, max-age=31536000, immutable"
+CHUNK_SIZE = 1 << 20
+
+def _fresh(compressed: str, path: str) -> bool:
+    return os.path.exists(compressed) and os.path.getmtime(compressed) >= os.path.getmtime(path)
+
+def _accepted_encodings(header: str) -> dict[str, float]:
+    # input: Accept-Encoding header, e.g. "gzip;q=0.5, br, *;q=0"
+    # output: q value of each of ENCODINGS, 0 if not acceptable; unlisted encodings take the q value of *
+    qualities = {}
+    for item in header.split(','):
+        name, *params = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            qualities[name.lower()] = q
+    return {encoding: qualities.get(encoding, qualities.get('*', 0.0)) for encoding, _ in ENCODINGS}
+
+def precompress(path: str) -> list[str]:
+    # input: path of a file that will be served
+    # output: paths of its compressed copies, written next to it as <path>.br and <path>.gz
+    if not path.endswith(COMPRESSIBLE_EXTENSIONS) or os.path.getsize(path) < PRECOMPRESS_MIN_BYTES:
+        return []
+    written = []
+    for encoding, suffix in ENCODINGS:
+        target = path + suffix
+        written.append(target)
+        if _fresh(target, path):
+            continue
+        tmp = f'{target}.{os.getpid()}.tmp'
+        with open(path, 'rb') as src:
+            if encoding == 'br':
+                compressor = brotli.Compressor(quality=9)
+                with open(tmp, 'wb') as dst:
+                    while chunk := src.read(CHUNK_SIZE):
+                        dst.write(compressor.process(chunk))
+                    dst.write(compressor.finish())
+            else:
+                with gzip.open(tmp, 'wb', compresslevel=9) as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(tmp, target)
+    return written
+
+def precompress_tree(root: str) -> int:
+    # compress every eligible file under root, returns the number of compressed copies
+    n_files = 0
+    for folder, _, files in os.walk(root):
+        for file in files:
+            if not file.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                n_files += len(precompress(os.path.join(folder, file)))
+    return n_files
+
+def remove_precompressed(path: str) -> None:
+    for _, suffix in ENCODINGS:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+class CachedStaticFiles(StaticFiles):
+    # StaticFiles that serves precompressed copies to clients accepting them,
+    # marks content-addressed files as immutable with their digest as a strong ETag,
+    # and leaves byte ranges to FileResponse on the uncompressed file
+    def __init__(self, *args, cache_control: str = "no-cache", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def file_response(self, full_path: str, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        content_addressed = CONTENT_ADDRESSED.search(os.path.basename(full_path))
+        headers = {"Cache-Control": IMMUTABLE if content_addressed else self.cache_control, "Vary": "Accept-Encoding"}
+        media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+
+        path, encoding = full_path, None
+        # ranges refer to the uncompressed bytes
+        if "range" not in request_headers:
+            accepted = _accepted_encodings(request_headers.get("accept-encoding", ""))
+            # highest q value first, ties in the order of ENCODINGS
+            for candidate, suffix in sorted(ENCODINGS, key=lambda item: -accepted[item[0]]):
+                if accepted[candidate] > 0 and _fresh(full_path + suffix, full_path):
+                    path, encoding = full_path + suffix, candidate
+                    stat_result = os.stat(path)
+                    break
+        response = FileResponse(path, status_code=status_code, stat_result=stat_result, media_type=media_type, headers=headers)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if content_addressed:
+            response.headers["ETag"] = f'"{content_addressed.group(1)}-{encoding or "identity"}"'
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+if __name__ == "__main__":
+    # compress static assets ahead of time e.g. at deployment
+    # usage: python staticfiles.py DIR [DIR ...]
+    import sys
+    for root in sys.argv[1:]:
+        print(f"{root}: {precompress_tree(root)} compressed copies")
+
+__all__ = [
+    "CachedStaticFiles",
+    "precompress",
+    "precompress_tree",
+    "remove_precompressed",
+]
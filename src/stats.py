@@ -0,0 +1,68 @@
+import warnings
+import numpy as np
+
+# genes per block, bounds the float32 working memory to a few tens of MB
+CHUNK_SIZE = 4096
+
+def _median(x: np.ndarray) -> np.ndarray:
+    # row-wise median using partial sorting instead of a full sort
+    # NaN sorts last and would shift the partition, rows with missing values take the slower np.nanmedian
+    missing = np.isnan(x).any(axis=1)
+    if missing.any():
+        median = np.empty(len(x), dtype=x.dtype)
+        median[~missing] = _median(x[~missing])
+        with warnings.catch_warnings():
+            # all-NaN rows have a NaN median
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median[missing] = np.nanmedian(x[missing], axis=1)
+        return median
+    n = x.shape[1]
+    k = n // 2
+    if n % 2:
+        return np.partition(x, k, axis=1)[:, k]
+    part = np.partition(x, [k - 1, k], axis=1)
+    return (part[:, k - 1] + part[:, k]) / 2
+
+def median_mad(x: np.ndarray, chunk_size: int = CHUNK_SIZE) -> tuple[np.ndarray, np.ndarray]:
+    # input: matrix (G, N) e.g. log2(tpm+1) of G genes in N samples, may be a memory-mapped array
+    # output: median (G,) and unscaled median absolute deviation (G,) of each row, ignoring missing values
+    G = x.shape[0]
+    median = np.empty(G, dtype=np.float32)
+    mad = np.empty(G, dtype=np.float32)
+    if x.shape[1] == 0:
+        median[:], mad[:] = np.nan, np.nan
+        return median, mad
+    for i in range(0, G, chunk_size):
+        block = np.asarray(x[i:i + chunk_size], dtype=np.float32)
+        median[i:i + chunk_size] = _median(block)
+        mad[i:i + chunk_size] = _median(np.abs(block - median[i:i + chunk_size, None]))
+    return median, mad
+
+def zscore_rows(x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # input: matrix (G, N)
+    # output: float32 z-scores of the rows without missing values and with non-zero variance, and the boolean mask of those rows (G,)
+    x = np.asarray(x, dtype=np.float32)
+    sd = x.std(axis=1, ddof=1) if x.shape[1] > 1 else np.zeros(len(x), dtype=np.float32)
+    keep = np.isfinite(x).all(axis=1) & (sd > 0)
+    x = x[keep]
+    return (x - x.mean(axis=1, keepdims=True)) / sd[keep, None], keep
+
+def benjamini_hochberg(p: np.ndarray) -> np.ndarray:
+    # Benjamini-Hochberg adjusted p values (q values), NaN p values are left as NaN
+    p = np.asarray(p, dtype=np.float64)
+    q = np.full(p.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p))
+    order = valid[np.argsort(p[valid])]
+    m = len(order)
+    if m == 0:
+        return q
+    ranked = p[order] * m / np.arange(1, m + 1)
+    # enforce monotonicity from the largest p value downwards
+    q[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return q
+
+__all__ = [
+    "benjamini_hochberg",
+    "median_mad",
+    "zscore_rows",
+]
@@ -0,0 +1,185 @@
+import os
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import chi2, norm
+
+from refdata import load_refdata
+from stats import benjamini_hochberg
+
+ENDPOINT_COLUMNS = {'os': ('oscdy', 'censos'), 'pfs': ('pfscdy', 'censpfs')}
+CHUNK_SIZE = 1024
+
+@lru_cache(maxsize=2)
+def load_survival(endpoint: str) -> pd.DataFrame:
+    # right-censored survival from refdata/{endpoint}.csv indexed by public_id, columns time and event
+    if endpoint not in ENDPOINT_COLUMNS:
+        raise ValueError('endpoint must be either "os" or "pfs"')
+    time_col, event_col = ENDPOINT_COLUMNS[endpoint]
+    df = load_refdata(f'{endpoint}.csv').dropna()
+    df = df.rename(columns={time_col: 'time', event_col: 'event'})
+    df['public_id'] = df['public_id'].str.upper()
+    return df.set_index('public_id')[['time', 'event']].astype({'time': float, 'event': bool})
+
+def risk_tables(time: np.ndarray, event: np.ndarray, membership: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # input: times (N,), events (N,), group membership (..., K, N) boolean, leading dimensions are batched
+    # output: distinct event times (J,), numbers at risk (..., K, J) and events (..., K, J) at those times
+    order = np.argsort(time, kind='stable')
+    time, event = time[order], event[order].astype(bool)
+    member = membership[..., order].astype(np.float64)
+    event_times = np.unique(time[event])
+    # at risk: members with time >= t, i.e. from the first sample at t to the end
+    first = np.searchsorted(time, event_times, side='left')
+    last = np.searchsorted(time, event_times, side='right')
+    total = np.cumsum(member, axis=-1)
+    total = np.concatenate([np.zeros_like(total[..., :1]), total], axis=-1)
+    at_risk = total[..., -1:] - total[..., first]
+    # events: members with an event at exactly t
+    events = np.cumsum(member * event, axis=-1)
+    events = np.concatenate([np.zeros_like(events[..., :1]), events], axis=-1)
+    n_events = events[..., last] - events[..., first]
+    return event_times, at_risk, n_events
+
+def logrank_statistic(at_risk: np.ndarray, events: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # input: risk tables (..., K, J) from risk_tables
+    # output: log-rank chi-square statistic (...) with K-1 degrees of freedom and its p value
+    n = at_risk.sum(axis=-2, keepdims=True)
+    d = events.sum(axis=-2, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = np.where(n > 0, at_risk / n, 0)
+        scale = np.where(n > 1, d * (n - d) / (n - 1), 0)
+    observed_minus_expected = (events - d * share).sum(axis=-1)
+    # covariance of O - E across groups
+    K = at_risk.shape[-2]
+    cov = np.einsum('...kj,...j->...k', share, scale[..., 0, :])[..., :, None] * np.eye(K) \
+        - np.einsum('...kj,...lj,...j->...kl', share, share, scale[..., 0, :])
+    # one group is redundant as O - E sums to zero
+    oe, v = observed_minus_expected[..., :-1], cov[..., :-1, :-1]
+    stat = np.einsum('...k,...k->...', oe, np.linalg.solve(v, oe[..., None])[..., 0]) if K > 2 else oe[..., 0] ** 2 / v[..., 0, 0]
+    return stat, chi2.sf(stat, K - 1)
+
+def kaplan_meier(event_times: np.ndarray, at_risk: np.ndarray, events: np.ndarray) -> pd.DataFrame:
+    # input: risk tables (K, J) from risk_tables
+    # output: long table with group index, time, at_risk, events, survival and 95% confidence interval
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hazard = np.where(at_risk > 0, events / at_risk, 0)
+        survival = np.cumprod(1 - hazard, axis=-1)
+        greenwood = np.cumsum(np.where(at_risk > events, events / (at_risk * (at_risk - events)), 0), axis=-1)
+        # exponential Greenwood interval on log(-log S), as in lifelines
+        log_log = np.log(-np.log(survival))
+        half_width = norm.ppf(0.975) * np.sqrt(greenwood) / np.abs(np.log(survival))
+        lower = np.exp(-np.exp(log_log + half_width))
+        upper = np.exp(-np.exp(log_log - half_width))
+    K, J = at_risk.shape
+    return pd.DataFrame({
+        'group': np.repeat(np.arange(K), J),
+        'time': np.tile(event_times, K),
+        'at_risk': at_risk.ravel().astype(int),
+        'events': events.ravel().astype(int),
+        'survival': survival.ravel(),
+        'lower95': lower.ravel(),
+        'upper95': upper.ravel(),
+    })
+
+def median_survival(km: pd.DataFrame) -> pd.Series:
+    # earliest time at which survival drops to 0.5 or below per group, NaN if never reached
+    reached = km[km['survival'] <= 0.5]
+    return reached.groupby('group')['time'].min().reindex(km['group'].unique())
+
+def survival_by_group(endpoint: str, groups: pd.Series) -> dict:
+    # input: endpoint 'os' or 'pfs', group labels indexed by public id
+    # output: dict with per-group summary, KM table and log-rank p value
+    surv = load_survival(endpoint)
+    groups = groups.dropna()
+    groups = groups[groups.index.isin(surv.index)]
+    labels = sorted(groups.unique(), key=str)
+    if len(labels) < 2:
+        raise ValueError('at least two groups with survival data are required')
+    surv = surv.loc[groups.index]
+    membership = np.stack([(groups == label).to_numpy() for label in labels])
+    event_times, at_risk, events = risk_tables(surv['time'].to_numpy(), surv['event'].to_numpy(), membership)
+    stat, p = logrank_statistic(at_risk, events)
+
+    km = kaplan_meier(event_times, at_risk, events)
+    medians = median_survival(km)
+    km['group'] = km['group'].map(dict(enumerate(labels)))
+    summary = pd.DataFrame({
+        'group': labels,
+        'n': membership.sum(axis=1),
+        'events': events.sum(axis=1).astype(int),
+        'median_survival_days': medians.to_numpy(),
+    })
+    # prepend time zero so curves start at 1
+    start = pd.DataFrame({'group': labels, 'time': 0.0, 'at_risk': membership.sum(axis=1), 'events': 0,
+                          'survival': 1.0, 'lower95': 1.0, 'upper95': 1.0})
+    km = pd.concat([start, km], ignore_index=True).sort_values(['group', 'time'], kind='stable')
+    return {'summary': summary, 'km': km, 'statistic': float(stat), 'p': float(p)}
+
+def _scan_chunk(high: np.ndarray, time: np.ndarray, event: np.ndarray) -> np.ndarray:
+    # input: high-expression indicator (G, N), times (N,) and events (N,)
+    # output: (G, 7) array of statistic, p, events high, events low, median high, median low, O-E of high
+    membership = np.stack([high, ~high], axis=1)
+    event_times, at_risk, events = risk_tables(time, event, membership)
+    stat, p = logrank_statistic(at_risk, events)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        survival = np.cumprod(1 - np.where(at_risk > 0, events / at_risk, 0), axis=-1)
+    # first event time at which survival drops to 0.5 or below
+    reached = survival <= 0.5
+    medians = np.where(reached.any(axis=-1), event_times[reached.argmax(axis=-1)], np.nan)
+    n, d = at_risk.sum(axis=1), events.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = np.where(n > 0, d * at_risk[:, 0] / n, 0).sum(axis=-1)
+    n_events = events.sum(axis=-1)
+    return np.column_stack([stat, p, n_events[:, 0], n_events[:, 1], medians[:, 0], medians[:, 1], n_events[:, 0] - expected])
+
+def logrank_scan(genes: np.ndarray, public_ids: np.ndarray, log2tpm: np.ndarray, endpoint: str,
+                 workers: int | None = None) -> pd.DataFrame:
+    # input: gene ids (G,), public ids (N,), log2(tpm+1) matrix (G, N) and endpoint 'os' or 'pfs'
+    # output: one median-split log-rank test per gene, ordered by p value
+    surv = load_survival(endpoint)
+    in_cohort = pd.Index(public_ids).isin(surv.index)
+    surv = surv.loc[np.asarray(public_ids)[in_cohort]]
+    x = np.asarray(log2tpm)[:, in_cohort]
+    high = x > np.median(x, axis=1, keepdims=True)
+    # genes that cannot be split into two non-empty groups are skipped
+    keep = high.any(axis=1) & ~high.all(axis=1)
+    genes, high = np.asarray(genes)[keep], high[keep]
+    args = (surv['time'].to_numpy(), surv['event'].to_numpy())
+    chunks = [high[i:i + CHUNK_SIZE] for i in range(0, len(high), CHUNK_SIZE)]
+
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(chunks) > 1:
+        # spawn rather than fork, as the server process runs threads
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=get_context('spawn')) as pool:
+            results = list(pool.map(_scan_chunk, chunks, *[[a] * len(chunks) for a in args]))
+    else:
+        results = [_scan_chunk(chunk, *args) for chunk in chunks]
+    results = np.concatenate(results) if results else np.empty((0, 7))
+
+    df = pd.DataFrame({
+        'gene': genes,
+        'n_high': high.sum(axis=1),
+        'n_low': (~high).sum(axis=1),
+        'events_high': results[:, 2].astype(int),
+        'events_low': results[:, 3].astype(int),
+        'median_survival_high': results[:, 4],
+        'median_survival_low': results[:, 5],
+        # observed minus expected events in the high group; > 0 means high expression has worse survival
+        'o_minus_e_high': results[:, 6],
+        'chisq': results[:, 0],
+        'p': results[:, 1],
+    })
+    df['q'] = benjamini_hochberg(df['p'].to_numpy())
+    return df.sort_values('p').reset_index(drop=True)
+
+__all__ = [
+    "kaplan_meier",
+    "load_survival",
+    "logrank_scan",
+    "logrank_statistic",
+    "median_survival",
+    "risk_tables",
+    "survival_by_group",
+]
@@ -0,0 +1,139 @@
+import uuid
+import psycopg
+from fastapi import HTTPException, status
+
+from variables import COMMPASS_AUTH_DSN, COMMPASS_MEMORY_DB_URI
+
+DEFAULT_THREAD_TITLE = "New conversation"
+
+# conversation threads owned by each user
+# the thread_id is the langgraph checkpointer thread_id
+# the legacy single thread of a user has thread_id equal to the username
+def setup_threads_table() -> None:
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS auth.threads (
+                    thread_id TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS threads_username_updated_at_idx ON auth.threads (username, updated_at DESC)")
+            conn.commit()
+
+
+def _row_to_dict(row) -> dict:
+    return {"thread_id": row[0], "title": row[1], "created_at": row[2].isoformat(), "updated_at": row[3].isoformat()}
+
+
+def create_thread(username: str, title: str = DEFAULT_THREAD_TITLE, thread_id: str | None = None) -> dict:
+    thread_id = thread_id or f"{username}:{uuid.uuid4().hex[:12]}"
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            try:
+                cur.execute(
+                    "INSERT INTO auth.threads (thread_id, username, title) VALUES (%s, %s, %s) "
+                    "ON CONFLICT (thread_id) DO NOTHING "
+                    "RETURNING thread_id, title, created_at, updated_at",
+                    (thread_id, username, title.strip() or DEFAULT_THREAD_TITLE),
+                )
+                row = cur.fetchone()
+                conn.commit()
+            except Exception as e_threaddb:
+                conn.rollback()
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to create thread. Error: " + str(e_threaddb))
+    if row is None:
+        return get_thread(username, thread_id)
+    return _row_to_dict(row)
+
+
+def list_threads(username: str) -> list[dict]:
+    # most recently used first; users start with their legacy thread
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT thread_id, title, created_at, updated_at FROM auth.threads WHERE username = %s ORDER BY updated_at DESC",
+                (username,),
+            )
+            rows = cur.fetchall()
+    if not rows:
+        return [create_thread(username, thread_id=username)]
+    return [_row_to_dict(row) for row in rows]
+
+
+def get_thread(username: str, thread_id: str) -> dict:
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT thread_id, title, created_at, updated_at FROM auth.threads WHERE username = %s AND thread_id = %s",
+                (username, thread_id),
+            )
+            row = cur.fetchone()
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Thread {thread_id} not found.")
+    return _row_to_dict(row)
+
+
+def touch_thread(thread_id: str, title: str | None = None) -> None:
+    # mark the thread as most recently used, and name it after its first question
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE auth.threads SET updated_at = now(), "
+                "title = CASE WHEN title = %s AND %s::text IS NOT NULL THEN %s::text ELSE title END "
+                "WHERE thread_id = %s",
+                (DEFAULT_THREAD_TITLE, title, title, thread_id),
+            )
+            conn.commit()
+
+
+def delete_checkpoints(thread_ids: list[str]) -> None:
+    # remove the conversation history of the given threads
+    with psycopg.connect(COMMPASS_MEMORY_DB_URI) as conn:
+        with conn.cursor() as cur:
+            try:
+                cur.execute("DELETE FROM checkpoints.checkpoints WHERE thread_id = ANY(%s)", (thread_ids,))
+                cur.execute("DELETE FROM checkpoints.checkpoint_writes WHERE thread_id = ANY(%s)", (thread_ids,))
+                cur.execute("DELETE FROM checkpoints.checkpoint_blobs WHERE thread_id = ANY(%s)", (thread_ids,))
+                conn.commit()
+            except Exception as e_memorydb:
+                conn.rollback()
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to erase memory. Error: " + str(e_memorydb))
+
+
+def delete_threads(username: str, thread_ids: list[str] | None = None) -> list[str]:
+    # delete the given threads of a user, or all of them, including their conversation history
+    with psycopg.connect(COMMPASS_AUTH_DSN) as conn:
+        with conn.cursor() as cur:
+            if thread_ids is None:
+                cur.execute("DELETE FROM auth.threads WHERE username = %s RETURNING thread_id", (username,))
+            else:
+                cur.execute("DELETE FROM auth.threads WHERE username = %s AND thread_id = ANY(%s) RETURNING thread_id", (username, thread_ids))
+            deleted = [row[0] for row in cur.fetchall()]
+            conn.commit()
+    # the legacy thread may have history without a row in auth.threads
+    if thread_ids is None and username not in deleted:
+        deleted.append(username)
+    delete_checkpoints(deleted)
+    return deleted
+
+
+def user_thread_ids(username: str) -> list[str]:
+    return [thread["thread_id"] for thread in list_threads(username)]
+
+
+__all__ = [
+    "DEFAULT_THREAD_TITLE",
+    "create_thread",
+    "delete_threads",
+    "get_thread",
+    "list_threads",
+    "setup_threads_table",
+    "touch_thread",
+    "user_thread_ids",
+]
@@ -1,18 +1,53 @@
 import os
-import re
-import uuid
-import psycopg
+import asyncio
+import numpy as np
 import pandas as pd
 from typing import Optional
 from langchain.tools import BaseTool
-from langchain_core.callbacks import CallbackManagerForToolRun
+from langchain_core.callbacks import AsyncCallbackManagerForToolRun, CallbackManagerForToolRun
 
-from variables import COMMPASS_DSN
-from vectorstore import connect_store
+from artifacts import find_artifact, new_artifact_path, register_artifact, save_artifact
+from clustering import METHODS, METRICS, cluster_matrix
+from cohort import resolve_groups, resolve_patients
+from coxph import coxph_genes
+from diffexpr import TESTS as DE_TESTS
+from diffexpr import differential_expression
+from expression import iter_first_visit_log2tpm, load_first_visit_log2tpm
+from plots import PLOT_FORMATS, PLOT_KINDS, arender_plot, make_preview, render_plot
+from refdata import load_refdata, refdata_index
+from replicas import arun_read, run_read
+from sql import QueryRejected, aexport_query, export_query, normalize_query, trial_run
+from stats import median_mad, zscore_rows
+from survival import logrank_scan, survival_by_group
+from vectorstore import aconnect_store, connect_store
 
 filedir = os.path.dirname(os.path.abspath(__file__))
 
-gene_annot = pd.read_csv(f'{filedir}/../refdata/gene_annotation.tsv', sep='\t', dtype={'chromosome':'str'})
+gene_annot = load_refdata('gene_annotation.tsv')
+# rows of a clustered heatmap, larger sets take long to cluster and are unreadable
+CLUSTER_MAX_GENES = 5000
+
+def resolve_gene_list(genes: str) -> list[str] | None:
+    # input: 'all', 'proteincoding', 'mad:N' for the N genes with the highest cohort-wide MAD,
+    #   the path to a csv file with an ensg or gene column, or comma-separated Ensembl gene IDs
+    # output: list of Ensembl gene IDs, None for all genes
+    if genes == 'all':
+        return None
+    if genes == 'proteincoding':
+        return load_refdata('protein_coding_genes.csv')['ensg'].tolist()
+    if genes.lower().startswith('mad:'):
+        n = genes.split(':', 1)[1].strip()
+        if not n.isdigit():
+            raise ValueError(f"'{genes}' is not of the form mad:N with N a number of genes.")
+        n = int(n)
+        return load_refdata('gene_log2tpm_mad.csv').nlargest(n, 'mad_log2')['gene'].tolist()
+    if genes.lower().endswith('.csv'):
+        if not os.path.exists(genes):
+            raise ValueError(f"gene list file {genes} does not exist.")
+        df_genes = pd.read_csv(genes)
+        gene_col = next((col for col in df_genes.columns if col.lower() in ['ensg', 'gene', 'gene_stable_id']), df_genes.columns[0])
+        return df_genes[gene_col].astype(str).tolist()
+    return [gene.strip() for gene in genes.split(',')]
 
 class ConvertGeneTool(BaseTool):
     name:str = "convert_gene_name_to_accession"
@@ -29,13 +64,13 @@ class ConvertGeneTool(BaseTool):
     def _convert_gene(self, gene_name: str):
         if gene_name.startswith("ENSG"):
             return f"Error: '{gene_name}' appears to be a Gene stable ID."
-        gene_row = self.gene_annot['gene_symbol'] == gene_name
-        if gene_row.sum() == 0:
+        gene_rows = refdata_index('gene_annotation.tsv', 'gene_symbol').get(gene_name, [])
+        if len(gene_rows) == 0:
             return f"Error: '{gene_name}' not a valid Gene name in the database. Try running SQL query on the `hgnc_nomenclature` table to convert to formal gene name."
-        elif gene_row.sum() > 1:
+        elif len(gene_rows) > 1:
             return f"Error: '{gene_name}' is ambiguous and maps to multiple Gene stable IDs in the database."
         else:
-            gene_id = self.gene_annot[gene_row]['gene_stable_id'].values[0]
+            gene_id = self.gene_annot['gene_stable_id'].iloc[gene_rows[0]]
             if not pd.isna(gene_id):
                 return gene_id
             else:
@@ -49,6 +84,15 @@ class ConvertGeneTool(BaseTool):
         """Use the tool."""
         return self._convert_gene(query)
 
+    async def _arun(
+            self,
+            query: str,
+            run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ):
+        """Use the tool asynchronously."""
+        # in-memory lookup, no need for a worker thread
+        return self._convert_gene(query)
+
 
 class GeneMetadataTool(BaseTool):
     name: str = "get_gene_metadata"
@@ -65,7 +109,7 @@ class GeneMetadataTool(BaseTool):
     def _get_metadata(self, gene_id: str):
         if not gene_id.startswith("ENSG"):
             return f"Error: '{gene_id}' does not appear to be a valid Gene stable ID."
-        gene_info = self.gene_annot[self.gene_annot['gene_stable_id'] == gene_id]
+        gene_info = self.gene_annot.iloc[refdata_index('gene_annotation.tsv', 'gene_stable_id').get(gene_id, [])]
         if not gene_info.empty:
             info_dict = gene_info.iloc[0].to_dict()
             return f"Gene Metadata for {gene_id}:\n" + "\n".join([f"{key}: {value}" for key, value in info_dict.items()])
@@ -80,37 +124,99 @@ class GeneMetadataTool(BaseTool):
         """Use the tool."""
         return self._get_metadata(query)
 
+    async def _arun(
+            self,
+            query: str,
+            run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ):
+        """Use the tool asynchronously."""
+        return self._get_metadata(query)
+
+class TrialSQLTool(BaseTool):
+    # replaces langchain's QuerySQLDatabaseTool under the same name and output format
+    name: str = "sql_db_query"
+    description: str = (
+        "Execute a SQL query against the database and get back the result. "
+        "If the query is not correct, an error message will be returned. "
+        "If an error is returned, rewrite the query, check the query, and try again. "
+        "This is the trial run: end the query with a LIMIT clause. "
+        "Queries with a missing join condition or a very high estimated cost are rejected with an explanation before they run. "
+        "Small results are kept, so running the same query without the LIMIT in execute_full_sql_query_with_python afterwards is instant."
+    )
+
+    def _format_result(self, rows: list[tuple], truncated: bool) -> str:
+        # same shape as SQLDatabase.run: a list of tuples, long strings truncated
+        rows = [tuple(value[:300] + '...' if isinstance(value, str) and len(value) > 300 else value for value in row) for row in rows]
+        if not rows:
+            return ""
+        return str(rows) + (" (truncated, add a LIMIT clause)" if truncated else "")
+
+    def _run(
+            self,
+            query: str,
+            run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool."""
+        try:
+            _, rows, truncated = trial_run(query)
+        except Exception as e:
+            return f"Error: {e}"
+        return self._format_result(rows, truncated)
+
+
 class PythonSQLTool(BaseTool):
     name: str = "execute_full_sql_query_with_python"
     description:str = (
         "Executes the full SQL query using python without the trial-run LIMIT clause"
-        "and saves the results to disk. Run this after the query has been tested using the QuerySQLDatabaseTool."
+        "and saves the results to disk. Run this after the query has been tested using the sql_db_query tool."
         "Can take some time to run especially when querying the `expr` table"
         "because the `expr` table has 60,000+ rows and 1000+ columns."
-        "Useful for extracting full results, compared to QuerySQLDatabaseTool which is just a trial run."
+        "For gene expression values, slicing genes and samples in the python REPL with `expression.open_expression_store` is much faster."
+        "Useful for extracting full results, compared to sql_db_query which is just a trial run."
     )
 
-    def _execute_sql_query_with_python(self, query: str):
-        conn = psycopg.connect(COMMPASS_DSN)
-        with conn.cursor() as curs:
-            curs.execute(re.sub(r'LIMIT \d+', '', query, flags=re.IGNORECASE))
-            result = curs.fetchall()
-            df = pd.DataFrame(result, columns=[desc[0] for desc in curs.description])
-            conn.close()
-        if not df.empty:
-            result_csv_filename = f"result/result_{uuid.uuid4().hex[:8]}.csv"
-            df.to_csv(result_csv_filename, index=False)
-            return f"Query results saved to output file {result_csv_filename}."
+    def _result_message(self, csv_path: str, n_rows: int):
+        if n_rows:
+            return f"Query results saved to output file {csv_path}."
         else:
             return "Query returned no results. No output file created."
-        
+
     def _run(
             self,
             query: str,
             run_manager: Optional[CallbackManagerForToolRun] = None,
     ):
         """Use the tool."""
-        return self._execute_sql_query_with_python(query)
+        # the same query exported earlier by the user is not run again
+        reuse_key = f"sql:{normalize_query(query)}"
+        if csv_path := find_artifact(reuse_key):
+            return self._result_message(csv_path, 1)
+        csv_path = new_artifact_path("result", "result", ".csv")
+        try:
+            n_rows = export_query(query, csv_path)
+        except QueryRejected as e:
+            return f"Error: {e}"
+        if n_rows:
+            csv_path = register_artifact(csv_path, reuse_key)
+        return self._result_message(csv_path, n_rows)
+
+    async def _arun(
+            self,
+            query: str,
+            run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ):
+        """Use the tool asynchronously."""
+        reuse_key = f"sql:{normalize_query(query)}"
+        if csv_path := await asyncio.to_thread(find_artifact, reuse_key):
+            return self._result_message(csv_path, 1)
+        csv_path = new_artifact_path("result", "result", ".csv")
+        try:
+            n_rows = await aexport_query(query, csv_path)
+        except QueryRejected as e:
+            return f"Error: {e}"
+        if n_rows:
+            csv_path = await asyncio.to_thread(register_artifact, csv_path, reuse_key)
+        return self._result_message(csv_path, n_rows)
 
 
 # similarity search against our vector store
@@ -125,6 +231,12 @@ class DocumentSearchTool(BaseTool):
         "Always start with the minimum k of 1. Only if the 1st table does not contain required fields should k be increased to 2, then 3. Maximum k is 3."
     )
     
+    def _format_results(self, results: list, k: int) -> str:
+        if results:
+            return f"The top {k} table(s) with the best match: <div class=\"scrollable lightaccent codeblock\">{[doc.page_content for doc in results]}</div>"
+        else:
+            return "No tables with relevant fields found"
+
     def _run(
         self,
         query: str,
@@ -135,10 +247,19 @@ class DocumentSearchTool(BaseTool):
         k = max(1, min(k, 3))  # constrain k between 1 and 3
         store = connect_store()
         results = store.similarity_search(query, k=k)
-        if results:
-            return f"The top {k} table(s) with the best match: <div class=\"scrollable lightaccent codeblock\">{[doc.page_content for doc in results]}</div>"
-        else:
-            return "No tables with relevant fields found"
+        return self._format_results(results, k)
+
+    async def _arun(
+        self,
+        query: str,
+        k: int = 1,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool asynchronously."""
+        k = max(1, min(k, 3))  # constrain k between 1 and 3
+        store = await aconnect_store()
+        results = await store.asimilarity_search(query, k=k)
+        return self._format_results(results, k)
 
 
 
@@ -147,7 +268,7 @@ class GenerateGraphFilepathTool(BaseTool):
     description: str = (
         "Generates a unique file path to save the plot image in PNG format."
         "No arguments required."
-        "Returns a file path string like 'graph/graph_ab12cd34.png'."
+        "Returns a file path string like 'graph/0123456789abcdef/graph_ab12cd34.png'."
     )
     
     def _run(
@@ -155,9 +276,16 @@ class GenerateGraphFilepathTool(BaseTool):
         run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> str:
         """Use the tool."""
-        plot_file_path = f"graph/graph_{uuid.uuid4().hex[:8]}.png"
+        plot_file_path = new_artifact_path("graph", "graph", ".png")
         return plot_file_path
 
+    async def _arun(
+        self,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool asynchronously."""
+        return self._run()
+
 
 
 class DisplayPlotTool(BaseTool):
@@ -167,6 +295,19 @@ class DisplayPlotTool(BaseTool):
         "Arguments: file_path (str). If file path does not exist, an error message is returned. "
         "Thus, the plot must first be saved as file_path before this plot tool is called."
     )
+
+    def _html(self, image_path: str, full_path: str) -> str:
+        # the chat shows image_path, the links open full_path
+        html = f"""
+        <div class=image-container>
+            <img src={image_path} width=100% height=auto>
+            <div class=links-container>
+                <a href={full_path} download>Download</a>
+                <a href={full_path} target=_blank rel=noopener noreferrer>New tab</a>
+            </div>
+        </div>
+        """
+        return html.replace('\n', '')
     
     def _run(
         self,
@@ -177,16 +318,93 @@ class DisplayPlotTool(BaseTool):
         if not os.path.exists(file_path):
             return f"Error: Path for PNG file {file_path} does not exist. Rename the newly generated PNG to {file_path}, or re-generate and save to {file_path}."
         else:
-            html = f"""
-            <div class=image-container>
-                <img src={file_path} width=100% height=auto>
-                <div class=links-container>
-                    <a href={file_path} download>Download</a>
-                    <a href={file_path} target=_blank rel=noopener noreferrer>New tab</a>
-                </div>
-            </div>
-            """
-            return html.replace('\n', '')
+            # keep the name, the REPL may overwrite the plot and display it again
+            register_artifact(file_path, content_address=False)
+            # large images are embedded downscaled, the links keep the original
+            return self._html(make_preview(file_path), file_path)
+
+    async def _arun(
+        self,
+        file_path: str,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool asynchronously."""
+        return self._run(file_path)
+
+
+class RenderPlotTool(BaseTool):
+    name: str = "render_plot"
+    description: str = (
+        "Render a standard plot from a csv file and display it, without writing plotting code. Much faster than plotting in the python REPL. "
+        f"Arguments: kind (str), one of {', '.join(PLOT_KINDS)}; data (str), path of the csv file; "
+        "x, y (str), column names: for box the grouping and value columns, for volcano the effect size (e.g. log2 fold change or coef) and p value columns; "
+        "group (str, km only), the group column, default 'group', with time and survival columns as written by survival_analysis; "
+        "label (str, volcano only), column naming the points, the top 10 hits are labelled; "
+        "zscore (bool, heatmap only), z-score each row, the first column holds the row labels and the other numeric columns are plotted; "
+        "title, xlabel, ylabel (str, optional); formats (str, optional), comma-separated extra formats webp and/or svg besides png. "
+        "Returns a preview of the plot as HTML, with links to the full resolution image and the extra formats. "
+        "Not suitable for: other kinds of plots -> use generate_graph_filepath, the python REPL and display_plot_html."
+    )
+
+    def _spec(self, kind: str, data: str, x: str, y: str, group: str, label: str, zscore: bool,
+              title: str, xlabel: str, ylabel: str, formats: str) -> dict:
+        spec = {'kind': kind.strip().lower(), 'data': data.strip(), 'zscore': zscore,
+                'formats': ['png'] + [fmt.strip().lower() for fmt in formats.split(',') if fmt.strip()]}
+        for key, value in (('x', x), ('y', y), ('group', group), ('label', label), ('title', title), ('xlabel', xlabel), ('ylabel', ylabel)):
+            if value.strip():
+                spec[key] = value.strip()
+        return spec
+
+    def _format_result(self, preview: str, formats: list[str]) -> str:
+        # the preview is embedded, full resolution images are rendered when a link is opened
+        extra = ''.join(f'<a href=/api/plot_full?preview={preview}&format={fmt} download>{fmt.upper()}</a>' for fmt in dict.fromkeys(formats) if fmt in PLOT_FORMATS and fmt != 'png')
+        return DisplayPlotTool()._html(preview, f'/api/plot_full?preview={preview}&format=png') + (f'<div class=links-container>{extra}</div>' if extra else '')
+
+    def _run(
+        self,
+        kind: str,
+        data: str,
+        x: str = '',
+        y: str = '',
+        group: str = '',
+        label: str = '',
+        zscore: bool = False,
+        title: str = '',
+        xlabel: str = '',
+        ylabel: str = '',
+        formats: str = '',
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool."""
+        try:
+            spec = self._spec(kind, data, x, y, group, label, zscore, title, xlabel, ylabel, formats)
+            preview = render_plot(spec)['png']
+        except Exception as e:
+            return f"Error: {e}"
+        return self._format_result(preview, spec['formats'])
+
+    async def _arun(
+        self,
+        kind: str,
+        data: str,
+        x: str = '',
+        y: str = '',
+        group: str = '',
+        label: str = '',
+        zscore: bool = False,
+        title: str = '',
+        xlabel: str = '',
+        ylabel: str = '',
+        formats: str = '',
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool asynchronously."""
+        try:
+            spec = self._spec(kind, data, x, y, group, label, zscore, title, xlabel, ylabel, formats)
+            preview = (await arender_plot(spec))['png']
+        except Exception as e:
+            return f"Error: {e}"
+        return self._format_result(preview, spec['formats'])
 
 
 class GeneCopyNumberTool(BaseTool):
@@ -202,13 +420,8 @@ class GeneCopyNumberTool(BaseTool):
         "Example output: public_id=MMRF_1016, sample=MMRF_1016_1_BM_CD138pos, chromosome=chr1, start_pos=149053976, end_pos=155975058, num_probes=700, segment_mean=0.499688, visit=1, segment_copy_number_status=1, overlap_len=46319."
     )
 
-    def _max_overlapping_segment(self, gene_stable_id: str):
-        import os
-        import psycopg
-        import pandas as pd
-        # disable SettingWithCopyWarning
-        pd.options.mode.chained_assignment = None  # default='warn'
-
+    def _segment_queries(self, gene_stable_id: str) -> tuple[list[tuple[str, tuple]], int, int]:
+        # the segments of the gene's chromosome, and the segments in each overlap case, with the gene start and end
         global gene_annot
 
         gene_of_interest_annot = gene_annot[gene_annot['Gene stable ID'] == gene_stable_id].iloc[0]
@@ -220,49 +433,69 @@ class GeneCopyNumberTool(BaseTool):
         # sort by overlap length between probe and gene
         #  PROBE =====1    |     =====2 |  =====3         |           ====4  |     ===5       |  ==========6
         #  GENES   =====1  |  =====2    |          ====3  |  =====4          |  ===========5. |.    ====6
-        conn = psycopg.connect(COMMPASS_DSN)
-        with conn.cursor() as curs:
-            curs.execute('SELECT * FROM genome_gatk_cna WHERE chromosome = %s', (gc,))
-            result = curs.fetchall()
-            cn_chrom = pd.DataFrame(result, columns=[desc[0] for desc in curs.description])
-            curs.execute('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND start_pos < %s AND end_pos > %s AND end_pos < %s', (gc,gs,gs,ge))
-            result = curs.fetchall()
-            df_case1 = pd.DataFrame(result, columns=[desc[0] for desc in curs.description])
-            curs.execute('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND start_pos > %s AND start_pos < %s AND end_pos > %s', (gc,gs,ge,ge))
-            result = curs.fetchall()
-            df_case2 = pd.DataFrame(result, columns=[desc[0] for desc in curs.description])
-            curs.execute('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND end_pos < %s', (gc,gs))
-            result = curs.fetchall()
-            df_case3 = pd.DataFrame(result, columns=[desc[0] for desc in curs.description])
-            curs.execute('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND start_pos > %s', (gc,ge))
-            result = curs.fetchall()
-            df_case4 = pd.DataFrame(result, columns=[desc[0] for desc in curs.description])        
-            curs.execute('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND start_pos > %s AND end_pos < %s', (gc,gs,ge))
-            result = curs.fetchall()
-            df_case5 = pd.DataFrame(result, columns=[desc[0] for desc in curs.description])
-            curs.execute('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND start_pos < %s AND end_pos > %s', (gc,gs,ge))
-            result = curs.fetchall()
-            df_case6 = pd.DataFrame(result, columns=[desc[0] for desc in curs.description])
-            conn.close()
-
-            # cases 1 to 6 should be all inclusive
-            assert len(df_case1) + len(df_case2) + len(df_case3) + len(df_case4) + len(df_case5) + len(df_case6) == len(cn_chrom)
-
-            # calculate overlap lengths
-            df_case1.loc[:,'overlap_len'] = df_case1['end_pos'] - gs + 1
-            df_case2.loc[:,'overlap_len'] = ge - df_case2['start_pos'] + 1
-            df_case5.loc[:,'overlap_len'] = df_case5['end_pos'] - df_case5['start_pos'] + 1
-            df_case6.loc[:,'overlap_len'] = ge - gs + 1
-
-            df_overlaps = pd.concat([df for df in [df_case1, df_case2, df_case5, df_case6] if len(df)], ignore_index=True)
-            # in case of a tie between overlap lengths, choose the one with higher Num_Probes value
-            df_max_overlaps_max_probes = df_overlaps.groupby('sample').apply(lambda x: x.sort_values(by=['overlap_len','num_probes'], ascending=False).head(n=1),include_groups=False)
-            ans_df = df_max_overlaps_max_probes.reset_index()
-            ans_df.loc[:, 'public_id'] = ans_df['sample'].str.extract(r'(MMRF_[0-9]+)_')[0]
-            assert not ans_df[ans_df.index.duplicated()].any().any()
-            # drop level_1 column generated by groupby apply
-            ans_df = ans_df.set_index(['public_id']).drop(columns=['level_1'])
-            return ans_df
+        queries = [
+            ('SELECT * FROM genome_gatk_cna WHERE chromosome = %s', (gc,)),
+            ('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND start_pos < %s AND end_pos > %s AND end_pos < %s', (gc,gs,gs,ge)),
+            ('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND start_pos > %s AND start_pos < %s AND end_pos > %s', (gc,gs,ge,ge)),
+            ('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND end_pos < %s', (gc,gs)),
+            ('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND start_pos > %s', (gc,ge)),
+            ('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND start_pos > %s AND end_pos < %s', (gc,gs,ge)),
+            ('SELECT * FROM genome_gatk_cna WHERE chromosome = %s AND start_pos < %s AND end_pos > %s', (gc,gs,ge)),
+        ]
+        return queries, gs, ge
+
+    def _max_overlaps(self, frames: list[pd.DataFrame], gs: int, ge: int) -> pd.DataFrame:
+        # disable SettingWithCopyWarning
+        pd.options.mode.chained_assignment = None  # default='warn'
+
+        cn_chrom, df_case1, df_case2, df_case3, df_case4, df_case5, df_case6 = frames
+
+        # cases 1 to 6 should be all inclusive
+        assert len(df_case1) + len(df_case2) + len(df_case3) + len(df_case4) + len(df_case5) + len(df_case6) == len(cn_chrom)
+
+        # calculate overlap lengths
+        df_case1.loc[:,'overlap_len'] = df_case1['end_pos'] - gs + 1
+        df_case2.loc[:,'overlap_len'] = ge - df_case2['start_pos'] + 1
+        df_case5.loc[:,'overlap_len'] = df_case5['end_pos'] - df_case5['start_pos'] + 1
+        df_case6.loc[:,'overlap_len'] = ge - gs + 1
+
+        df_overlaps = pd.concat([df for df in [df_case1, df_case2, df_case5, df_case6] if len(df)], ignore_index=True)
+        # in case of a tie between overlap lengths, choose the one with higher Num_Probes value
+        df_max_overlaps_max_probes = df_overlaps.groupby('sample').apply(lambda x: x.sort_values(by=['overlap_len','num_probes'], ascending=False).head(n=1),include_groups=False)
+        ans_df = df_max_overlaps_max_probes.reset_index()
+        ans_df.loc[:, 'public_id'] = ans_df['sample'].str.extract(r'(MMRF_[0-9]+)_')[0]
+        assert not ans_df[ans_df.index.duplicated()].any().any()
+        # drop level_1 column generated by groupby apply
+        ans_df = ans_df.set_index(['public_id']).drop(columns=['level_1'])
+        return ans_df
+
+    def _max_overlapping_segment(self, gene_stable_id: str) -> pd.DataFrame:
+        queries, gs, ge = self._segment_queries(gene_stable_id)
+
+        def run(conn) -> list[pd.DataFrame]:
+            frames = []
+            with conn.cursor() as curs:
+                for query, params in queries:
+                    curs.execute(query, params)
+                    frames.append(pd.DataFrame(curs.fetchall(), columns=[desc[0] for desc in curs.description]))
+            return frames
+
+        return self._max_overlaps(run_read(run), gs, ge)
+
+    async def _amax_overlapping_segment(self, gene_stable_id: str) -> pd.DataFrame:
+        queries, gs, ge = self._segment_queries(gene_stable_id)
+
+        async def run(conn) -> list[pd.DataFrame]:
+            frames = []
+            async with conn.cursor() as curs:
+                for query, params in queries:
+                    await curs.execute(query, params)
+                    frames.append(pd.DataFrame(await curs.fetchall(), columns=[desc[0] for desc in curs.description]))
+            return frames
+
+        frames = await arun_read(run)
+        # choosing among the segments of every sample is pandas work, keep it off the event loop
+        return await asyncio.to_thread(self._max_overlaps, frames, gs, ge)
     
     def _run(
         self,
@@ -270,9 +503,22 @@ class GeneCopyNumberTool(BaseTool):
         run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> str:
         """Use the tool."""
-        ans_df = self._max_overlapping_segment(query)
-        csv_path = f'result/gene_level_copy_number_{query}.csv'
-        ans_df.to_csv(csv_path)
+        reuse_key = f"copy_number:{query}"
+        if not (csv_path := find_artifact(reuse_key)):
+            ans_df = self._max_overlapping_segment(query)
+            csv_path = save_artifact("result", f"gene_level_copy_number_{query}", ".csv", ans_df.to_csv, reuse_key)
+        return f"Result saved to {csv_path}"
+
+    async def _arun(
+        self,
+        query: str,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool asynchronously."""
+        reuse_key = f"copy_number:{query}"
+        if not (csv_path := await asyncio.to_thread(find_artifact, reuse_key)):
+            ans_df = await self._amax_overlapping_segment(query)
+            csv_path = await asyncio.to_thread(save_artifact, "result", f"gene_level_copy_number_{query}", ".csv", ans_df.to_csv, reuse_key)
         return f"Result saved to {csv_path}"
 
 
@@ -290,6 +536,21 @@ class CoxRegressionBaseDataTool(BaseTool):
         "You can then merge their feature(s) of interest with this table."
     )
 
+    def _survival_query(self, endpoint: str) -> str:
+        if endpoint == 'os':
+            return 'SELECT PUBLIC_ID, oscdy, censos FROM stand_alone_survival WHERE censos is not null'
+        return 'SELECT PUBLIC_ID, pfscdy, censpfs FROM stand_alone_survival WHERE censpfs is not null'
+
+    def _write_template(self, endpoint: str, surv: list, clin: list) -> None:
+        df_surv = pd.DataFrame(surv, columns=['PUBLIC_ID', endpoint+'cdy', 'cens'+endpoint])
+        df_clin = pd.DataFrame(clin, columns=['PUBLIC_ID', 'D_PT_age', 'D_PT_gender', 'D_PT_iss'])
+        df_clin['D_PT_gender'] = df_clin['D_PT_gender'].map({1: 'Male',2: 'Female'})
+        df_clin['D_PT_iss'] = df_clin['D_PT_iss'].map({1: 'I',2: 'II', 3: 'III'})
+        df_clin['D_PT_gender'] = df_clin['D_PT_gender'].astype(pd.CategoricalDtype())
+        df_clin['D_PT_iss'] = df_clin['D_PT_iss'].astype(pd.CategoricalDtype())
+        df_cph_template = df_surv.merge(df_clin, on='PUBLIC_ID')
+        df_cph_template.to_csv(f'result/cox_ph_covariates_{endpoint}.csv', index=False)
+
     def _get_cox_regression_base_data(self, endpoint='os'):
         # input: endpoint: 'os' or 'pfs' 
         # output: None except printed statement
@@ -299,25 +560,15 @@ class CoxRegressionBaseDataTool(BaseTool):
         # ... which are the common covariates used in Cox PH regression with variable of interest
         # create the datase only if not already exists
         if not os.path.exists(f'result/cox_ph_covariates_{endpoint}.csv'):
-            conn = psycopg.connect(COMMPASS_DSN)
-            with conn.cursor() as curs:
-                if endpoint == 'os':
-                    curs.execute(f'SELECT PUBLIC_ID, oscdy, censos FROM stand_alone_survival WHERE censos is not null')
-                elif endpoint == 'pfs':
-                    curs.execute(f'SELECT PUBLIC_ID, pfscdy, censpfs FROM stand_alone_survival WHERE censpfs is not null')
-                else:
-                    raise ValueError('endpoint must be either \"os\" or \"pfs\"')
-                result = curs.fetchall()
-                df_surv = pd.DataFrame(result, columns=['PUBLIC_ID', endpoint+'cdy', 'cens'+endpoint])
-                curs.execute('SELECT PUBLIC_ID, D_PT_age, D_PT_gender, D_PT_iss FROM per_patient')
-                result = curs.fetchall()
-                df_clin = pd.DataFrame(result, columns=['PUBLIC_ID', 'D_PT_age', 'D_PT_gender', 'D_PT_iss'])
-                df_clin['D_PT_gender'] = df_clin['D_PT_gender'].map({1: 'Male',2: 'Female'})
-                df_clin['D_PT_iss'] = df_clin['D_PT_iss'].map({1: 'I',2: 'II', 3: 'III'})
-                df_clin['D_PT_gender'] = df_clin['D_PT_gender'].astype(pd.CategoricalDtype())
-                df_clin['D_PT_iss'] = df_clin['D_PT_iss'].astype(pd.CategoricalDtype())
-                df_cph_template = df_surv.merge(df_clin, on='PUBLIC_ID')
-                df_cph_template.to_csv(f'result/cox_ph_covariates_{endpoint}.csv', index=False)
+            if endpoint not in ['os', 'pfs']:
+                raise ValueError('endpoint must be either \"os\" or \"pfs\"')
+            def run(conn) -> tuple[list, list]:
+                with conn.cursor() as curs:
+                    curs.execute(self._survival_query(endpoint))
+                    surv = curs.fetchall()
+                    curs.execute('SELECT PUBLIC_ID, D_PT_age, D_PT_gender, D_PT_iss FROM per_patient')
+                    return surv, curs.fetchall()
+            self._write_template(endpoint, *run_read(run))
 
         # Already pre-generated to save
         return f'Saved template dataset containing PUBLIC ID, {endpoint}, age, ISS, gender columns to result/cox_ph_covariates_{endpoint}.csv'
@@ -330,6 +581,25 @@ class CoxRegressionBaseDataTool(BaseTool):
         """Use the tool."""
         return self._get_cox_regression_base_data(query)
 
+    async def _arun(
+        self,
+        query: str,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool asynchronously."""
+        endpoint = query
+        if not os.path.exists(f'result/cox_ph_covariates_{endpoint}.csv'):
+            if endpoint not in ['os', 'pfs']:
+                raise ValueError('endpoint must be either \"os\" or \"pfs\"')
+            async def run(conn) -> tuple[list, list]:
+                async with conn.cursor() as curs:
+                    await curs.execute(self._survival_query(endpoint))
+                    surv = await curs.fetchall()
+                    await curs.execute('SELECT PUBLIC_ID, D_PT_age, D_PT_gender, D_PT_iss FROM per_patient')
+                    return surv, await curs.fetchall()
+            await asyncio.to_thread(self._write_template, endpoint, *(await arun_read(run)))
+        return self._get_cox_regression_base_data(endpoint)
+
 class CoxPHStatsLog2TPMExprTool(BaseTool):
     name: str = "gene_expr_coxph_statistics"
     description: str = (
@@ -345,7 +615,7 @@ class CoxPHStatsLog2TPMExprTool(BaseTool):
         "Suitable for: User wants to filter a long list of genes down to those relevant to survival outcomes. "
         "Suitable for: User wants to measure whether upregulation or downregulation of a gene is associated with better or worse survival outcomes -> look at whether hazard ratio is >1 or <1. "
         "Not suitable for: User wants to measure the effect of their gene of interest on survival while adjusting for other covariates apart from age, sex, and ISS -> Suggest using get_cox_regression_base_data to get the base dataset and then merge their feature(s) of interest for CoxPH regression. "
-        "Not suitable for: analysis on certain subpopulations, as summary statistics are based on the entire cohort."
+        "Not suitable for: analysis on certain subpopulations, as summary statistics are based on the entire cohort -> use gene_expr_coxph_statistics_subpopulation instead."
     )
     
     def _run(
@@ -362,6 +632,47 @@ class CoxPHStatsLog2TPMExprTool(BaseTool):
             return f'Error: Gene-wise Cox PH regression results for endpoint {endpoint} not found.'
         return f'Path to gene-wise CoxPH summary statistics for {endpoint} endpoint: {refdata_file}'
 
+class CoxPHSubpopulationTool(BaseTool):
+    name: str = "gene_expr_coxph_statistics_subpopulation"
+    description: str = (
+        "Compute gene-wise Cox PH regression results for a subpopulation of patients for a given endpoint ('os' or 'pfs'). "
+        "Arguments: endpoint (str), either 'os' or 'pfs'; patients (str), the patient subset, given as either "
+        "a SELECT query returning public_id values, the path to a csv file with a public_id column (e.g. from execute_full_sql_query_with_python), "
+        "or a comma-separated list of public ids. "
+        "Returns the path to a csv file with the same columns as gene_expr_coxph_statistics: "
+        "`Gene`,`coef`,`exp(coef)`,`se(coef)`,`coef lower 95%`,`coef upper 95%`,`exp(coef) lower 95%`,`exp(coef) upper 95%`,`cmp to`,`z`,`p`,`-log2(p)`, ordered by p. "
+        "The analysis performed is Cox PH regression on z-score of log2 (tpm+1) expression values of all genes, z-scored within the subpopulation, "
+        "with age, sex, and ISS as covariates. Samples are first-visit, bone marrow CD138pos. "
+        "Example input: endpoint=pfs, patients=SELECT public_id FROM ... WHERE ... "
+        "Takes a few minutes for all genes. Do not loop over genes with lifelines in the python REPL; use this tool instead. "
+        "Suitable for: User wants survival-associated genes within a subpopulation e.g. t(11;14) patients or ISS III patients. "
+        "Not suitable for: the entire cohort -> use gene_expr_coxph_statistics for pre-computed results."
+    )
+
+    def _run(
+        self,
+        endpoint: str,
+        patients: str,
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool."""
+        endpoint = endpoint.lower()
+        if endpoint not in ['os', 'pfs']:
+            return "Error: endpoint must be either 'os' or 'pfs'"
+        try:
+            public_ids = resolve_patients(patients)
+        except Exception as e:
+            return f"Error: could not resolve patient subset. {e}"
+        genes, public_ids, log2tpm = load_first_visit_log2tpm(public_ids)
+        if len(public_ids) == 0:
+            return "Error: none of the selected patients have first-visit gene expression data."
+        try:
+            df = coxph_genes(genes, public_ids, log2tpm, endpoint)
+        except ValueError as e:
+            return f"Error: {e}"
+        csv_path = save_artifact("result", f"cox_ph_{endpoint}_{len(df)}_genes", ".csv", lambda path: df.to_csv(path, index=False))
+        return f"Path to gene-wise CoxPH summary statistics for {endpoint} endpoint in {df.attrs['n_patients']} patients: {csv_path}"
+
 class MADLog2TPMExprTool(BaseTool):
     name: str = "gene_expr_mad_values"
     description: str = (
@@ -372,7 +683,7 @@ class MADLog2TPMExprTool(BaseTool):
         "Suitable for: User wants to filter or order genes based on expression variability across the cohort. "
         "Suitable for: User wants to check if a subpopulation has higher or lower expression compared to the cohort median. "
         "Not suitable for: evaluating differential expression between conditions. This is cohort-wide summary statistics. "
-        "Not suitable for: retrieving median or MAD of certain subpopulations. Values here are based on the entire cohort."
+        "Not suitable for: retrieving median or MAD of certain subpopulations. Values here are based on the entire cohort -> use gene_expr_mad_values_subpopulation instead."
     )
     
     def _run(
@@ -385,6 +696,39 @@ class MADLog2TPMExprTool(BaseTool):
             return 'Error: Pre-computed gene MAD results not found.'
         return f'Path to gene-wise median and MAD of log2(tpm+1) expression values: {refdata_file}'
 
+class MADSubpopulationTool(BaseTool):
+    name: str = "gene_expr_mad_values_subpopulation"
+    description: str = (
+        "Compute the median and median absolute deviation (MAD) of log2(tpm+1)-transformed gene expression for a subpopulation of patients. "
+        "Argument: patients (str), the patient subset, given as either a SELECT query returning public_id values, "
+        "the path to a csv file with a public_id column (e.g. from execute_full_sql_query_with_python), or a comma-separated list of public ids. "
+        "Returns the path to a csv file with the same columns as gene_expr_mad_values: gene, median_log2, mad_log2, ordered by decreasing mad_log2. "
+        "Samples are first-visit, bone marrow CD138pos. Takes a few seconds for all genes. "
+        "Example input: SELECT public_id FROM ... WHERE ... "
+        "Suitable for: User wants the most variable genes within a subpopulation e.g. t(11;14) patients. "
+        "Suitable for: User wants to compare the median expression of a subpopulation with the cohort-wide values from gene_expr_mad_values. "
+        "Not suitable for: evaluating differential expression between conditions -> use gene_expr_differential."
+    )
+
+    def _run(
+        self,
+        patients: str,
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool."""
+        try:
+            public_ids = resolve_patients(patients)
+        except Exception as e:
+            return f"Error: could not resolve patient subset. {e}"
+        genes, public_ids, log2tpm = load_first_visit_log2tpm(public_ids)
+        if len(public_ids) == 0:
+            return "Error: none of the selected patients have first-visit gene expression data."
+        median, mad = median_mad(log2tpm)
+        df = pd.DataFrame({'gene': genes, 'median_log2': median, 'mad_log2': mad})
+        df = df.sort_values('mad_log2', ascending=False)
+        csv_path = save_artifact("result", f"gene_log2tpm_mad_{len(public_ids)}_patients", ".csv", lambda path: df.to_csv(path, index=False))
+        return f"Path to gene-wise median and MAD of log2(tpm+1) expression values in {len(public_ids)} patients: {csv_path}"
+
 class RetrieveGeneListTool(BaseTool):
     name: str = "retrieve_gene_list"
     description: str = (
@@ -419,6 +763,14 @@ class RetrieveGeneListTool(BaseTool):
         
         return f'Path to {query} genes: {refdata_file}'
 
+    async def _arun(
+        self,
+        query:str,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool asynchronously."""
+        return self._run(query)
+
 class SurvivalDataTool(BaseTool):
     name: str = "get_survival_data"
     description: str = (
@@ -428,6 +780,7 @@ class SurvivalDataTool(BaseTool):
         "oscdy and pfscdy are time-to-event in days"
         "censos and censpfs are censoring status (1=event occurred, 0=censored)."
         "Use scenario: To perform survival analysis or Cox regression, merge your features with this data."
+        "For Kaplan-Meier curves, median survival and log-rank tests between groups, use survival_analysis instead."
     )
     def _run(
         self,
@@ -443,17 +796,278 @@ class SurvivalDataTool(BaseTool):
             return f'Error: Survival data for {query} endpoint not found.'
         return f"Path to {query} data file for all patients: {csv_path}"
 
+    async def _arun(
+        self,
+        query: str,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool asynchronously."""
+        return self._run(query)
+
+class SurvivalAnalysisTool(BaseTool):
+    name: str = "survival_analysis"
+    description: str = (
+        "Kaplan-Meier survival analysis and log-rank test between groups of patients in one call. "
+        "Arguments: endpoint (str), either 'os' or 'pfs'; "
+        "grouping (str), a SELECT query or the path to a csv file with a public_id column and a group label column; "
+        "gene (str), an Ensembl Gene stable ID (e.g. ENSG00000109685) to split patients into high and low expression at the median instead of grouping; "
+        "patients (str, optional), a SELECT query, csv path or comma-separated public ids restricting the patients for the gene split. "
+        "Give either grouping or gene. "
+        "Returns the number of patients, events and median survival (days) per group, the log-rank p value, "
+        "the path to a csv file of the Kaplan-Meier estimates with 95% confidence intervals, and the rendered Kaplan-Meier plot as HTML. "
+        "Example input: endpoint=os, grouping=SELECT public_id, d_pt_iss FROM per_patient "
+        "Example input: endpoint=pfs, gene=ENSG00000109685 "
+        "Suitable for: comparing survival between subgroups, no python code or separate plotting needed. "
+        "Not suitable for: adjusting for covariates -> use get_cox_regression_base_data."
+    )
+
+    def _run(
+        self,
+        endpoint: str,
+        grouping: str = '',
+        gene: str = '',
+        patients: str = '',
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool."""
+        endpoint = endpoint.lower()
+        if endpoint not in ['os', 'pfs']:
+            return "Error: endpoint must be either 'os' or 'pfs'"
+        try:
+            if gene.strip():
+                if not gene.strip().startswith("ENSG"):
+                    return f"Error: '{gene}' does not appear to be a valid Gene stable ID. Use convert_gene_name_to_accession first."
+                genes, public_ids, log2tpm = load_first_visit_log2tpm(resolve_patients(patients), genes=[gene.strip()])
+                if len(genes) == 0:
+                    return f"Error: no expression data for gene {gene}."
+                expr = pd.Series(log2tpm[0], index=public_ids)
+                groups = (expr > expr.median()).map({True: f'{gene.strip()} high', False: f'{gene.strip()} low'})
+            elif grouping.strip():
+                groups = resolve_groups(grouping)
+            else:
+                return "Error: either grouping or gene must be given."
+            result = survival_by_group(endpoint, groups)
+        except Exception as e:
+            return f"Error: {e}"
+
+        csv_path = save_artifact("result", f"kaplan_meier_{endpoint}", ".csv", lambda path: result['km'].to_csv(path, index=False))
+        n = result['summary'].set_index('group')['n']
+        try:
+            preview = render_plot({
+                'kind': 'km',
+                'data': csv_path,
+                'labels': {str(label): f'{label} (n={count})' for label, count in n.items()},
+                'ylabel': 'Overall survival' if endpoint == 'os' else 'Progression-free survival',
+                'title': f"Log-rank p = {result['p']:.3g}",
+            })['png']
+            plot_html = DisplayPlotTool()._html(preview, f'/api/plot_full?preview={preview}&format=png')
+        except Exception as e:
+            # the test results stand without the plot, which can be drawn from csv_path with render_plot
+            plot_html = f" Error: the Kaplan-Meier plot could not be rendered. {e}"
+        return (
+            f"Log-rank test for {endpoint} across {len(result['summary'])} groups: "
+            f"chi-square = {result['statistic']:.3f}, p = {result['p']:.3g}."
+            f"{result['summary'].to_html(index=False, border=0)}"
+            f"Kaplan-Meier estimates saved to {csv_path}."
+            f"{plot_html}"
+        )
+
+class SurvivalScanTool(BaseTool):
+    name: str = "gene_expr_survival_scan"
+    description: str = (
+        "Scan many genes for association with survival by splitting patients into high and low expression at each gene's median "
+        "and running a log-rank test per gene. "
+        "Arguments: endpoint (str), either 'os' or 'pfs'; "
+        "genes (str), either 'proteincoding' (default, 20084 protein-coding genes), 'all', 'mad:N' for the N most variable genes, "
+        "a comma-separated list of Ensembl Gene stable IDs, or the path to a csv file with an ensg or gene column; "
+        "patients (str, optional), a SELECT query, csv path or comma-separated public ids restricting the patients. "
+        "Returns the path to a csv file ranked by p value with columns "
+        "gene, symbol, n_high, n_low, events_high, events_low, median_survival_high, median_survival_low, o_minus_e_high, chisq, p, q. "
+        "q is the Benjamini-Hochberg FDR. o_minus_e_high > 0 means worse survival with high expression. "
+        "Samples are first-visit, bone marrow CD138pos. A genome-wide scan takes under a minute. "
+        "Do not loop over genes with lifelines in the python REPL; use this tool instead. "
+        "Suitable for: User wants to know which genes' high vs low expression splits OS or PFS. "
+        "Not suitable for: adjusting for age, sex, and ISS -> use gene_expr_coxph_statistics or gene_expr_coxph_statistics_subpopulation."
+    )
+
+    def _run(
+        self,
+        endpoint: str,
+        genes: str = 'proteincoding',
+        patients: str = '',
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool."""
+        endpoint = endpoint.lower()
+        if endpoint not in ['os', 'pfs']:
+            return "Error: endpoint must be either 'os' or 'pfs'"
+        try:
+            gene_list = resolve_gene_list(genes.strip() or 'proteincoding')
+        except ValueError as e:
+            return f"Error: {e}"
+        try:
+            public_ids = resolve_patients(patients)
+        except Exception as e:
+            return f"Error: could not resolve patient subset. {e}"
+        gene_ids, public_ids, log2tpm = load_first_visit_log2tpm(public_ids, genes=gene_list)
+        if len(gene_ids) == 0 or len(public_ids) == 0:
+            return "Error: no expression data for the selected genes and patients."
+        df = logrank_scan(gene_ids, public_ids, log2tpm, endpoint)
+        symbols = gene_annot.drop_duplicates('gene_stable_id').set_index('gene_stable_id')['gene_symbol']
+        df.insert(1, 'symbol', df['gene'].map(symbols))
+        csv_path = save_artifact("result", f"survival_scan_{endpoint}_{len(df)}_genes", ".csv", lambda path: df.to_csv(path, index=False))
+        return f"Median-split log-rank results for {len(df)} genes ({(df['q'] < 0.05).sum()} with q < 0.05) saved to {csv_path}"
+
+class ClusteredHeatmapTool(BaseTool):
+    name: str = "gene_expr_clustered_heatmap"
+    description: str = (
+        "Hierarchically cluster genes and patients on z-scored log2(tpm+1) expression and display the clustered heatmap. "
+        "Arguments: genes (str), a comma-separated list of Ensembl Gene stable IDs, the path to a csv file with an ensg or gene column, "
+        "or 'mad:N' for the N most variable genes cohort-wide e.g. 'mad:500'; "
+        "patients (str, optional), a SELECT query, csv path or comma-separated public ids restricting the patients; "
+        f"method (str, optional), linkage method, one of {', '.join(METHODS)}, default average; "
+        f"metric (str, optional), distance metric, one of {', '.join(METRICS)}, default correlation; ward always uses euclidean; "
+        "cluster_patients (bool, optional), also cluster the patients, default True. "
+        f"At most {CLUSTER_MAX_GENES} genes; genes with zero variance are dropped. "
+        "Returns the path to a csv file with the z-scores in dendrogram order (first column gene symbol, then one column per public_id) "
+        "and a preview of the heatmap with a link to the full resolution image. "
+        "Samples are first-visit, bone marrow CD138pos. Clusterings are cached, repeating a request is fast. "
+        "Do not use seaborn clustermap in the python REPL; use this tool instead. "
+        "Suitable for: User wants a clustered heatmap or expression clusters of a gene set e.g. the top variable genes. "
+        "Not suitable for: heatmaps of data other than gene expression -> use render_plot with kind heatmap."
+    )
+
+    def _run(
+        self,
+        genes: str,
+        patients: str = '',
+        method: str = 'average',
+        metric: str = 'correlation',
+        cluster_patients: bool = True,
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool."""
+        method, metric = method.strip().lower() or 'average', metric.strip().lower() or 'correlation'
+        if method not in METHODS or metric not in METRICS:
+            return f"Error: method must be one of {', '.join(METHODS)} and metric one of {', '.join(METRICS)}."
+        try:
+            gene_list = resolve_gene_list(genes.strip())
+        except ValueError as e:
+            return f"Error: {e}"
+        if gene_list is None or len(gene_list) > CLUSTER_MAX_GENES:
+            return f"Error: at most {CLUSTER_MAX_GENES} genes can be clustered, e.g. use 'mad:{CLUSTER_MAX_GENES}' for the most variable genes."
+        try:
+            public_ids = resolve_patients(patients)
+        except Exception as e:
+            return f"Error: could not resolve patient subset. {e}"
+        gene_ids, public_ids, log2tpm = load_first_visit_log2tpm(public_ids, genes=gene_list)
+        z, keep = zscore_rows(log2tpm)
+        gene_ids = gene_ids[keep]
+        if len(gene_ids) < 2 or len(public_ids) < 2:
+            return "Error: at least 2 variable genes and 2 patients with expression data are needed for clustering."
+        rows, cols = cluster_matrix(z, method, metric, cluster_columns=cluster_patients)
+        symbols = gene_annot.drop_duplicates('gene_stable_id').set_index('gene_stable_id')['gene_symbol']
+        labels = pd.Series(gene_ids[rows]).map(symbols).fillna(pd.Series(gene_ids[rows])).to_numpy()
+        df = pd.DataFrame(z[np.ix_(rows, cols)], columns=public_ids[cols])
+        df.insert(0, 'gene', labels)
+        csv_path = save_artifact("result", f"clustered_heatmap_{len(gene_ids)}_genes", ".csv", lambda path: df.to_csv(path, index=False, float_format='%.3f'))
+        spec = {'kind': 'heatmap', 'data': csv_path, 'diverging': True,
+                'title': f"{len(gene_ids)} genes x {len(public_ids)} patients, {method} linkage", 'ylabel': 'gene', 'xlabel': 'patient'}
+        try:
+            preview = render_plot(spec)['png']
+        except Exception as e:
+            return f"Error: clustering saved to {csv_path} but the heatmap could not be rendered. {e}"
+        return (
+            f"Z-scored expression of {len(gene_ids)} genes in {len(public_ids)} patients in clustered order saved to {csv_path}."
+            f"{DisplayPlotTool()._html(preview, f'/api/plot_full?preview={preview}&format=png')}"
+        )
+
+class DifferentialExpressionTool(BaseTool):
+    name: str = "gene_expr_differential"
+    description: str = (
+        "Test every gene for differential log2(tpm+1) expression between two groups of patients at once, "
+        "with a Welch t-test or Mann-Whitney U test and Benjamini-Hochberg FDR. "
+        "Arguments: grouping (str), a SELECT query or the path to a csv file with a public_id column and a group column "
+        "(the first column other than public_id); "
+        "case (str, optional), the group label tested; control (str, optional), the reference group label, default all patients not in case; "
+        "if neither is given, grouping must have exactly two groups and the second in sorted order is the case e.g. 1 vs 0; "
+        "genes (str, optional), 'all' (default, ~60k genes), 'proteincoding', 'mad:N' for the N most variable genes, "
+        "a comma-separated list of Ensembl Gene stable IDs, or the path to a csv file with an ensg or gene column; "
+        f"test (str, optional), one of {', '.join(DE_TESTS)}, default welch. "
+        "Returns the path to a csv file ranked by p value with columns gene, symbol, mean_case, mean_control, log2fc, statistic, p, q. "
+        "log2fc is mean log2(tpm+1) of case minus control. Genes without variation have empty p and q. "
+        "Samples are first-visit, bone marrow CD138pos. All genes take a few seconds. "
+        "Do not loop over genes with scipy in the python REPL; use this tool instead. "
+        "Follow up with render_plot kind volcano, x log2fc, y q, label symbol for a volcano plot. "
+        "Suitable for: User wants genes differentially expressed between e.g. t(4;14) and other patients, or responders and non-responders."
+    )
+
+    def _run(
+        self,
+        grouping: str,
+        case: str = '',
+        control: str = '',
+        genes: str = 'all',
+        test: str = 'welch',
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+    ) -> str:
+        """Use the tool."""
+        test = test.strip().lower().replace('-', '').replace('_', '') or 'welch'
+        if test not in DE_TESTS:
+            return f"Error: test must be one of {', '.join(DE_TESTS)}."
+        try:
+            gene_list = resolve_gene_list(genes.strip() or 'all')
+            groups = resolve_groups(grouping).dropna().astype(str)
+        except Exception as e:
+            return f"Error: {e}"
+        case, control = case.strip(), control.strip()
+        labels = sorted(groups.unique())
+        if not case:
+            if control or len(labels) != 2:
+                return f"Error: grouping has groups {', '.join(labels)}; name the case group."
+            control, case = labels
+        for label in (case, control):
+            if label and label not in labels:
+                return f"Error: group {label} not in grouping, which has groups {', '.join(labels)}."
+        # blocks of genes are read and log-transformed as the test reaches them
+        public_ids, blocks = iter_first_visit_log2tpm(list(groups.index), genes=gene_list)
+        sample_groups = groups.reindex(public_ids).to_numpy()
+        is_case = sample_groups == case
+        is_control = sample_groups == control if control else ~is_case
+        control = control or 'rest'
+        try:
+            df = differential_expression(blocks, is_case, is_control, test)
+        except ValueError as e:
+            return f"Error: {e} with expression data, {case}: {is_case.sum()}, {control}: {is_control.sum()}."
+        symbols = gene_annot.drop_duplicates('gene_stable_id').set_index('gene_stable_id')['gene_symbol']
+        df.insert(1, 'symbol', df['gene'].map(symbols))
+        csv_path = save_artifact("result", f"differential_expression_{test}", ".csv", lambda path: df.to_csv(path, index=False))
+        significant = df['q'] < 0.05
+        return (
+            f"{test} test of {case} (n={is_case.sum()}) vs {control} (n={is_control.sum()}) over {df['p'].notna().sum()} genes: "
+            f"{(significant & (df['log2fc'] > 0)).sum()} up and {(significant & (df['log2fc'] < 0)).sum()} down with q < 0.05. "
+            f"Results saved to {csv_path}"
+        )
+
 __all__ = [
+    "ClusteredHeatmapTool",
     "ConvertGeneTool", 
     "GeneMetadataTool", 
     "MADLog2TPMExprTool", 
+    "MADSubpopulationTool",
     "PythonSQLTool", 
+    "TrialSQLTool",
     "DocumentSearchTool", 
     "GenerateGraphFilepathTool", 
     "DisplayPlotTool", 
+    "RenderPlotTool",
     "GeneCopyNumberTool", 
     "CoxRegressionBaseDataTool", 
     "CoxPHStatsLog2TPMExprTool",
+    "CoxPHSubpopulationTool",
+    "DifferentialExpressionTool",
     "RetrieveGeneListTool",
-    "SurvivalDataTool"
+    "SurvivalAnalysisTool",
+    "SurvivalDataTool",
+    "SurvivalScanTool"
     ]
\ No newline at end of file
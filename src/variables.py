@@ -13,6 +13,34 @@ JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY")
 JWT_SECURITY_SALT = os.environ.get("JWT_SECURITY_SALT")
 EMBEDDINGS_MODEL_PROVIDER = os.environ.get("EMBEDDINGS_MODEL_PROVIDER")
 EMBEDDINGS_TABLE_SUFFIX = os.environ.get("EMBEDDINGS_TABLE_SUFFIX")
+# optional, comma-separated hostnames of read replicas of the CoMMpass database
+DBREPLICA_HOSTNAMES = [host.strip() for host in os.environ.get("DBREPLICA_HOSTNAMES", "").split(",") if host.strip()]
+# optional, disk quota per user for result and graph files, days an unused file is kept, seconds between collections
+ARTIFACT_QUOTA_MB = int(os.environ.get("ARTIFACT_QUOTA_MB", "500"))
+ARTIFACT_TTL_DAYS = float(os.environ.get("ARTIFACT_TTL_DAYS", "14"))
+ARTIFACT_GC_INTERVAL = int(os.environ.get("ARTIFACT_GC_INTERVAL", "3600"))
+# optional, number of checkpoints kept per conversation thread and seconds between compactions
+CHECKPOINT_KEEP_LAST = int(os.environ.get("CHECKPOINT_KEEP_LAST", "10"))
+CHECKPOINT_COMPACTION_INTERVAL = int(os.environ.get("CHECKPOINT_COMPACTION_INTERVAL", "3600"))
+# optional, agent runs executing at once across all users and per user, excess runs are queued
+MAX_CONCURRENT_RUNS = int(os.environ.get("MAX_CONCURRENT_RUNS", "4"))
+MAX_CONCURRENT_RUNS_PER_USER = int(os.environ.get("MAX_CONCURRENT_RUNS_PER_USER", "1"))
+# optional, tool calls of one agent step that run at the same time
+MAX_TOOL_CONCURRENCY = int(os.environ.get("MAX_TOOL_CONCURRENCY", "4"))
+# optional, worker processes rendering plots
+PLOT_WORKERS = int(os.environ.get("PLOT_WORKERS", "2"))
+# optional, statement_timeout and maximum EXPLAIN cost of agent-written SQL, for trial runs and full exports
+SQL_TRIAL_TIMEOUT_MS = int(os.environ.get("SQL_TRIAL_TIMEOUT_MS", "30000"))
+SQL_EXPORT_TIMEOUT_MS = int(os.environ.get("SQL_EXPORT_TIMEOUT_MS", "300000"))
+SQL_TRIAL_MAX_COST = float(os.environ.get("SQL_TRIAL_MAX_COST", "1e6"))
+SQL_EXPORT_MAX_COST = float(os.environ.get("SQL_EXPORT_MAX_COST", "1e8"))
+# optional, fast model for intermediate tool-calling steps, routing is disabled if not set
+ROUTER_MODEL_ID = os.environ.get("ROUTER_MODEL_ID")
+# optional, LLM requests per second per provider e.g. "openai=5,anthropic=2", unlisted providers are not limited
+LLM_RATE_LIMITS = {
+    provider.strip(): float(rate)
+    for provider, rate in (item.split("=") for item in os.environ.get("LLM_RATE_LIMITS", "").split(",") if item.strip())
+}
 
 assert API_BYPASS_TOKEN is not None, "API_BYPASS_TOKEN environment variable is not set"
 assert DBHOSTNAME is not None, "DBHOSTNAME environment variable is not set"
@@ -33,22 +61,40 @@ COMMPASS_DSN=f"dbname=commpass user={DBUSERNAME} password={DBPASSWORD} host={DBH
 COMMPASS_AUTH_DSN=f"dbname=commpass user={DBUSERNAME} password={DBPASSWORD} host={DBHOSTNAME} options='-c search_path=auth'"
 COMMPASS_DB_URI=f"postgresql+psycopg://{DBUSERNAME}:{DBPASSWORD}@{DBHOSTNAME}/commpass"
 COMMPASS_DB_URI_POSTGRES=f"postgresql+psycopg://{DBUSERNAME}:{DBPASSWORD}@{DBHOSTNAME}/commpass"
+COMMPASS_REPLICA_DSNS=[f"dbname=commpass user={DBUSERNAME} password={DBPASSWORD} host={host} port=5432" for host in DBREPLICA_HOSTNAMES]
 COMMPASS_MEMORY_DB_URI=f"postgresql://{DBUSERNAME}:{DBPASSWORD}@{DBHOSTNAME}:5432/commpass?options=-csearch_path%3dcheckpoints"
 
 __all__ = [
     "API_BYPASS_TOKEN",
+    "ARTIFACT_GC_INTERVAL",
+    "ARTIFACT_QUOTA_MB",
+    "ARTIFACT_TTL_DAYS",
+    "CHECKPOINT_COMPACTION_INTERVAL",
+    "CHECKPOINT_KEEP_LAST",
     "COMMPASS_AUTH_DSN",
     "COMMPASS_DB_URI",
     "COMMPASS_DB_URI_POSTGRES",
     "COMMPASS_DSN",
     "COMMPASS_MEMORY_DB_URI",
+    "COMMPASS_REPLICA_DSNS",
+    "DBREPLICA_HOSTNAMES",
     "EMBEDDINGS_MODEL_PROVIDER",
     "EMBEDDINGS_TABLE_SUFFIX",
     "MAIL_USERNAME",
     "MAIL_PASSWORD",
     "MAIL_SERVER",
     "MODEL_ID",
+    "PLOT_WORKERS",
+    "ROUTER_MODEL_ID",
     "SERVER_BASE_URL",
+    "SQL_EXPORT_MAX_COST",
+    "SQL_EXPORT_TIMEOUT_MS",
+    "SQL_TRIAL_MAX_COST",
+    "SQL_TRIAL_TIMEOUT_MS",
     "JWT_SECRET_KEY",
     "JWT_SECURITY_SALT",
+    "LLM_RATE_LIMITS",
+    "MAX_CONCURRENT_RUNS",
+    "MAX_CONCURRENT_RUNS_PER_USER",
+    "MAX_TOOL_CONCURRENCY",
 ]
\ No newline at end of file
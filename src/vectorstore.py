@@ -34,12 +34,27 @@ try:
 except AttributeError:
     os.environ["EMBEDDINGS_MODEL_ID"] = embeddings.model_id
 
-# create connection to vector store
+# connection to vector store, created once and shared by sync and async searches
+_store = None
+
 def connect_store():
-    store = PGVectorStore.create_sync(
-        engine=pg_engine,
-        table_name=EMBEDDINGS_MODEL_PROVIDER+EMBEDDINGS_TABLE_SUFFIX,
-        schema_name="document_embeddings",
-        embedding_service=embeddings,
-    )
-    return store
\ No newline at end of file
+    global _store
+    if _store is None:
+        _store = PGVectorStore.create_sync(
+            engine=pg_engine,
+            table_name=EMBEDDINGS_MODEL_PROVIDER+EMBEDDINGS_TABLE_SUFFIX,
+            schema_name="document_embeddings",
+            embedding_service=embeddings,
+        )
+    return _store
+
+async def aconnect_store():
+    global _store
+    if _store is None:
+        _store = await PGVectorStore.create(
+            engine=pg_engine,
+            table_name=EMBEDDINGS_MODEL_PROVIDER+EMBEDDINGS_TABLE_SUFFIX,
+            schema_name="document_embeddings",
+            embedding_service=embeddings,
+        )
+    return _store